@@ -3,35 +3,163 @@ Configuration file for starGate.py.
 """
 
 ## AMI Configuration
+# filters asks asterisk (1.8+) to only send the events chevrons registered
+# for. eventmask, if set, is sent with an Events action on login, e.g.
+# 'call,agent'.
 ami = {
     'host': 'voip.example.net',
     'port': 5038,
     'username': 'asterisk',
-    'password': 'password'
+    'password': 'password',
+    'filters': False,
+    'eventmask': None
 }
 
 ## FastAGI Configuration
+# At most max_sessions sessions (max_per_command per command) are handled at
+# once, with up to backlog more waiting for a slot; 0 means unlimited. Other
+# sessions get the overflow response, either 'setPriority' (restart at
+# priority 1) or 'finish' (carry on in the dialplan).
 agi = {
-    'port': 24131
+    'port': 24131,
+    'max_sessions': 200,
+    'max_per_command': {},
+    'backlog': 100,
+    'overflow': 'finish'
 }
 
 ## Database Configuration
+# The pool keeps between min and max connections. In adaptive mode it starts
+# at min and, every resize_interval seconds, grows towards max by the number
+# of queries waiting for a connection (unless their average latency is over
+# latency_max seconds) or shrinks by one connection when some sit idle.
+# Chevrons named in pools get a dedicated pool and write journal, with any of
+# these settings overridden, e.g. {'records': {'min': 2, 'max': 10}}.
 db = {
     'type': 'MySQLdb',
     'host': '127.0.0.1',
     'username': 'user',
     'password': 'password',
-    'database': 'stargate'
+    'database': 'stargate',
+    'min': 3,
+    'max': 5,
+    'adaptive': False,
+    'resize_interval': 10,
+    'latency_max': 0.5,
+    'pools': {}
+}
+
+## Write Journal Configuration
+# Database writes wait in memory, with at most max_inflight of them running
+# at once. Writes for the same call or queue member run in order, one at a
+# time, while writes for different ones share the pool connections. Past
+# max_pending waiting writes, or while the database is failing, critical and
+# normal writes are appended to the journal at path instead (synced to disk
+# every fsync_interval seconds) while best-effort writes are shed, as they
+# are from shed_at (a share of max_pending) waiting writes on.
+# After failure_threshold connection errors in a row the circuit breaker
+# opens and the database is probed after retry seconds, doubling up to
+# retry_max. The journal is replayed in order at up to replay_rate writes per
+# second once the database is back, or on the next start. Only connection
+# errors are waited out: a write the database refuses is tried attempts times
+# in all, then appended to the dead-letter file at path.dead.
+journal = {
+    'path': 'stargate.journal',
+    'max_pending': 5000,
+    'max_inflight': 10,
+    'replay_rate': 200,
+    'fsync_interval': 0.2,
+    'retry': 5,
+    'retry_max': 300,
+    'failure_threshold': 3,
+    'shed_at': 0.5,
+    'attempts': 3
+}
+
+## Logging Configuration
+# Default level and per chevron levels (debug, info, warning, error). sample
+# logs only one in every N events of a chevron at debug level. Sending
+# stargate SIGUSR2 toggles debug logging on everything at runtime.
+logging = {
+    'level': 'info',
+    'levels': {},
+    'sample': {}
+}
+
+## Metrics Configuration
+# Serves prometheus text metrics at http://interface:port/metrics, a port of
+# 0 disables the endpoint.
+metrics = {
+    'port': 9124,
+    'interface': '127.0.0.1'
 }
 
 plugins = {}
 
-plugins['records'] = {}
+## Call Records Plugin Configuration
+# By default every call state change is written to the records table as it
+# happens. Set write_behind to True to opt in to keeping call state in memory
+# and writing each record once on hangup instead; the table then lags open
+# calls by up to checkpoint seconds, the interval open records are flushed
+# at, or until hangup if checkpoint is 0. close_batch bounds the number of
+# stale records closed per UPDATE when reconciling on (re)connect. With
+# rollups on, closed calls are totalled per rollup_bucket seconds by
+# caller_dnid, account_code and agent into records_rollup, checked for
+# finished buckets every rollup_flush seconds; tools/rollup.py backfills
+# them from past records.
+# export streams every completed call record to a local file, e.g.
+# {'path': 'cdr/records.jsonl', 'format': 'jsonl' or 'csv', 'batch': 500,
+#  'interval': 1.0, 'max_bytes': 67108864, 'max_age': 3600, 'compress': True,
+#  'max_buffered': 100000}
+# written and synced every interval seconds or batch records, rotated at
+# max_bytes or after max_age seconds and gzipped on rotation. Failed writes
+# are retried, keeping up to max_buffered records in memory, and records
+# which can't be encoded are appended to path + '.dead'. With database
+# off, call records are only kept in memory and exported, not stored in the
+# records table.
+plugins['records'] = {
+    'write_behind': False,
+    'checkpoint': 60,
+    'close_batch': 500,
+    'rollups': False,
+    'rollup_bucket': 3600,
+    'rollup_flush': 60,
+    'database': True,
+    'export': None
+}
+
+## Queue Statistics Plugin Configuration
+# Live statistics of the queues listed, served at /stats on the metrics
+# endpoint. Averages, abandon rate and service level (share of calls answered
+# within service_level seconds) cover the last window seconds, kept in slots
+# of step seconds.
+plugins['stats'] = {
+    'queues': ['Dev'],
+    'window': 900,
+    'step': 10,
+    'service_level': 20
+}
 
 ## Callback Plugin Configration
+# Callbacks are sent as soon as an agent frees up for the caller next up in
+# queue. backoff is the delay (seconds) before retrying a caller, doubled on
+# each attempt up to backoff_max. The callback blacklist is cached in memory,
+# fetching new numbers every blacklist_refresh seconds and reloading it fully
+# every blacklist_resync seconds. Queue member statuses are written every
+# status_flush seconds, only the latest status of each member if it changed.
+# On each AMI connection the queue tables are resynchronized with asterisk.
+# The 'diff' resync only writes the rows that changed, resync_batch rows per
+# statement, while 'reload' empties and refills the tables in a transaction.
 plugins['queue'] = {
     'port': 24131,
-    'interval': 90,
+    'callback_enabled': False,
+    'backoff': 90,
+    'backoff_max': 900,
+    'blacklist_refresh': 60,
+    'blacklist_resync': 3600,
+    'status_flush': 0.5,
+    'resync': 'diff',
+    'resync_batch': 500,
     'queues': ['Dev'],
     'callback_limit': 3,
     'callback': {
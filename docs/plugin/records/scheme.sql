@@ -39,3 +39,22 @@ CREATE TABLE IF NOT EXISTS `records` (
     KEY `Agent ID` (`agent`)
     KEY `Support Ticket Number` (`ticket`)
 ) ENGINE=InnoDB  DEFAULT CHARSET=latin1;
+
+--
+-- Table structure for call record rollups, the totals of the calls ended
+-- in each bucket by caller_dnid, account_code or agent
+--
+
+CREATE TABLE IF NOT EXISTS `records_rollup` (
+    `bucket` datetime NOT NULL default '0000-00-00 00:00:00',
+    `dimension` varchar(16) NOT NULL default '',
+    `value` varchar(80) NOT NULL default '',
+    `calls` int(11) NOT NULL default '0',
+    `abandoned` int(11) NOT NULL default '0',
+    `held` int(11) NOT NULL default '0',
+    `hold_seconds` bigint(20) NOT NULL default '0',
+    `answered` int(11) NOT NULL default '0',
+    `talk_seconds` bigint(20) NOT NULL default '0',
+    PRIMARY KEY (`bucket`, `dimension`, `value`),
+    KEY `Dimension Value` (`dimension`, `value`, `bucket`)
+) ENGINE=InnoDB  DEFAULT CHARSET=latin1;
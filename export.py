@@ -0,0 +1,307 @@
+"""
+StarGate Call Record Export
+
+Copyright (C) 2010 Ovation Networks, Inc.
+This file is part of Stargate.
+
+Stargate is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Stargate is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import csv
+import gzip
+import json
+import time
+import shutil
+from cStringIO import StringIO
+
+from twisted.application import service
+from twisted.internet import defer, task, threads
+
+from stargate import getLogger
+
+logger = getLogger('RecordExport')
+
+## Columns exported, in csv column order
+FIELDS = ('uid', 'channel', 'caller_number', 'caller_name', 'caller_dnid',
+          'account_code', 'status', 'agent', 'call_start', 'call_end',
+          'hold_start', 'hold_end', 'talk_start', 'talk_end')
+
+
+def _encode(value):
+    """ Exports dates (and anything else json lacks) as strings """
+    return str(value)
+
+
+class ExportFile:
+    """
+    Append-only file of records, rotated once it reaches maxBytes or has
+    been open maxAge seconds. Rotated files are renamed with the time they
+    were opened and, with compress set, gzipped. Records which can't be
+    encoded are appended to the dead-letter file next to it instead, one
+    repr per line. Only ever used from one thread at a time.
+    """
+
+    def __init__(self, path, format='jsonl', maxBytes=64 * 1024 * 1024,
+                 maxAge=3600, compress=True):
+        self.path = path
+        self.format = format
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.compress = compress
+        self.file = None
+        self.opened = None
+
+    def due(self, now):
+        """ Whether the open file should be rotated """
+        return self.file is not None and (
+            self.file.tell() >= self.maxBytes or
+            now - self.opened >= self.maxAge)
+
+    def write(self, rows):
+        """
+        Appends the rows and syncs them to disk, rotating as needed, and
+        returns how many were dead-lettered. A write that fails is cut back
+        off the file, so the rows can be written again.
+        """
+        if self.due(time.time()):
+            self.rotate()
+        if not rows:
+            return 0
+        (data, rejected) = self._encode(rows)
+        if rejected:
+            self._deadLetter(rejected)
+        if not data:
+            return len(rejected)
+        if self.file is None:
+            self._open()
+        start = self.file.tell()
+        try:
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        except:
+            self._truncate(start)
+            raise
+        return len(rejected)
+
+    def rotate(self):
+        """
+        Moves the open file aside, the next write starting a new one. Should
+        the move fail, the next write carries on with the same file.
+        """
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        (base, ext) = os.path.splitext(self.path)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.opened))
+        rotated = "%s-%s%s" % (base, stamp, ext)
+        count = 0
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):
+            count += 1
+            rotated = "%s-%s.%d%s" % (base, stamp, count, ext)
+        os.rename(self.path, rotated)
+        if self.compress:
+            try:
+                self._compress(rotated)
+            except EnvironmentError as e:
+                # The rotated file is complete, just left uncompressed
+                logger.error("Failed to compress %s: %s", rotated, e)
+            else:
+                rotated += '.gz'
+        logger.info("Rotated record export to %s", rotated)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _compress(self, path):
+        source = open(path, 'rb')
+        try:
+            target = gzip.open(path + '.gz', 'wb')
+            try:
+                shutil.copyfileobj(source, target)
+            finally:
+                target.close()
+        except:
+            source.close()
+            if os.path.exists(path + '.gz'):
+                os.remove(path + '.gz')
+            raise
+        source.close()
+        os.remove(path)
+
+    def _deadLetter(self, rows):
+        logger.error("Dead-lettering %d records which failed to encode",
+                     len(rows))
+        try:
+            dead = open(self.path + '.dead', 'ab')
+            try:
+                dead.write("".join(["%r\n" % (row,) for row in rows]))
+            finally:
+                dead.close()
+        except EnvironmentError as e:
+            logger.error("Failed to dead-letter %d records: %s", len(rows),
+                         e)
+
+    def _truncate(self, size):
+        try:
+            self.file.truncate(size)
+            self.file.seek(size)
+        except EnvironmentError as e:
+            # Reopened, and the rows possibly written twice, by the retry
+            logger.error("Failed to truncate %s: %s", self.path, e)
+            try:
+                self.file.close()
+            except EnvironmentError:
+                pass
+            self.file = None
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        fresh = not os.path.exists(self.path) or not os.path.getsize(
+            self.path)
+        self.file = open(self.path, 'ab')
+        self.opened = time.time()
+        if fresh and self.format == 'csv':
+            self.file.write(self._encode([dict(zip(FIELDS, FIELDS))])[0])
+
+    def _encode(self, rows):
+        """
+        Encodes the rows one by one, returning the encoded ones and the rows
+        which failed to encode, such as those with non utf-8 byte strings.
+        """
+        (lines, rejected) = ([], [])
+        if self.format == 'csv':
+            out = StringIO()
+            writer = csv.writer(out)
+        for row in rows:
+            try:
+                if self.format == 'csv':
+                    writer.writerow([row.get(field, '') for field in FIELDS])
+                    lines.append(out.getvalue())
+                    out.seek(0)
+                    out.truncate()
+                else:
+                    lines.append(json.dumps(row, default=_encode,
+                                            sort_keys=True) + "\n")
+            except (TypeError, ValueError):
+                rejected.append(row)
+        return ("".join(lines), rejected)
+
+
+class RecordExport(service.Service):
+    """
+    Streams completed call records to an ExportFile. Records are buffered in
+    memory and written every interval seconds, or as soon as batch of them
+    are waiting, by a thread so encoding, writing and syncing never hold up
+    the reactor. One batch is written at a time, in order. A batch the
+    file system fails to write goes back to the head of the buffer and is
+    tried again on the next interval, while one failing for any other
+    reason is dropped. Past maxBuffered records the oldest are dropped.
+    """
+
+    def __init__(self, path, format='jsonl', maxBytes=64 * 1024 * 1024,
+                 maxAge=3600, compress=True, interval=1.0, batch=500,
+                 maxBuffered=100000):
+        self.file = ExportFile(path, format, maxBytes, maxAge, compress)
+        self.batch = batch
+        self.maxBuffered = maxBuffered
+        self.buffer = []
+        self.writing = None
+        self.failing = False
+        self.exported = 0
+        self.failed = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.loop = task.LoopingCall(self._flush)
+        self.interval = interval
+
+    def startService(self):
+        service.Service.startService(self)
+        self.loop.start(self.interval, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.loop.running:
+            self.loop.stop()
+        d = self._flush()
+        d.addCallback(lambda _: threads.deferToThread(self.file.close))
+        return d
+
+    def write(self, row):
+        """ Queues a record, given as a dict keyed by FIELDS, for export """
+        self.buffer.append(row)
+        self._bound()
+        if (len(self.buffer) >= self.batch and self.writing is None and
+                not self.failing):
+            self._flush()
+
+    def stats(self):
+        return {'buffered': len(self.buffer), 'exported': self.exported,
+                'failed': self.failed, 'dropped': self.dropped,
+                'rejected': self.rejected}
+
+    def _bound(self):
+        excess = len(self.buffer) - self.maxBuffered
+        if excess > 0:
+            del self.buffer[:excess]
+            self.dropped += excess
+            logger.error("Export buffer full, dropped the %d oldest records",
+                         excess)
+
+    def _flush(self):
+        """
+        Hands the buffered records to a thread, returning a deferred firing
+        once everything buffered so far is written.
+        """
+        if self.writing is not None:
+            d = defer.Deferred()
+            self.writing.addBoth(lambda _: self._flush().chainDeferred(d))
+            return d
+        if not self.buffer and not self.file.due(time.time()):
+            return defer.succeed(None)
+        (rows, self.buffer) = (self.buffer, [])
+        d = self.writing = threads.deferToThread(self.file.write, rows)
+        d.addCallbacks(self._written, self._failed, callbackArgs=(rows,),
+                       errbackArgs=(rows,))
+        return d
+
+    def _written(self, rejected, rows):
+        self.writing = None
+        self.failing = False
+        self.exported += len(rows) - rejected
+        self.rejected += rejected
+        if len(self.buffer) >= self.batch:
+            self._flush()
+
+    def _failed(self, failure, rows):
+        self.writing = None
+        self.failed += len(rows)
+        if not failure.check(EnvironmentError):
+            self.dropped += len(rows)
+            logger.error("Failed to export %d records, dropped: %s",
+                         len(rows), failure.getErrorMessage())
+            if len(self.buffer) >= self.batch:
+                self._flush()
+            return
+        self.failing = True
+        self.buffer[:0] = rows
+        self._bound()
+        logger.error("Failed to export %d records, retrying: %s", len(rows),
+                     failure.getErrorMessage())
@@ -0,0 +1,213 @@
+"""
+StarGate Metrics
+
+Copyright (C) 2010 Ovation Networks, Inc.
+This file is part of Stargate.
+
+Stargate is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Stargate is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+from bisect import bisect_left
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web import resource, server
+from twisted.application import internet
+
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5,
+           5.0, 10.0)
+
+
+class Counter(object):
+    """ Monotonically increasing counter """
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield (name, labels, self.value)
+
+
+class Gauge(object):
+    """ Value read from the given function each time metrics are scraped """
+    __slots__ = ('function',)
+
+    def __init__(self, function):
+        self.function = function
+
+    def samples(self, name, labels):
+        yield (name, labels, self.function())
+
+
+class Histogram(object):
+    """
+    Histogram with fixed buckets. The bucket counts are allocated once, so
+    observing a value allocates nothing.
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        total = 0
+        for (bound, count) in zip(self.buckets, self.counts):
+            total += count
+            yield (name + '_bucket', labels + (('le', repr(bound)),), total)
+        yield (name + '_bucket', labels + (('le', '+Inf'),), self.count)
+        yield (name + '_sum', labels, self.sum)
+        yield (name + '_count', labels, self.count)
+
+
+class Registry:
+    """
+    Collection of metrics rendered in the prometheus text format. Metrics
+    are created once per name and label set and the same object is returned
+    on later lookups, so hot paths should keep a reference to the metric
+    rather than looking it up for every event.
+    """
+
+    def __init__(self):
+        self.families = {}
+        self.order = []
+
+    def _metric(self, kind, name, help, labels, factory):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = (kind, help, {})
+            self.order.append(name)
+        key = tuple(sorted(labels.items()))
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = factory()
+        return metric
+
+    def counter(self, name, help, **labels):
+        return self._metric('counter', name, help, labels, Counter)
+
+    def histogram(self, name, help, buckets=BUCKETS, **labels):
+        return self._metric('histogram', name, help, labels,
+                            lambda: Histogram(buckets))
+
+    def gauge(self, name, help, function, **labels):
+        """ Registers a gauge whose value is read from function on scrape """
+        return self._metric('gauge', name, help, labels,
+                            lambda: Gauge(function))
+
+    def render(self):
+        lines = []
+        for name in self.order:
+            (kind, help, metrics) = self.families[name]
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for (labels, metric) in sorted(metrics.items()):
+                for (sample, labels, value) in metric.samples(name, labels):
+                    lines.append("%s%s %s" % (sample, _labels(labels),
+                                              _value(value)))
+        lines.append("")
+        return "\n".join(lines)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % (",".join(['%s="%s"' % (key, str(value).replace('\\',
+        '\\\\').replace('"', '\\"')) for (key, value) in labels]),)
+
+
+def _value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+## The registry shared by stargate and every chevron
+registry = Registry()
+
+
+def instrumentQueries(cls, chevron, registry=registry):
+    """
+    Wraps every public method of a chevron's RequestHandler class so the
+    latency and errors of each query are recorded, labelled by chevron and
+    method name.
+    """
+    for (name, method) in cls.__dict__.items():
+        if name.startswith('_') or not callable(method):
+            continue
+        setattr(cls, name, _timed(method, chevron, name, registry))
+    return cls
+
+
+def _timed(method, chevron, name, registry):
+    latency = registry.histogram('stargate_db_query_seconds',
+        'Database query latency by chevron and RequestHandler method',
+        chevron=chevron, query=name)
+    errors = registry.counter('stargate_db_query_errors_total',
+        'Failed database queries by chevron and RequestHandler method',
+        chevron=chevron, query=name)
+
+    def done(result, start):
+        latency.observe(time.time() - start)
+        if isinstance(result, Failure):
+            errors.inc()
+        return result
+
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        result = method(*args, **kwargs)
+        if isinstance(result, defer.Deferred):
+            result.addBoth(done, start)
+        return result
+
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class MetricsResource(resource.Resource):
+    """ Serves the registry in the prometheus text exposition format """
+    isLeaf = True
+
+    def __init__(self, registry=registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.render()
+
+
+def MetricsService(port, interface='127.0.0.1', registry=registry,
+                   root=None):
+    """
+    Returns a service serving the metrics over HTTP at /metrics, next to any
+    other resources put on root.
+    """
+    if root is None:
+        root = resource.Resource()
+    root.putChild('metrics', MetricsResource(registry))
+    return internet.TCPServer(port, server.Site(root), interface=interface)
@@ -0,0 +1,121 @@
+"""
+StarGate Call Record Rollups
+
+Copyright (C) 2010 Ovation Networks, Inc.
+This file is part of Stargate.
+
+Stargate is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Stargate is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+
+## Record columns the calls are rolled up by
+DIMENSIONS = ('caller_dnid', 'account_code', 'agent')
+
+## Adds a bucket's totals to those already stored
+UPSERT = """
+                INSERT INTO `records_rollup`
+                    (bucket, dimension, value, calls, abandoned, held,
+                     hold_seconds, answered, talk_seconds)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE
+                    calls = calls + VALUES(calls),
+                    abandoned = abandoned + VALUES(abandoned),
+                    held = held + VALUES(held),
+                    hold_seconds = hold_seconds + VALUES(hold_seconds),
+                    answered = answered + VALUES(answered),
+                    talk_seconds = talk_seconds + VALUES(talk_seconds)"""
+
+
+def bucketOf(when, size):
+    """
+    Start of the bucket of size seconds, counted from midnight, the given
+    datetime falls in.
+    """
+    midnight = when.replace(hour=0, minute=0, second=0, microsecond=0)
+    offset = (when - midnight).seconds
+    return midnight + datetime.timedelta(seconds=offset - offset % size)
+
+
+def seconds(start, end):
+    """ Whole seconds between two datetimes, None unless both are set """
+    if (not isinstance(start, datetime.datetime) or
+            not isinstance(end, datetime.datetime)):
+        return None
+    delta = end - start
+    return max(0, delta.days * 86400 + delta.seconds)
+
+
+class Rollups:
+    """
+    Totals of the closed calls per bucket, by call end, and dimension value:
+    calls, abandons, calls held and their seconds on hold, calls answered
+    and their seconds talking. Buckets are size seconds long and should
+    divide a day. Each call adds to one row per dimension, so the totals
+    grow with the distinct values seen in a bucket, not with the calls.
+    Calls can be rolled up by only some of the DIMENSIONS, still given
+    their values in the same order.
+    """
+
+    def __init__(self, size=3600, dimensions=DIMENSIONS):
+        self.size = size
+        self.dimensions = dimensions
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def add(self, callEnd, values, status, holdStart, holdEnd, talkStart,
+            talkEnd):
+        """ Adds a closed call, values given in DIMENSIONS order """
+        bucket = bucketOf(callEnd, self.size)
+        totals = self.buckets.get(bucket)
+        if totals is None:
+            totals = self.buckets[bucket] = {}
+        abandoned = status == 'ABANDONED' and 1 or 0
+        hold = seconds(holdStart, holdEnd)
+        talk = seconds(talkStart, talkEnd)
+        for (dimension, value) in zip(DIMENSIONS, values):
+            if dimension not in self.dimensions:
+                continue
+            key = (dimension, value is not None and str(value) or '')
+            row = totals.get(key)
+            if row is None:
+                row = totals[key] = [0, 0, 0, 0, 0, 0]
+            row[0] += 1
+            row[1] += abandoned
+            if hold is not None:
+                row[2] += 1
+                row[3] += hold
+            if talk is not None:
+                row[4] += 1
+                row[5] += talk
+
+    def due(self, now):
+        """ Takes the rows of the buckets which ended by now """
+        current = bucketOf(now, self.size)
+        return self._take([bucket for bucket in self.buckets
+                           if bucket < current])
+
+    def drain(self):
+        """ Takes the rows of every bucket, finished or not """
+        return self._take(self.buckets.keys())
+
+    def _take(self, buckets):
+        rows = []
+        for bucket in sorted(buckets):
+            for ((dimension, value), totals) in \
+                    self.buckets.pop(bucket).iteritems():
+                rows.append((bucket, dimension, value) + tuple(totals))
+        return rows
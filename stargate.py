@@ -18,7 +18,14 @@ You should have received a copy of the GNU General Public License
 along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import time
+import datetime
+import weakref
+from collections import deque
+from urlparse import urlparse, parse_qs
+
 from twisted.internet import defer
+from twisted.plugin import getPlugins
 from zope.interface import Interface
 from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.python import log
@@ -26,13 +33,110 @@ from twisted.python import log
 from starpy import manager
 
 
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+
+class Logger:
+    """
+    Leveled logger for a stargate component or chevron. Messages are given
+    as a format string and its arguments, and are only formatted once they
+    pass the level check, so disabled logging costs a single comparison.
+    """
+
+    def __init__(self, name, level=INFO, sample=1):
+        self.name = name
+        self.sample = sample
+        self.seen = 0
+        self.setLevel(level)
+
+    def setLevel(self, level):
+        self.level = LEVELS.get(level, level)
+        self.debugging = self.level <= DEBUG
+
+    def debug(self, message, *args):
+        if self.debugging:
+            self._emit(message, args)
+
+    def info(self, message, *args):
+        if self.level <= INFO:
+            self._emit(message, args)
+
+    def warning(self, message, *args):
+        if self.level <= WARNING:
+            self._emit(message, args)
+
+    def error(self, message, *args):
+        if self.level <= ERROR:
+            self._emit(message, args)
+
+    def event(self, event):
+        """
+        Logs an AMI event at debug level. Only one in every `sample` events
+        is logged, to keep high frequency events from flooding the log.
+        """
+        if self.debugging:
+            self.seen += 1
+            if self.seen >= self.sample:
+                self.seen = 0
+                self._emit("%s Event Triggered: %s",
+                           (event.get('event'), event))
+
+    def _emit(self, message, args):
+        if args:
+            message = message % args
+        log.msg(message, system=self.name)
+
+
+loggers = {}
+logSettings = {}
+
+
+def getLogger(name):
+    """ Returns the logger for the given component, creating it once """
+    logger = loggers.get(name)
+    if logger is None:
+        logger = loggers[name] = Logger(name)
+        _applySettings(logger)
+    return logger
+
+
+def configureLogging(settings, debug=False):
+    """
+    Applies logging settings to every logger, e.g.
+        {'level': 'info', 'levels': {'QueuePlugin': 'debug'},
+         'sample': {'CallRecordPlugin': 100}}
+    Setting debug forces every logger to debug level instead.
+    """
+    logSettings.clear()
+    logSettings.update(settings)
+    logSettings['force'] = debug
+    for logger in loggers.itervalues():
+        _applySettings(logger)
+
+
+def _applySettings(logger):
+    level = logSettings.get('levels', {}).get(logger.name,
+                                              logSettings.get('level', INFO))
+    if logSettings.get('force'):
+        level = DEBUG
+    logger.setLevel(level)
+    logger.sample = max(1, logSettings.get('sample', {}).get(logger.name, 1))
+
+
 class IChevron(Interface):
     """
     A stargate plugin.
     """
     def registerEvents():
         """
-        Registers all ami events that the stargate plugin will handle
+        Registers all ami events that the stargate plugin will handle. Called
+        once, on the first AMI connection; use onStatus to act on every
+        (re)connect.
         """
     def registerCommands():
         """
@@ -42,6 +146,49 @@ class IChevron(Interface):
         """
         Registers all services that the plugin may provide with the application
         """
+    def onStatus(snapshot):
+        """
+        Receives the StatusSnapshot of asterisk's channels and queues taken on
+        each (re)connect, to resynchronize the plugin's state
+        """
+
+
+class StatusSnapshot:
+    """
+    Status of asterisk's channels and queues, fetched once per connection
+    and shared by every chevron. Channels are indexed by uniqueid, queue
+    callers (in queue position order) and members by queue.
+    Taken is when the status was asked for, to the second, as calls started
+    from then on may be missing from it.
+    """
+
+    def __init__(self, channels, queues, taken=None):
+        if taken is None:
+            taken = datetime.datetime.now().replace(microsecond=0)
+        self.taken = taken
+        self.channels = {}
+        self.entries = {}
+        self.members = {}
+        self.params = {}
+
+        for event in channels:
+            if 'uniqueid' in event:
+                self.channels[event['uniqueid']] = event
+
+        for event in queues:
+            name = event.get('event')
+            if name == 'QueueEntry':
+                self.entries.setdefault(event['queue'], []).append(event)
+            elif name == 'QueueMember':
+                self.members.setdefault(event['queue'], []).append(event)
+            elif name == 'QueueParams':
+                self.params[event['queue']] = event
+
+    def __repr__(self):
+        return "<StatusSnapshot %d channels, %d callers, %d members>" % (
+            len(self.channels),
+            sum([len(e) for e in self.entries.itervalues()]),
+            sum([len(m) for m in self.members.itervalues()]))
 
 
 class StarGateFactory(ReconnectingClientFactory):
@@ -51,13 +198,17 @@ class StarGateFactory(ReconnectingClientFactory):
         self.username = username
         self.secret = password
         self.loginDefer = None
+        self.connects = 0
+        self.disconnects = 0
 
     def buildProtocol(self, addr):
         self.resetDelay()
+        self.connects += 1
         return ReconnectingClientFactory.buildProtocol(self, addr)
 
     def clientConnectionLost(self, connector, reason):
         log.err('Lost connection.  Reason:', reason)
+        self.disconnects += 1
         self.loginDefer = defer.Deferred()
         self.loginDefer.addCallback(self.loginCallback)
         ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
@@ -74,3 +225,274 @@ class StarGateFactory(ReconnectingClientFactory):
         self.loginCallback = function
         self.loginDefer = defer.Deferred()
         self.loginDefer.addCallback(self.loginCallback)
+
+
+class CommandRouter:
+    """
+    Routing table of fastAGI commands. Handlers are compiled into a tuple per
+    command as they are registered and each agi_network_script seen is parsed
+    only once, so dispatching a session is a couple of dictionary lookups.
+    Scripts for unknown commands are remembered as well and skipped.
+    """
+    cacheSize = 1024
+
+    def __init__(self):
+        self.handlers = {}
+        self.routes = {}
+        self.scripts = {}
+
+    def register(self, command, function):
+        self.handlers.setdefault(command, []).append(function)
+        self.routes[command] = tuple(self.handlers[command])
+        self.scripts.clear()
+
+    def resolve(self, script):
+        """
+        Returns a (command, handlers, params) tuple for the given
+        agi_network_script or None if no handlers are registered for it.
+        """
+        try:
+            return self.scripts[script]
+        except KeyError:
+            pass
+
+        r = urlparse(script)
+        handlers = self.routes.get(r.path)
+        route = None
+        if handlers is not None:
+            route = (r.path, handlers, parse_qs(r.query))
+
+        if len(self.scripts) >= self.cacheSize:
+            self.scripts.clear()
+        self.scripts[script] = route
+        return route
+
+
+class SessionLimiter:
+    """
+    Bounds the number of fastAGI sessions handled at once, both globally
+    and per command. Sessions over the limits wait in a bounded backlog and
+    are started as running sessions finish; once the backlog is full new
+    sessions are rejected straight away. A limit of 0 means unlimited.
+    """
+
+    def __init__(self, maxSessions=0, maxPerCommand=None, backlog=0):
+        self.maxSessions = maxSessions
+        self.maxPerCommand = maxPerCommand or {}
+        self.backlog = backlog
+        self.inflight = 0
+        self.commands = {}
+        self.waiting = deque()
+        self.accepted = 0
+        self.rejected = {}
+
+    def submit(self, command, run, reject):
+        """
+        Runs the session for command by calling run, which may return a
+        deferred firing once the session is done, or calls reject if the
+        session can neither be started nor queued.
+        """
+        if self._admissible(command):
+            self._start(command, run)
+        elif len(self.waiting) < self.backlog:
+            self.waiting.append((command, run))
+        else:
+            self.rejected[command] = self.rejected.get(command, 0) + 1
+            reject()
+
+    def _admissible(self, command):
+        if self.maxSessions and self.inflight >= self.maxSessions:
+            return False
+        limit = self.maxPerCommand.get(command, 0)
+        return not limit or self.commands.get(command, 0) < limit
+
+    def _start(self, command, run):
+        self.accepted += 1
+        self.inflight += 1
+        self.commands[command] = self.commands.get(command, 0) + 1
+        d = defer.maybeDeferred(run)
+        d.addBoth(self._release, command)
+
+    def _release(self, result, command):
+        self.inflight -= 1
+        self.commands[command] -= 1
+        for (i, (waiting, run)) in enumerate(self.waiting):
+            if self._admissible(waiting):
+                del self.waiting[i]
+                self._start(waiting, run)
+                break
+
+    def stats(self):
+        return {'inflight': self.inflight, 'waiting': len(self.waiting),
+                'accepted': self.accepted,
+                'rejected': sum(self.rejected.values()),
+                'commands': dict(self.commands),
+                'rejected_commands': dict(self.rejected)}
+
+
+class EventRoute:
+    """
+    Handlers registered for a single AMI event. Handlers whose predicate is
+    a single field tested against a fixed collection of values are indexed
+    by value so they are all matched with one lookup per field. Any other
+    predicate is tested against the event directly.
+    """
+    indexable = (set, frozenset, list, tuple)
+
+    def __init__(self):
+        self.always = []
+        self.static = {}
+        self.dynamic = []
+
+    def add(self, order, function, where=None):
+        if where is None:
+            self.always.append((order, function))
+            return
+        if isinstance(where, dict):
+            where = [where]
+
+        if len(where) == 1 and len(where[0]) == 1:
+            (key, values) = where[0].items()[0]
+            if isinstance(values, self.indexable):
+                index = self.static.setdefault(key, {})
+                for value in set(values):
+                    index.setdefault(value, []).append((order, function))
+                return
+        self.dynamic.append((order, function, where))
+
+    def match(self, event):
+        """ Returns the handlers interested in the event in order """
+        matched = list(self.always)
+        for (key, index) in self.static.iteritems():
+            matched.extend(index.get(event.get(key), ()))
+        for (order, function, clauses) in self.dynamic:
+            for clause in clauses:
+                for (key, values) in clause.iteritems():
+                    if event.get(key) not in values:
+                        break
+                else:
+                    matched.append((order, function))
+                    break
+
+        if len(matched) > 1:
+            matched.sort()
+        return [function for (order, function) in matched]
+
+
+class EventRouter:
+    """
+    Routing table of AMI events to the chevron handlers registered for them.
+    A handler may declare a predicate, given as a dict mapping event fields
+    to the values it is interested in (anything supporting `in`), or a list
+    of such dicts of which any may match. Predicates are evaluated once per
+    event before any handler runs.
+    """
+
+    def __init__(self):
+        self.events = {}
+        self.handlers = set()
+        self.bound = weakref.WeakKeyDictionary()
+        self.order = 0
+
+    def __contains__(self, event):
+        return event in self.events
+
+    def register(self, event, function, where=None):
+        """
+        Registers a handler for the event. Registering the same handler for
+        the same event again is ignored, returning False.
+        """
+        if (event, function) in self.handlers:
+            return False
+        self.handlers.add((event, function))
+
+        route = self.events.get(event)
+        if route is None:
+            route = self.events[event] = EventRoute()
+        self.order += 1
+        route.add(self.order, function, where)
+        return True
+
+    def bind(self, ami, dispatcher):
+        """
+        Attaches the dispatcher to the AMI protocol instance for every
+        registered event it is not attached for yet. Returns the names of the
+        newly attached events.
+        """
+        bound = self.bound.setdefault(ami, set())
+        events = [event for event in self.events if event not in bound]
+        for event in events:
+            ami.registerEvent(event, dispatcher)
+            bound.add(event)
+        return events
+
+    def match(self, event):
+        route = self.events.get(event.get('event'))
+        if route is None:
+            return ()
+        return route.match(event)
+
+    def clear(self):
+        self.events.clear()
+        self.handlers.clear()
+        self.bound.clear()
+
+
+class ChevronRegistry:
+    """
+    Discovers the installed chevrons once and locks them into stargate,
+    reporting how long discovery and each chevron's registration took.
+    """
+
+    def __init__(self, interface=IChevron, package=None):
+        self.interface = interface
+        self.package = package
+        self.chevrons = None
+        self.timings = {}
+        self.logger = getLogger('StarGate')
+
+    def __iter__(self):
+        return iter(self.discover())
+
+    def discover(self):
+        """ Returns the chevrons, scanning the plugin cache on first use """
+        if self.chevrons is None:
+            start = time.time()
+            self.chevrons = list(getPlugins(self.interface, self.package))
+            self.logger.info("Discovered %d chevrons in %.3fs",
+                             len(self.chevrons), time.time() - start)
+        return self.chevrons
+
+    def lock(self, method, *args):
+        """
+        Calls method on every chevron implementing it with the given
+        arguments. When a chevron returns a deferred its time is reported
+        once it fires.
+        """
+        for chevron in self.discover():
+            function = getattr(chevron, method, None)
+            if function is not None:
+                self.time(chevron.__class__.__name__, method, function, *args)
+
+    def time(self, name, method, function, *args):
+        """
+        Calls function, recording how long it took under name/method, until
+        the deferred it returns fires if any.
+        """
+        start = time.time()
+        try:
+            result = function(*args)
+        except:
+            self._done(None, name, method, start)
+            raise
+        if isinstance(result, defer.Deferred):
+            result.addBoth(self._done, name, method, start)
+        else:
+            self._done(None, name, method, start)
+        return result
+
+    def _done(self, result, name, method, start):
+        elapsed = time.time() - start
+        self.timings[(name, method)] = elapsed
+        self.logger.info("%s %s in %.3fs", name, method, elapsed)
+        return result
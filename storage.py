@@ -0,0 +1,884 @@
+"""
+StarGate Storage
+
+Copyright (C) 2010 Ovation Networks, Inc.
+This file is part of Stargate.
+
+Stargate is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Stargate is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import json
+import time
+from collections import deque
+
+from twisted.application import service
+from twisted.enterprise import adbapi
+from twisted.internet import defer, reactor, task
+from twisted.python.failure import Failure
+
+from stargate import getLogger
+
+logger = getLogger('WriteQueue')
+
+
+## Tags a byte string journaled as the latin-1 text of its bytes
+BYTES = '__bytes__'
+
+
+def _encode(value):
+    """ Journals dates (and anything else json lacks) as strings """
+    return str(value)
+
+
+def _pack(value):
+    """
+    Copy of a write's arguments json can always encode. Byte strings which
+    aren't ascii, such as latin-1 caller names, are kept as the latin-1 text
+    of their bytes, tagged so _unpack gets the same bytes back.
+    """
+    if isinstance(value, str):
+        try:
+            value.decode('ascii')
+        except UnicodeDecodeError:
+            return {BYTES: value.decode('latin-1')}
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_pack(item) for item in value]
+    return value
+
+
+def _unpack(value):
+    """ json object hook restoring the byte strings tagged by _pack """
+    if len(value) == 1 and BYTES in value:
+        return value[BYTES].encode('latin-1')
+    return value
+
+
+def _dumps(entry):
+    """ Encodes a write, (sql, args, many), as a line of json """
+    return json.dumps(_pack(list(entry)), default=_encode) + "\n"
+
+
+def _loads(line):
+    return json.loads(line, object_hook=_unpack)
+
+
+class Journal:
+    """
+    Append-only file of database writes, one json document per line. Writes
+    are read back in order from the replay offset, which is kept next to the
+    journal so a restart picks up where replay stopped. Only lines that have
+    been synced are ever read back.
+    """
+    commitEvery = 100
+
+    def __init__(self, path):
+        self.path = path
+        self.offsetPath = path + '.offset'
+        self.file = open(path, 'ab')
+        self.reader = open(path, 'rb')
+        self.unsynced = 0
+        self.uncommitted = 0
+        self.offset = 0
+        if os.path.exists(self.offsetPath):
+            self.offset = int(open(self.offsetPath).read() or 0)
+
+        # Count the writes left to replay, dropping a partly written line
+        # left behind by a crash
+        self.backlog = 0
+        self.synced = self.offset
+        self.reader.seek(self.offset)
+        for line in self.reader:
+            if not line.endswith("\n"):
+                break
+            self.backlog += 1
+            self.synced += len(line)
+        self.file.truncate(self.synced)
+
+    def __len__(self):
+        return self.backlog
+
+    def append(self, entry):
+        self.write(_dumps(entry))
+
+    def write(self, line):
+        """ Appends a write already encoded by _dumps """
+        self.file.write(line)
+        self.unsynced += 1
+
+    def sync(self):
+        """ Flushes the appended writes to disk, returning how many """
+        count = self.unsynced
+        if count:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.synced = self.file.tell()
+            self.backlog += count
+            self.unsynced = 0
+        return count
+
+    def read(self):
+        """ Returns the next synced write and the offset after it, or None """
+        if self.offset >= self.synced:
+            return None
+        self.reader.seek(self.offset)
+        line = self.reader.readline()
+        (sql, args, many) = _loads(line)
+        return ((sql, args, many), self.offset + len(line))
+
+    def advance(self, offset):
+        """ Marks the writes up to offset as replayed """
+        self.offset = offset
+        self.backlog -= 1
+        self.uncommitted += 1
+        if self.uncommitted >= self.commitEvery:
+            self.commit()
+
+    def commit(self):
+        out = open(self.offsetPath, 'w')
+        out.write(str(self.offset))
+        out.close()
+        self.uncommitted = 0
+
+    def empty(self):
+        return self.offset >= self.synced and not self.unsynced
+
+    def truncate(self):
+        """ Starts the journal over once everything has been replayed """
+        self.file.truncate(0)
+        self.file.seek(0)
+        self.synced = self.offset = self.backlog = 0
+        self.commit()
+
+    def close(self):
+        self.sync()
+        self.commit()
+        self.file.close()
+        self.reader.close()
+
+
+class ConnectionPool(adbapi.ConnectionPool):
+    """
+    adbapi.ConnectionPool keeping count of the queries run and the time they
+    took, waiting for a connection included, so it can be resized.
+    """
+
+    def __init__(self, *args, **kwargs):
+        adbapi.ConnectionPool.__init__(self, *args, **kwargs)
+        self.queries = 0
+        self.latency = 0.0
+
+    def runInteraction(self, *args, **kwargs):
+        d = adbapi.ConnectionPool.runInteraction(self, *args, **kwargs)
+        d.addBoth(self._timed, time.time())
+        return d
+
+    def _timed(self, result, start):
+        self.queries += 1
+        self.latency += time.time() - start
+        return result
+
+    def resize(self, size):
+        """ Sets the most threads, and so connections, the pool may use """
+        self.max = size
+        self.threadpool.adjustPoolsize(self.min, size)
+
+    def prune(self):
+        """
+        Closes the connections of the threads stopped by a resize. The
+        threadpool keeps every thread it ever started, so the ones which
+        have exited are dropped from it here too.
+        """
+        threads = [thread for thread in self.threadpool.threads
+                   if thread.is_alive()]
+        self.threadpool.threads[:] = threads
+        live = [thread.ident for thread in threads]
+        for (tid, conn) in self.connections.items():
+            if tid not in live:
+                del self.connections[tid]
+                self._close(conn)
+
+
+class PoolSizer(service.Service):
+    """
+    Resizes a ConnectionPool between its min and maxSize threads every
+    interval seconds. The pool grows by the number of queries left waiting
+    for a connection, unless their average latency is over latencyMax (more
+    connections would only load a struggling database further), and shrinks
+    by one thread at a time while nothing waits and some threads are idle.
+    """
+
+    def __init__(self, pool, name, maxSize, interval=10, latencyMax=0.5):
+        self.pool = pool
+        self.name = name
+        self.logger = getLogger(self.__class__.__name__)
+        self.maxSize = maxSize
+        self.latencyMax = latencyMax
+        self.queries = 0
+        self.latency = 0.0
+        self.loop = task.LoopingCall(self._resize)
+        self.interval = interval
+
+    def startService(self):
+        service.Service.startService(self)
+        self.loop.start(self.interval, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.loop.running:
+            self.loop.stop()
+
+    def _resize(self):
+        self.pool.prune()
+        threadpool = self.pool.threadpool
+        waiting = threadpool.q.qsize()
+        queries = self.pool.queries - self.queries
+        latency = queries and (self.pool.latency - self.latency) / queries
+        (self.queries, self.latency) = (self.pool.queries, self.pool.latency)
+
+        size = self.pool.max
+        if waiting and size < self.maxSize:
+            if latency > self.latencyMax:
+                self.logger.info("Not growing the %s pool past %d threads, "
+                                 "%.3fs average latency", self.name, size,
+                                 latency)
+                return
+            resized = min(size + waiting, self.maxSize)
+        elif (not waiting and size > self.pool.min and
+              len(threadpool.working) < size):
+            resized = size - 1
+        else:
+            return
+        self.logger.info("Resizing the %s pool from %d to %d threads, %d "
+                         "queries waiting, %.3fs average latency", self.name,
+                         size, resized, waiting, latency)
+        self.pool.resize(resized)
+
+
+def _fan(result, *targets):
+    """ Fires every target deferred with the result """
+    for d in targets:
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+
+def _gather(ds):
+    """
+    Fires once every deferred has succeeded, or with the first failure
+    """
+    if len(ds) == 1:
+        return ds[0]
+    d = defer.DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+    d.addCallbacks(lambda results: None,
+                   lambda failure: failure.value.subFailure)
+    return d
+
+
+def _executemany(txn, sql, rows):
+    txn.executemany(sql, rows)
+
+
+CRITICAL = 0
+NORMAL = 1
+BEST_EFFORT = 2
+
+## Marks a queued interaction, in place of the many flag of a write
+INTERACTION = 'interaction'
+
+## MySQL client errors for a connection that failed or was lost, rather than
+## a write the server refused: can't connect (2002, 2003), server gone away
+## (2006) and connection lost during a query (2013) or handshake (2055)
+CONNECTION_ERRORS = (2002, 2003, 2006, 2013, 2055)
+
+CLOSED = 'closed'
+HALF_OPEN = 'half-open'
+OPEN = 'open'
+
+## Breaker states as reported to metrics
+BREAKER = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(Exception):
+    """ Raised for reads while the database circuit breaker is open """
+
+
+class Shed(Exception):
+    """ Raised for best-effort writes dropped rather than written """
+
+
+class CircuitBreaker:
+    """
+    Stops sending work to a failing database. After threshold connection
+    errors in a row the breaker opens and the database is probed after retry
+    seconds, doubling up to retryMax for as long as the probes fail. A
+    successful probe closes the breaker and calls onClose.
+    """
+
+    def __init__(self, probe, onClose, threshold=3, retry=5, retryMax=300):
+        self.probe = probe
+        self.onClose = onClose
+        self.threshold = threshold
+        self.retry = retry
+        self.retryMax = retryMax
+        self.state = CLOSED
+        self.failures = 0
+        self.delay = retry
+        self.call = None
+
+    def allow(self):
+        return self.state == CLOSED
+
+    def success(self):
+        if self.state == CLOSED:
+            self.failures = 0
+
+    def failure(self, failure):
+        self.failures += 1
+        if self.state == CLOSED and self.failures >= self.threshold:
+            logger.error("Database failing, circuit open for %ss: %s",
+                         self.delay, failure.getErrorMessage())
+            self._open()
+
+    def stop(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def _open(self):
+        self.state = OPEN
+        self.call = reactor.callLater(self.delay, self._probe)
+
+    def _probe(self):
+        self.call = None
+        self.state = HALF_OPEN
+        d = self.probe()
+        d.addCallbacks(self._probed, self._probeFailed)
+
+    def _probed(self, result):
+        logger.info("Database answering, circuit closed")
+        self.state = CLOSED
+        self.failures = 0
+        self.delay = self.retry
+        self.onClose()
+
+    def _probeFailed(self, failure):
+        self.delay = min(self.delay * 2, self.retryMax)
+        logger.warning("Database probe failed, next in %ss: %s", self.delay,
+                       failure.getErrorMessage())
+        self._open()
+
+
+class WriteQueue(service.Service):
+    """
+    Bounded queue of database writes in front of an adbapi.ConnectionPool.
+    Writes (runOperation and runOperations) wait in memory, most urgent
+    priority first, with at most maxInflight of them handed to the pool at
+    once. Best-effort writes are shed once the queue is shedAt full or the
+    database is failing, failing with Shed. A best-effort write given a key
+    replaces the arguments of the waiting one with the same key, so writes
+    sharing a key must share their statement, and fires as that one does.
+    The rows of a best-effort runOperations may each be given a key,
+    replacing waiting rows one by one. Past maxPending
+    waiting writes, or while the database is failing, critical and normal
+    writes are appended to the journal instead. Once the circuit breaker
+    closes again the journal is replayed in order, at up to replayRate
+    writes per second, before writes go through memory again. Reads and
+    interactions go straight to the pool and fail fast while the breaker is
+    open.
+
+    Only lost connections are worth waiting out. A write the database
+    refuses is tried attempts times in all, then appended to the dead-letter
+    file next to the journal, so it can't hold up the writes behind it.
+
+    Writes given lanes (such as a call's uniqueid) are ordered: a write only
+    runs, or is journaled, once every earlier write sharing one of its lanes
+    has settled, while writes in different lanes run in parallel. A barrier
+    (runBarrier) waits for every write queued before it in any lane and
+    holds back every write given lanes queued after it until it is done.
+    Writes without lanes aren't ordered by barriers.
+    """
+
+    def __init__(self, dbpool, path, maxPending=5000, maxInflight=10,
+                 replayRate=200, fsyncInterval=0.2, retry=5, retryMax=300,
+                 threshold=3, shedAt=0.5, attempts=3):
+        self.dbpool = dbpool
+        self.path = path
+        self.maxPending = maxPending
+        self.maxInflight = maxInflight
+        self.replayRate = replayRate
+        self.fsyncInterval = fsyncInterval
+        self.shedLimit = int(maxPending * shedAt)
+        self.attempts = attempts
+        self.journal = None
+        self.deadLetters = None
+        self.replayAttempts = 0
+        self.pending = (deque(), deque(), deque())
+        self.keyed = {}
+        self.lanes = {}
+        self.barrier = None
+        self.held = []
+        self.waiting = 0
+        self.syncing = []
+        self.inflight = 0
+        self.spilling = False
+        self.replaying = False
+        self.stopped = None
+        self.written = 0
+        self.failed = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.shed = 0
+        self.coalesced = 0
+        self.dead = 0
+        dbapi = getattr(dbpool, 'dbapi', None)
+        self.connectionErrors = tuple([error for error in
+            (getattr(dbapi, 'OperationalError', None),
+             getattr(dbapi, 'InterfaceError', None)) if error is not None])
+        self.breaker = CircuitBreaker(self._probe, self._replay, threshold,
+                                      retry, retryMax)
+        self.syncer = task.LoopingCall(self._sync)
+
+    def startService(self):
+        service.Service.startService(self)
+        self.journal = Journal(self.path)
+        if len(self.journal):
+            logger.info("Replaying %d journaled writes", len(self.journal))
+            self.spilling = True
+        self.syncer.start(self.fsyncInterval, now=False)
+        self._replay()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        # Whatever is still queued in memory is kept for the next start, once
+        # the writes in flight have settled
+        d = self.stopped = defer.Deferred()
+        self._settled()
+        return d
+
+    def _close(self):
+        if self.syncer.running:
+            self.syncer.stop()
+        self.breaker.stop()
+        self._sync()
+        self.journal.close()
+        self.journal = None
+        if self.deadLetters is not None:
+            self.deadLetters.close()
+            self.deadLetters = None
+        (stopped, self.stopped) = (self.stopped, None)
+        stopped.callback(None)
+
+    def runQuery(self, *args, **kwargs):
+        return self._read(self.dbpool.runQuery, *args, **kwargs)
+
+    def runInteraction(self, *args, **kwargs):
+        return self._read(self.dbpool.runInteraction, *args, **kwargs)
+
+    def runOperation(self, sql, args=None, priority=NORMAL, key=None,
+                     lanes=()):
+        """
+        Queues a write, firing once it is written or journaled. Shed writes
+        fail with Shed.
+        """
+        keys = key is not None and (key,) or None
+        return self._submit((sql, args, False), priority, keys, lanes)
+
+    def runBarrier(self, interaction, *args, **kwargs):
+        """
+        Runs an interaction in between the writes queued before it and those
+        queued after it, for reads that must see the tables as the queued
+        writes leave them. Interactions can't be journaled, so like reads
+        they fail fast with CircuitOpen while the database is failing or the
+        journal is replaying.
+        """
+        entry = (interaction, (args, kwargs), INTERACTION)
+        if self.journal is None:
+            return self._run(entry)
+        if self.spilling or not self.breaker.allow():
+            return defer.fail(CircuitOpen("Database writes are journaled"))
+        d = defer.Deferred()
+        self._queue([entry, d, NORMAL, None, (), 0])
+        return d
+
+    def runOperations(self, sql, rows, priority=NORMAL, keys=None,
+                      lanes=()):
+        """
+        Queues a write executed once per row of arguments. Best-effort rows
+        may be given keys, one per row.
+        """
+        return self._submit((sql, list(rows), True), priority,
+                            keys is not None and tuple(keys) or None, lanes)
+
+    def stats(self):
+        return {'pending': self.waiting, 'inflight': self.inflight,
+                'journaled': self.journal and len(self.journal) or 0,
+                'breaker': BREAKER[self.breaker.state],
+                'written': self.written, 'failed': self.failed,
+                'spilled': self.spilled, 'replayed': self.replayed,
+                'shed': self.shed, 'coalesced': self.coalesced,
+                'lanes': len(self.lanes), 'dead': self.dead,
+                'held': len(self.held)}
+
+    def _transient(self, failure):
+        """ Whether a failure is down to the connection, not the write """
+        if failure.check(adbapi.ConnectionLost):
+            return True
+        if self.connectionErrors and failure.check(*self.connectionErrors):
+            args = failure.value.args
+            return bool(args) and args[0] in CONNECTION_ERRORS
+        return False
+
+    def _read(self, method, *args, **kwargs):
+        if not self.breaker.allow():
+            return defer.fail(CircuitOpen("Database circuit breaker open"))
+        d = method(*args, **kwargs)
+        d.addCallbacks(self._readDone, self._readFailed)
+        return d
+
+    def _readDone(self, result):
+        self.breaker.success()
+        return result
+
+    def _readFailed(self, failure):
+        if self._transient(failure):
+            self.breaker.failure(failure)
+        return failure
+
+    def _submit(self, entry, priority, keys, lanes):
+        d = defer.Deferred()
+        failing = self.spilling or not self.breaker.allow()
+        if self.journal is None:
+            # Not started yet, nothing to keep in order with
+            self._run(entry).chainDeferred(d)
+        elif priority == BEST_EFFORT:
+            merged = []
+            if keys is not None:
+                (entry, keys, merged) = self._coalesce(entry, keys)
+            if entry is None:
+                pass
+            elif failing or self.waiting >= self.shedLimit:
+                self.shed += 1
+                merged.append(defer.fail(Shed("Database writes are shed")))
+            else:
+                queued = defer.Deferred()
+                self._queue([entry, queued, priority, keys, tuple(lanes), 0])
+                merged.append(queued)
+            _gather(merged).chainDeferred(d)
+        else:
+            self._queue([entry, d, priority, None, tuple(lanes), 0])
+            if (failing and not self.inflight or
+                    self.waiting > self.maxPending):
+                self._spillPending()
+        return d
+
+    def _coalesce(self, entry, keys):
+        """
+        Hands the arguments of each keyed row to the waiting write with the
+        same key, returning the entry and keys of the rows left over, or
+        None once every row has been taken, and deferreds firing as the
+        writes that took rows do.
+        """
+        (sql, args, many) = entry
+        if not many:
+            args = [args]
+        (rows, left, taken) = ([], [], {})
+        for (row, key) in zip(args, keys):
+            found = self.keyed.get(key)
+            if found is None:
+                rows.append(row)
+                left.append(key)
+                continue
+            (item, index) = found
+            if index is None:
+                item[0] = (item[0][0], row, False)
+            else:
+                item[0][1][index] = row
+            taken[id(item)] = item
+            self.coalesced += 1
+        merged = [self._follow(item) for item in taken.itervalues()]
+        if not rows:
+            return (None, None, merged)
+        if not many:
+            return (entry, tuple(left), merged)
+        return ((sql, rows, True), tuple(left), merged)
+
+    def _follow(self, item):
+        """ Returns a deferred firing as the waiting write does """
+        (d, both) = (defer.Deferred(), defer.Deferred())
+        both.addBoth(_fan, item[1], d)
+        item[1] = both
+        return d
+
+    def _queue(self, item):
+        if self.barrier is not None and (item[4] or
+                                         item[0][2] == INTERACTION):
+            # Held back, in order, until the barrier is done
+            self.held.append(item)
+            self.waiting += 1
+            self._key(item)
+            return
+        if item[0][2] == INTERACTION:
+            # Behind everything queued so far
+            self.barrier = item
+            item[4] = tuple(self.lanes)
+        self._key(item)
+        self.waiting += 1
+        # Writes behind another in one of their lanes are held until it
+        # settles
+        held = False
+        for lane in item[4]:
+            queue = self.lanes.get(lane)
+            if queue is None:
+                queue = self.lanes[lane] = deque()
+            elif queue:
+                held = True
+            queue.append(item)
+        if not held:
+            self.pending[item[2]].append(item)
+            self._pump()
+
+    def _key(self, item):
+        if item[3] is not None:
+            many = item[0][2]
+            for (index, key) in enumerate(item[3]):
+                if not many:
+                    index = None
+                self.keyed[key] = (item, index)
+
+    def _release(self, item):
+        """ Lets the writes held behind a settled write, or barrier, go """
+        for lane in item[4]:
+            queue = self.lanes[lane]
+            queue.popleft()
+            if not queue:
+                del self.lanes[lane]
+                continue
+            head = queue[0]
+            for other in head[4]:
+                if self.lanes[other][0] is not head:
+                    break
+            else:
+                self.pending[head[2]].append(head)
+        if item is self.barrier:
+            self.barrier = None
+            (held, self.held) = (self.held, [])
+            for other in held:
+                self.waiting -= 1
+                self._queue(other)
+
+    def _next(self):
+        for pending in self.pending:
+            if pending:
+                item = pending.popleft()
+                if item[3] is not None:
+                    for key in item[3]:
+                        self.keyed.pop(key, None)
+                self.waiting -= 1
+                return item
+
+    def _run(self, entry):
+        (sql, args, many) = entry
+        if many == INTERACTION:
+            return self.dbpool.runInteraction(sql, *args[0], **args[1])
+        if many:
+            return self.dbpool.runInteraction(_executemany, sql, args)
+        return self.dbpool.runOperation(sql, args)
+
+    def _pump(self):
+        while (self.inflight < self.maxInflight and not self.spilling and
+               self.breaker.allow() and self.stopped is None):
+            item = self._next()
+            if item is None:
+                return
+            self._start(item)
+
+    def _start(self, item):
+        self.inflight += 1
+        r = self._run(item[0])
+        r.addCallbacks(self._written, self._failed,
+                       callbackArgs=(item,), errbackArgs=(item,))
+
+    def _written(self, result, item):
+        self.inflight -= 1
+        self.written += 1
+        self.breaker.success()
+        self._release(item)
+        item[1].callback(None)
+        self._settled()
+
+    def _failed(self, failure, item):
+        self.inflight -= 1
+        (entry, d, priority, key, lanes, attempts) = item
+        if entry[2] == INTERACTION:
+            if self._transient(failure):
+                self.breaker.failure(failure)
+            d.errback(failure)
+        elif not self._transient(failure):
+            item[5] = attempts = attempts + 1
+            if attempts < self.attempts and self.stopped is None:
+                # Refused writes such as deadlocks may go through next time
+                self._start(item)
+                return
+            self._deadLetter(entry, failure, attempts)
+            d.errback(failure)
+        elif priority == BEST_EFFORT:
+            self.breaker.failure(failure)
+            self.shed += 1
+            d.errback(Shed(failure.getErrorMessage()))
+        else:
+            # Kept for replay, ahead of the writes still waiting in memory
+            self.breaker.failure(failure)
+            self._spill(entry, d)
+        self._release(item)
+        self._settled()
+
+    def _settled(self):
+        """
+        Once spilling, the writes waiting in memory follow the ones in
+        flight into the journal as soon as those are settled.
+        """
+        if not self.inflight and (self.spilling or not self.breaker.allow()
+                                  or self.stopped is not None):
+            self._spillPending()
+        if self.stopped is not None:
+            if not self.inflight and not self.replaying:
+                self._close()
+            return
+        self._pump()
+        self._replay()
+
+    def _spillPending(self):
+        """
+        Journals the waiting writes, shedding the best-effort ones. Writes
+        held behind one in flight stay in memory until it settles.
+        """
+        while True:
+            item = self._next()
+            if item is None:
+                break
+            if item[0][2] == INTERACTION:
+                item[1].errback(CircuitOpen("Database writes are journaled"))
+            elif item[2] == BEST_EFFORT:
+                self.shed += 1
+                item[1].errback(Shed("Database writes are journaled"))
+            else:
+                self._spill(item[0], item[1])
+            self._release(item)
+
+    def _spill(self, entry, d):
+        try:
+            line = _dumps(entry)
+        except (TypeError, ValueError):
+            # Never journaled, so it can't hold up the replay
+            failure = Failure()
+            self._deadLetter(entry, failure, 0)
+            d.errback(failure)
+            return
+        if not self.spilling:
+            logger.warning("Journaling database writes, %d pending",
+                           self.waiting)
+            self.spilling = True
+        self.journal.write(line)
+        self.syncing.append(d)
+        self.spilled += 1
+
+    def _sync(self):
+        """ Syncs the journal, then fires the writes waiting on it """
+        if self.journal.sync():
+            (syncing, self.syncing) = (self.syncing, [])
+            for d in syncing:
+                d.callback(None)
+            self._replay()
+
+    def _probe(self):
+        return self.dbpool.runQuery("SELECT 1")
+
+    def _replay(self):
+        """
+        Starts replaying the journal once the writes queued in memory before
+        it are done.
+        """
+        if (self.spilling and self.breaker.allow() and not self.replaying
+                and not self.waiting and not self.inflight and self.running):
+            self.replaying = True
+            self._replayNext()
+
+    def _replayNext(self):
+        if self.stopped is not None:
+            self.replaying = False
+            self._settled()
+            return
+        if not self.breaker.allow():
+            self.replaying = False
+            return
+        entry = self.journal.read()
+        if entry is None:
+            self.replaying = False
+            if self.journal.empty():
+                logger.info("Journal replayed, %d writes", self.replayed)
+                self.journal.truncate()
+                self.spilling = False
+            return
+        (entry, offset) = entry
+        d = self._run(entry)
+        d.addCallbacks(self._replayed, self._replayFailed,
+                       callbackArgs=(offset,), errbackArgs=(entry, offset))
+
+    def _replayed(self, result, offset):
+        self.breaker.success()
+        self.replayAttempts = 0
+        self.journal.advance(offset)
+        self.replayed += 1
+        reactor.callLater(1.0 / self.replayRate, self._replayNext)
+
+    def _replayFailed(self, failure, entry, offset):
+        if self._transient(failure):
+            # Retried until the breaker opens, then once it closes again
+            self.breaker.failure(failure)
+            reactor.callLater(self.breaker.retry, self._replayNext)
+            return
+        self.replayAttempts += 1
+        if self.replayAttempts < self.attempts:
+            reactor.callLater(1.0 / self.replayRate, self._replayNext)
+            return
+        self._deadLetter(entry, failure, self.replayAttempts)
+        self._replayed(None, offset)
+
+    def _deadLetter(self, entry, failure, attempts):
+        """
+        Appends a write the database refused to the dead-letter file, one
+        json document per line as in the journal, with the error last.
+        """
+        (sql, args, many) = entry
+        logger.error("Dead-lettering write %s after %d attempts: %s",
+                     " ".join(str(sql).split()), attempts,
+                     failure.getErrorMessage())
+        self.failed += 1
+        self.dead += 1
+        try:
+            line = _dumps([sql, args, many, failure.getErrorMessage()])
+        except (TypeError, ValueError):
+            line = _dumps([repr(sql), repr(args), many,
+                          failure.getErrorMessage()])
+        try:
+            if self.deadLetters is None:
+                self.deadLetters = open(self.path + '.dead', 'ab')
+            self.deadLetters.write(line)
+            self.deadLetters.flush()
+        except EnvironmentError as e:
+            logger.error("Failed to dead-letter write: %s", e)
+
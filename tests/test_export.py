@@ -0,0 +1,72 @@
+"""
+Tests of the call record export file, written to a temporary directory:
+
+    % trial tests
+
+Copyright (C) 2010 Ovation Networks, Inc.
+This file is part of Stargate.
+
+Stargate is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Stargate is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+
+from export import ExportFile, RecordExport
+
+
+class ExportFileTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = self.mktemp()
+        os.mkdir(directory)
+        self.path = os.path.join(directory, 'records.jsonl')
+
+    def test_deadLetter(self):
+        """ A row json can't encode is dead-lettered, not the whole batch """
+        export = ExportFile(self.path, compress=False)
+        rows = [{'uid': '1.1', 'caller_name': 'Jos\xe9'}, {'uid': '1.2'}]
+        self.assertEqual(export.write(rows), 1)
+        export.close()
+        self.assertEqual(open(self.path).read(), '{"uid": "1.2"}\n')
+        self.assertEqual(open(self.path + '.dead').read(),
+                         "%r\n" % (rows[0],))
+
+    def test_csv(self):
+        export = ExportFile(self.path, format='csv', compress=False)
+        rows = [{'uid': '1.1', 'caller_name': u'Jos\xe9'}, {'uid': '1.2'}]
+        self.assertEqual(export.write(rows), 1)
+        export.close()
+        self.assertEqual(open(self.path).read().splitlines()[1:],
+                         ['1.2' + ',' * 13])
+
+
+class RecordExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.export = RecordExport(self.mktemp())
+
+    def test_retryIOError(self):
+        """ Batches the file system failed to write are tried again """
+        self.export._failed(Failure(IOError(28, 'No space left')), [{}])
+        self.assertEqual(len(self.export.buffer), 1)
+        self.assertTrue(self.export.failing)
+
+    def test_dropOtherErrors(self):
+        self.export._failed(Failure(RuntimeError('unexpected')), [{}])
+        self.assertEqual(self.export.buffer, [])
+        self.assertEqual(self.export.stats()['dropped'], 1)
+        self.assertFalse(self.export.failing)
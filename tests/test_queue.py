@@ -0,0 +1,154 @@
+"""
+Tests of the queue callback plugin's in memory structures, run from the
+top of the tree with a config.py in place:
+
+    % trial tests
+
+Copyright (C) 2010 Ovation Networks, Inc.
+This file is part of Stargate.
+
+Stargate is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Stargate is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from storage import Shed
+from twisted.plugins.queue import QueuePlugin, TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.fired = []
+
+    def wheel(self, expired):
+        wheel = TimerWheel(expired, resolution=1.0, slots=8)
+        wheel.loop.clock = self.clock
+        return wheel
+
+    def test_expires(self):
+        wheel = self.wheel(self.fired.append)
+        wheel.schedule('a', 3)
+        self.clock.pump([1, 1])
+        self.assertEqual(self.fired, [])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['a'])
+        self.assertFalse(wheel.loop.running)
+
+    def test_rounds(self):
+        """ Delays longer than the wheel wait out whole turns of it """
+        wheel = self.wheel(self.fired.append)
+        wheel.schedule('a', 20)
+        self.clock.pump([1] * 19)
+        self.assertEqual(self.fired, [])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_rearm(self):
+        """
+        Re-arming a timer from its own expiry keeps the one loop running at
+        the wheel's resolution.
+        """
+        def expired(key):
+            self.fired.append(self.clock.seconds())
+            wheel.schedule(key, 10)
+        wheel = self.wheel(expired)
+        wheel.schedule('a', 10)
+        self.clock.pump([1] * 60)
+        self.assertEqual(self.fired, [10, 20, 30, 40, 50, 60])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_cancel(self):
+        wheel = self.wheel(self.fired.append)
+        wheel.schedule('a', 3)
+        wheel.cancel('a')
+        self.clock.pump([1] * 5)
+        self.assertEqual(self.fired, [])
+        self.assertFalse(wheel.loop.running)
+
+
+class FakePool:
+    """ Pool whose writes wait to be settled by the test """
+
+    def __init__(self):
+        self.writes = []
+
+    def runOperations(self, sql, rows, **kwargs):
+        d = defer.Deferred()
+        self.writes.append((list(rows), d))
+        return d
+
+
+class FakeApplication:
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def getPool(self, name):
+        return self.pool
+
+
+class MemberFlushTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FakePool()
+        self.plugin = QueuePlugin()
+        self.plugin.application = FakeApplication(self.pool)
+
+    def status(self, status):
+        self.plugin._onAgentStatus(None, {
+            'queue': 'sales', 'location': 'SIP/100', 'membername': 'Ann',
+            'penalty': '0', 'callstaken': '1', 'lastcall': '0',
+            'status': status, 'paused': '1'})
+
+    def flushed(self):
+        """ The statuses written by the flushes so far """
+        return [[row[3] for row in rows] for (rows, d) in self.pool.writes]
+
+    def test_written(self):
+        """ A status is only flushed again once it changes """
+        self.status('2')
+        self.plugin._flushMembers()
+        self.pool.writes[0][1].callback(None)
+        self.status('2')
+        self.plugin._flushMembers()
+        self.assertEqual(self.flushed(), [['2']])
+
+    def test_revertedInFlight(self):
+        """
+        A status changed back while the change is being flushed is flushed
+        again after it.
+        """
+        self.status('2')
+        self.plugin._flushMembers()
+        self.pool.writes[0][1].callback(None)
+        self.status('3')
+        self.plugin._flushMembers()
+        self.status('2')
+        self.plugin._flushMembers()
+        self.assertEqual(self.flushed(), [['2'], ['3'], ['2']])
+
+    def test_shed(self):
+        """ A shed status is flushed again unless superseded """
+        self.status('2')
+        self.plugin._flushMembers()
+        self.pool.writes[0][1].errback(Shed("Database writes are shed"))
+        self.plugin._flushMembers()
+        self.assertEqual(self.flushed(), [['2'], ['2']])
+        self.status('3')
+        self.pool.writes[1][1].errback(Shed("Database writes are shed"))
+        self.plugin._flushMembers()
+        self.assertEqual(self.flushed(), [['2'], ['2'], ['3']])
@@ -0,0 +1,90 @@
+"""
+Tests of the call records plugin's resync against the status snapshot, run
+from the top of the tree with a config.py in place:
+
+    % trial tests
+
+Copyright (C) 2010 Ovation Networks, Inc.
+This file is part of Stargate.
+
+Stargate is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Stargate is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from stargate import StatusSnapshot
+from twisted.plugins.records import CallRecord, CallRecordPlugin
+
+
+TAKEN = datetime.datetime(2010, 1, 1, 12, 0, 0)
+
+
+class FakePool:
+    """ Pool recording the uids closed through it """
+
+    def __init__(self):
+        self.closed = []
+
+    def runOperation(self, sql, args=None, **kwargs):
+        self.closed.append(args[-1])
+        return defer.succeed(None)
+
+
+class FakeApplication:
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def getPool(self, name):
+        return self.pool
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FakePool()
+        self.plugin = CallRecordPlugin()
+        self.plugin.application = FakeApplication(self.pool)
+        self.plugin.writeBehind = False
+        self.plugin.rollups = None
+        self.plugin.export = None
+
+    def call(self, uid, started):
+        self.plugin.active.add(CallRecord(uid, 'SIP/%s' % (uid,), 'QUEUED',
+                                          callStart=started))
+
+    def test_hungUp(self):
+        """ Calls whose channel is gone from the snapshot are closed """
+        self.call('1.1', TAKEN - datetime.timedelta(seconds=1))
+        self.call('1.2', TAKEN)
+        snapshot = StatusSnapshot([{'uniqueid': '1.2', 'channel': 'SIP/1'}],
+                                  [], TAKEN)
+        self.assertEqual(self.plugin._resumeRecords(snapshot), 1)
+        self.assertEqual(self.pool.closed, ['1.1'])
+        self.assertEqual(self.plugin.active.get('1.2').channel, 'SIP/1')
+
+    def test_startedSince(self):
+        """
+        Calls started once the snapshot was taken are missing from it, and
+        left open.
+        """
+        self.call('1.1', TAKEN)
+        self.call('1.2', TAKEN + datetime.timedelta(seconds=1))
+        snapshot = StatusSnapshot([], [], TAKEN)
+        self.plugin._initRecords(([], snapshot))
+        self.assertEqual(self.pool.closed, [])
+        self.assertEqual(len(self.plugin.active), 2)
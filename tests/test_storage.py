@@ -0,0 +1,433 @@
+"""
+Tests of the database write queue and its journal, run against a fake
+connection pool whose writes are settled by hand.
+
+Copyright (C) 2010 Ovation Networks, Inc.
+This file is part of Stargate.
+
+Stargate is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Stargate is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+import storage
+
+
+class OperationalError(Exception):
+    pass
+
+
+class FakeDBAPI:
+    OperationalError = OperationalError
+    InterfaceError = None
+
+
+GONE = OperationalError(2006, 'MySQL server has gone away')
+REFUSED = OperationalError(1054, "Unknown column 'x' in 'field list'")
+
+
+class FakePool:
+    """ Connection pool whose queries wait to be settled by the test """
+    dbapi = FakeDBAPI
+
+    def __init__(self):
+        self.calls = []
+
+    def _call(self, sql, args):
+        d = defer.Deferred()
+        self.calls.append((sql, args, d))
+        return d
+
+    def runOperation(self, sql, args=None):
+        return self._call(sql, args)
+
+    def runQuery(self, sql, args=None):
+        return self._call(sql, args)
+
+    def runInteraction(self, interaction, *args, **kwargs):
+        if interaction is storage._executemany:
+            return self._call(*args)
+        return self._call('interaction', interaction)
+
+    def running(self):
+        """ Statements run and not settled yet, in order """
+        return [sql for (sql, args, d) in self.calls if not d.called]
+
+    def started(self):
+        return [sql for (sql, args, d) in self.calls]
+
+    def _find(self, sql):
+        for (name, args, d) in self.calls:
+            if name == sql and not d.called:
+                return (args, d)
+        raise KeyError(sql)
+
+    def succeed(self, sql, result=None):
+        (args, d) = self._find(sql)
+        d.callback(result)
+        return args
+
+    def fail(self, sql, error):
+        (args, d) = self._find(sql)
+        d.errback(error)
+        return args
+
+
+class WriteQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(storage, 'reactor', self.clock)
+        self.pool = FakePool()
+        self.path = self.mktemp()
+        self.queue = self.writeQueue()
+
+    def writeQueue(self, **kwargs):
+        kwargs.setdefault('threshold', 1)
+        kwargs.setdefault('retry', 5)
+        queue = storage.WriteQueue(self.pool, self.path, **kwargs)
+        queue.syncer.clock = self.clock
+        queue.startService()
+        self.addCleanup(self.stop, queue)
+        return queue
+
+    def stop(self, queue):
+        if not queue.running:
+            return
+        d = queue.stopService()
+        for (sql, args, call) in self.pool.calls:
+            if not call.called:
+                call.errback(GONE)
+        self.clock.pump([1] * 10)
+        self.assertTrue(d.called)
+
+    def results(self, d):
+        """ Collects what a deferred fires with, failures included """
+        fired = []
+        d.addBoth(fired.append)
+        return fired
+
+    def recover(self):
+        """ Lets the breaker probe the database and find it answering """
+        self.clock.advance(self.queue.breaker.delay)
+        self.pool.succeed("SELECT 1")
+
+
+class JournalTest(WriteQueueTestCase):
+
+    def test_bytes(self):
+        """ Byte strings which aren't utf-8 are journaled and read back """
+        journal = storage.Journal(self.path)
+        entry = ("INSERT", ['1.1', 'Jos\xe9', u'Jos\xe9', 3], False)
+        journal.append(entry)
+        journal.sync()
+        ((sql, args, many), offset) = journal.read()
+        self.assertEqual((sql, args, many), ("INSERT", list(entry[1]), False))
+        self.assertEqual(type(args[1]), str)
+        journal.close()
+
+    def test_spillBytes(self):
+        """ A latin-1 write spilled on an outage is replayed unchanged """
+        fired = self.results(self.queue.runOperation("UPDATE", ('Jos\xe9',),
+                                                     lanes=('1.1',)))
+        self.pool.fail("UPDATE", GONE)
+        self.clock.advance(1)
+        self.assertEqual(fired, [None])
+        self.assertEqual(self.queue.waiting, 0)
+        self.assertEqual(self.queue.lanes, {})
+
+        self.recover()
+        self.assertEqual(self.pool.succeed("UPDATE"), ['Jos\xe9'])
+        self.clock.advance(1)
+        self.assertFalse(self.queue.spilling)
+
+    def test_spillUnencodable(self):
+        """
+        A write the journal can't encode is dead-lettered and still lets the
+        writes behind it go.
+        """
+        class Unprintable(object):
+            def __str__(self):
+                raise ValueError("unprintable")
+        first = self.results(self.queue.runOperation(
+            "UPDATE", (Unprintable(),), lanes=('1.1',)))
+        second = self.results(self.queue.runOperation(
+            "CLOSE", ('1.1',), lanes=('1.1',)))
+        self.pool.fail("UPDATE", GONE)
+        self.assertTrue(first[0].check(ValueError))
+        self.assertEqual(self.queue.stats()['dead'], 1)
+        self.assertTrue(os.path.exists(self.path + '.dead'))
+
+        self.clock.advance(1)
+        self.assertEqual(second, [None])
+        self.assertEqual(self.queue.waiting, 0)
+        self.assertEqual(self.queue.lanes, {})
+        self.recover()
+        self.pool.succeed("CLOSE")
+        self.clock.advance(1)
+        self.assertFalse(self.queue.spilling)
+
+
+class ShedTest(WriteQueueTestCase):
+
+    def test_shedFails(self):
+        """ A best-effort write shed while the database fails isn't written """
+        self.queue.runOperation("UPDATE", ('1',))
+        self.pool.fail("UPDATE", GONE)
+        fired = self.results(self.queue.runOperation(
+            "STATUS", ('1',), priority=storage.BEST_EFFORT))
+        self.assertTrue(fired[0].check(storage.Shed))
+        self.assertEqual(self.queue.stats()['shed'], 1)
+
+    def test_coalescedFollows(self):
+        """ A coalesced write fires as the write it was merged into does """
+        queue = self.queue
+        queue.maxInflight = 1
+        queue.runOperation("UPDATE", ('1',))
+        first = self.results(queue.runOperations(
+            "STATUS", [('a',)], priority=storage.BEST_EFFORT, keys=['a']))
+        second = self.results(queue.runOperations(
+            "STATUS", [('b',)], priority=storage.BEST_EFFORT, keys=['a']))
+        self.assertEqual((first, second), ([], []))
+
+        self.pool.succeed("UPDATE")
+        self.assertEqual(self.pool.fail("STATUS", GONE), [('b',)])
+        self.assertTrue(first[0].check(storage.Shed))
+        self.assertTrue(second[0].check(storage.Shed))
+
+
+class LaneTest(WriteQueueTestCase):
+
+    def test_ordered(self):
+        """ Writes sharing a lane run one after the other, in order """
+        for (sql, lane) in (("FIRST", 'a'), ("SECOND", 'a'), ("OTHER", 'b')):
+            self.queue.runOperation(sql, lanes=(lane,))
+        self.assertEqual(self.pool.running(), ["FIRST", "OTHER"])
+        self.pool.succeed("FIRST")
+        self.assertEqual(self.pool.running(), ["OTHER", "SECOND"])
+
+    def test_manyLanes(self):
+        """ A write in two lanes waits for the earlier writes of both """
+        self.queue.runOperation("A", lanes=('a',))
+        self.queue.runOperation("B", lanes=('b',))
+        self.queue.runOperation("BOTH", lanes=('a', 'b'))
+        self.pool.succeed("A")
+        self.assertEqual(self.pool.running(), ["B"])
+        self.pool.succeed("B")
+        self.assertEqual(self.pool.running(), ["BOTH"])
+        self.pool.succeed("BOTH")
+        self.assertEqual(self.queue.lanes, {})
+
+    def test_priority(self):
+        """ Waiting writes are handed to the pool most urgent first """
+        self.queue.maxInflight = 1
+        self.queue.runOperation("FIRST")
+        self.queue.runOperation("NORMAL")
+        self.queue.runOperation("CRITICAL", priority=storage.CRITICAL)
+        self.pool.succeed("FIRST")
+        self.assertEqual(self.pool.running(), ["CRITICAL"])
+
+
+class ShedAtTest(WriteQueueTestCase):
+
+    def test_shedAt(self):
+        """ Best-effort writes are shed once the queue is shedAt full """
+        self.queue = self.writeQueue(maxInflight=1, maxPending=4, shedAt=0.5)
+        for sql in ("RUNNING", "FIRST", "SECOND"):
+            self.queue.runOperation(sql)
+        fired = self.results(self.queue.runOperation(
+            "STATUS", priority=storage.BEST_EFFORT))
+        self.assertTrue(fired[0].check(storage.Shed))
+        self.pool.succeed("RUNNING")
+        fired = self.results(self.queue.runOperation(
+            "STATUS", priority=storage.BEST_EFFORT))
+        self.assertEqual(fired, [])
+
+    def test_spilled(self):
+        """ Waiting best-effort writes are shed when the rest is journaled """
+        self.queue.maxInflight = 1
+        self.queue.runOperation("RUNNING")
+        fired = self.results(self.queue.runOperation(
+            "STATUS", priority=storage.BEST_EFFORT))
+        self.pool.fail("RUNNING", GONE)
+        self.assertTrue(fired[0].check(storage.Shed))
+        self.assertEqual(self.pool.running(), [])
+
+
+class BreakerTest(WriteQueueTestCase):
+
+    def test_open(self):
+        """ Lost connections open the breaker, failing reads fast """
+        self.queue.runOperation("UPDATE")
+        self.pool.fail("UPDATE", GONE)
+        self.assertEqual(self.queue.stats()['breaker'], 2)
+        fired = self.results(self.queue.runQuery("SELECT"))
+        self.assertTrue(fired[0].check(storage.CircuitOpen))
+        self.assertEqual(self.pool.running(), [])
+
+    def test_halfOpen(self):
+        """
+        The open breaker probes the database, backing off while the probe
+        fails, and closes once it answers.
+        """
+        self.queue.runOperation("UPDATE")
+        self.pool.fail("UPDATE", GONE)
+        self.clock.advance(5)
+        self.assertEqual(self.queue.stats()['breaker'], 1)
+        self.assertEqual(self.pool.running(), ["SELECT 1"])
+        self.pool.fail("SELECT 1", GONE)
+        self.assertEqual(self.queue.stats()['breaker'], 2)
+
+        self.clock.advance(5)
+        self.assertEqual(self.pool.running(), [])
+        self.clock.advance(5)
+        self.pool.succeed("SELECT 1")
+        self.assertEqual(self.queue.stats()['breaker'], 0)
+        self.assertEqual(self.queue.breaker.delay, 5)
+
+    def test_refused(self):
+        """ Writes the database refuses don't count against it """
+        self.queue.runOperation("UPDATE")
+        self.pool.fail("UPDATE", REFUSED)
+        self.assertEqual(self.queue.stats()['breaker'], 0)
+
+
+class ReplayTest(WriteQueueTestCase):
+
+    def test_replay(self):
+        """
+        Writes are journaled while the database is down and replayed in
+        order once it answers, new writes included, before writes go through
+        memory again.
+        """
+        first = self.results(self.queue.runOperation("FIRST"))
+        self.pool.fail("FIRST", GONE)
+        second = self.results(self.queue.runOperation("SECOND"))
+        self.clock.advance(1)
+        self.assertEqual((first, second), ([None], [None]))
+        self.assertEqual(self.queue.stats()['journaled'], 2)
+
+        self.recover()
+        self.pool.succeed("FIRST")
+        # Journaled behind the writes being replayed
+        self.queue.runOperation("THIRD")
+        self.clock.advance(1)
+        self.assertEqual(self.pool.running(), ["SECOND"])
+        self.pool.succeed("SECOND")
+        self.clock.advance(1)
+        self.pool.succeed("THIRD")
+        self.clock.advance(1)
+        self.assertFalse(self.queue.spilling)
+        self.assertEqual(self.queue.stats()['replayed'], 3)
+
+        self.queue.runOperation("FOURTH")
+        self.assertEqual(self.pool.running(), ["FOURTH"])
+        self.assertEqual(self.queue.stats()['journaled'], 0)
+
+    def test_restart(self):
+        """ Journaled writes are replayed by the next queue started """
+        self.queue.runOperation("UPDATE", ('1.1',))
+        self.pool.fail("UPDATE", GONE)
+        self.clock.advance(1)
+        self.stop(self.queue)
+
+        self.queue = self.writeQueue()
+        self.assertEqual(self.pool.running(), ["UPDATE"])
+        self.assertEqual(self.pool.succeed("UPDATE"), ['1.1'])
+        self.clock.advance(1)
+        self.assertFalse(self.queue.spilling)
+
+
+class DeadLetterTest(WriteQueueTestCase):
+
+    def test_refused(self):
+        """
+        A write refused attempts times is dead-lettered, letting the writes
+        behind it go.
+        """
+        fired = self.results(self.queue.runOperation("BAD", ('1.1',),
+                                                     lanes=('1.1',)))
+        self.queue.runOperation("NEXT", lanes=('1.1',))
+        for attempt in range(3):
+            self.assertEqual(self.pool.running(), ["BAD"])
+            self.pool.fail("BAD", REFUSED)
+        self.assertTrue(fired[0].check(OperationalError))
+        self.assertEqual(self.pool.running(), ["NEXT"])
+        self.assertEqual(self.queue.stats()['dead'], 1)
+        self.queue.deadLetters.flush()
+        (line,) = open(self.path + '.dead').readlines()
+        self.assertEqual(storage._loads(line)[:3], ["BAD", ['1.1'], False])
+
+    def test_replayRefused(self):
+        """ A journaled write refused on replay doesn't hold up the rest """
+        self.queue.runOperation("BAD")
+        self.pool.fail("BAD", GONE)
+        self.queue.runOperation("NEXT")
+        self.clock.advance(1)
+
+        self.recover()
+        for attempt in range(3):
+            self.pool.fail("BAD", REFUSED)
+            self.clock.advance(1)
+        self.assertEqual(self.pool.running(), ["NEXT"])
+        self.assertEqual(self.queue.stats()['dead'], 1)
+
+
+class BarrierTest(WriteQueueTestCase):
+
+    def barrier(self):
+        return self.results(self.queue.runBarrier(lambda txn: None))
+
+    def test_waits(self):
+        """ A barrier waits for the writes queued before it in any lane """
+        self.queue.runOperation("A", lanes=('a',))
+        self.queue.runOperation("B", lanes=('b',))
+        fired = self.barrier()
+        self.pool.succeed("A")
+        self.assertEqual(self.pool.running(), ["B"])
+        self.pool.succeed("B")
+        self.assertEqual(self.pool.running(), ["interaction"])
+        self.pool.succeed("interaction")
+        self.assertEqual(fired, [None])
+
+    def test_holds(self):
+        """ Writes queued after a barrier wait for it, in order """
+        self.queue.runOperation("A", lanes=('a',))
+        self.barrier()
+        self.queue.runOperation("B", lanes=('b',))
+        self.queue.runOperation("A2", lanes=('a',))
+        self.assertEqual(self.queue.stats()['held'], 2)
+        self.pool.succeed("A")
+        self.assertEqual(self.pool.running(), ["interaction"])
+        self.pool.succeed("interaction")
+        self.assertEqual(self.pool.running(), ["B", "A2"])
+        self.assertEqual(self.queue.stats()['held'], 0)
+
+    def test_unordered(self):
+        """ Writes without lanes, such as rollups, ignore barriers """
+        self.queue.runOperation("A", lanes=('a',))
+        self.barrier()
+        self.queue.runOperations("ROLLUP", [(1,)])
+        self.assertEqual(self.pool.running(), ["A", "ROLLUP"])
+        self.pool.succeed("ROLLUP")
+        self.assertEqual(self.pool.running(), ["A"])
+
+    def test_journaling(self):
+        """ Barriers fail fast while writes are journaled """
+        self.queue.runOperation("A")
+        self.pool.fail("A", GONE)
+        self.assertTrue(self.barrier()[0].check(storage.CircuitOpen))
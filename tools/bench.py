@@ -0,0 +1,414 @@
+#!/usr/bin/env python2.6
+"""
+Micro-benchmarks of stargate's per-event code paths.
+
+Each benchmark drives a chevron handler (or the fastAGI dispatcher) with
+prebuilt events against fakedb.ConnectionPool, which records queries
+instead of running them, and reports operations per second along with the
+net number of gc tracked objects left allocated per operation. Results
+are compared to the stored baseline and any benchmark slower (or holding
+on to more objects) than the baseline allows is reported as a regression.
+Baselines depend on the machine, so none is shipped: run with --save once
+on the machine the comparisons will be made on. Without a baseline the
+benchmarks refuse to run.
+
+    % python tools/bench.py                 # compare to the baseline
+    % python tools/bench.py --save          # store a new baseline
+    % python tools/bench.py -k initRecords  # only matching benchmarks
+
+Copyright (C) 2010 Ovation Networks, Inc.
+This file is part of Stargate.
+
+Stargate is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Stargate is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import gc
+import time
+import json
+import shutil
+import tempfile
+from optparse import OptionParser
+
+from twisted.internet import defer
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TOOLS)
+BASELINE = os.path.join(TOOLS, 'bench_baseline.json')
+
+CONFIG = """from default_config import *
+
+db = dict(db, type='fakedb')
+metrics = dict(metrics, port=0)
+logging = dict(logging, level='warning')
+plugins = dict(plugins)
+plugins['queue'] = dict(plugins['queue'], queues=['Bench'],
+                        callback_enabled=False)
+"""
+
+QUEUE = 'Bench'
+
+
+def setupPath():
+    """
+    Puts a generated config module, the tools and the source tree on the
+    python path, before twisted is imported so the chevrons are found.
+    """
+    workdir = tempfile.mkdtemp(prefix='stargate-bench-')
+    config = open(os.path.join(workdir, 'config.py'), 'w')
+    config.write(CONFIG)
+    config.close()
+    sys.path[0:0] = [workdir, TOOLS, ROOT]
+    return workdir
+
+
+class FakeApplication:
+    """ The parts of the StarGate application the chevrons use """
+
+    def __init__(self, dbpool):
+        self.dbpool = dbpool
+        self.ami = None
+        self.service = None
+
+    def getPool(self, name):
+        return self.dbpool
+
+    def registerCommands(self, commands, function):
+        pass
+
+    def registerEvent(self, events, function, where=None):
+        pass
+
+
+class FakeAGI:
+    """ fastAGI session answering every command straight away """
+
+    def __init__(self, variables):
+        self.variables = variables
+
+    def _done(self, *args, **kwargs):
+        return defer.succeed(0)
+
+    wait = finish = setPriority = setVariable = streamFile = _done
+    getVariable = _done
+
+
+def uid(i):
+    return '1300000000.%d' % (i,)
+
+
+def channel(i):
+    return 'SIP/trunk-%08x' % (i,)
+
+
+def agent(i):
+    return 'SIP/%d' % (1000 + i % 50,)
+
+
+def agiVariables(i, script):
+    return {'agi_network': 'yes', 'agi_network_script': script,
+            'agi_uniqueid': uid(i), 'agi_channel': channel(i),
+            'agi_callerid': '1555%07d' % (i,), 'agi_calleridname': 'Bench',
+            'agi_dnid': '8005550100', 'agi_accountcode': ''}
+
+
+def joinEvent(i):
+    return {'event': 'Join', 'channel': channel(i), 'uniqueid': uid(i),
+            'calleridnum': '1555%07d' % (i,), 'calleridname': 'Bench',
+            'queue': QUEUE, 'position': '1', 'count': '1'}
+
+
+def bridgeEvent(i):
+    return {'event': 'Bridge', 'bridgestate': 'Link', 'bridgetype': 'core',
+            'channel1': channel(i), 'channel2': agent(i) + '-1',
+            'uniqueid1': uid(i), 'uniqueid2': uid(i) + '1',
+            'callerid1': '1555%07d' % (i,), 'callerid2': agent(i)}
+
+
+def hangupEvent(i):
+    return {'event': 'Hangup', 'channel': channel(i), 'uniqueid': uid(i),
+            'cause': '16', 'cause-txt': 'Normal Clearing'}
+
+
+def memberEvent(i, status=None):
+    if status is None:
+        status = str(1 + i % 2)
+    return {'event': 'QueueMemberStatus', 'queue': QUEUE,
+            'location': agent(i), 'membername': agent(i),
+            'membership': 'static', 'penalty': '0', 'callstaken': str(i),
+            'lastcall': '0', 'status': status, 'paused': '0'}
+
+
+def entryEvent(i):
+    return {'event': 'QueueEntry', 'queue': QUEUE, 'position': str(i + 1),
+            'channel': channel(i), 'uniqueid': uid(i),
+            'calleridnum': '1555%07d' % (i,), 'calleridname': 'Bench',
+            'wait': '10'}
+
+
+def queueMember(i):
+    return {'event': 'QueueMember', 'queue': QUEUE, 'name': agent(i),
+            'location': agent(i), 'membership': 'static', 'penalty': '0',
+            'callstaken': '0', 'lastcall': '0', 'status': '1', 'paused': '0'}
+
+
+class Benchmarks:
+    """
+    The benchmark cases. Each setup method returns a function running count
+    operations and count, building all of its input beforehand.
+    """
+
+    def __init__(self, events, scales):
+        from twisted.plugins import records, queue
+        import fakedb
+        from stargate import StatusSnapshot
+        self.records = records
+        self.queue = queue
+        self.fakedb = fakedb
+        self.StatusSnapshot = StatusSnapshot
+        self.events = events
+        self.scales = scales
+
+    def cases(self):
+        cases = [
+            ('records._onJoin', self.recordsJoin),
+            ('records._onBridge', self.recordsBridge),
+            ('records._onHangup', self.recordsHangup),
+            ('records._createRecord', self.recordsCreate),
+            ('queue._onQueueJoin', self.queueJoin),
+            ('queue._onAgentStatus', self.queueAgentStatus),
+            ('stargate._dispatchCommand', self.dispatchCommand)]
+        for scale in self.scales:
+            cases.append(('records._initRecords[%d]' % (scale,),
+                          lambda scale=scale: self.initRecords(scale)))
+            cases.append(('queue._initQueue[%d]' % (scale,),
+                          lambda scale=scale: self.initQueue(scale)))
+        return cases
+
+    def _plugin(self, cls):
+        plugin = cls()
+        plugin.application = FakeApplication(self.fakedb.ConnectionPool())
+        return plugin
+
+    def _calls(self, plugin, n):
+        for i in range(n):
+            plugin.active.add(self.records.CallRecord(uid(i), channel(i),
+                                                      'QUEUED'))
+
+    def _events(self, handler, events):
+        def run():
+            for event in events:
+                handler(None, event)
+        return run
+
+    def recordsJoin(self):
+        plugin = self._plugin(self.records.CallRecordPlugin)
+        self._calls(plugin, self.events)
+        events = [joinEvent(i) for i in range(self.events)]
+        return (self._events(plugin._onJoin, events), len(events))
+
+    def recordsBridge(self):
+        plugin = self._plugin(self.records.CallRecordPlugin)
+        self._calls(plugin, self.events)
+        events = [bridgeEvent(i) for i in range(self.events)]
+        return (self._events(plugin._onBridge, events), len(events))
+
+    def recordsHangup(self):
+        plugin = self._plugin(self.records.CallRecordPlugin)
+        self._calls(plugin, self.events)
+        events = [hangupEvent(i) for i in range(self.events)]
+        return (self._events(plugin._onHangup, events), len(events))
+
+    def recordsCreate(self):
+        plugin = self._plugin(self.records.CallRecordPlugin)
+        sessions = [FakeAGI(agiVariables(i, 'NewCall?status=QUEUED'))
+                    for i in range(self.events)]
+
+        def run():
+            for agi in sessions:
+                plugin._createRecord(agi, ['QUEUED'])
+        return (run, len(sessions))
+
+    def queueJoin(self):
+        plugin = self._plugin(self.queue.QueuePlugin)
+        events = [joinEvent(i) for i in range(self.events)]
+        return (self._events(plugin._onQueueJoin, events), len(events))
+
+    def queueAgentStatus(self):
+        plugin = self._plugin(self.queue.QueuePlugin)
+        events = [memberEvent(i) for i in range(self.events)]
+        return (self._events(plugin._onAgentStatus, events), len(events))
+
+    def dispatchCommand(self):
+        """ Routing and admission of a session, with a no-op handler """
+        StarGate = loadStarGate()
+        stargate = StarGate()
+        stargate.router.register('Bench', lambda agi, **p: None)
+        scripts = ['Bench?uniqueid=%s' % (uid(i % 100),)
+                   for i in range(self.events)]
+        sessions = [FakeAGI({'agi_network_script': script})
+                    for script in scripts]
+
+        def run():
+            for agi in sessions:
+                stargate._dispatchCommand(agi)
+        return (run, len(sessions))
+
+    def initRecords(self, scale):
+        """ Half of the open records still have a channel """
+        plugin = self._plugin(self.records.CallRecordPlugin)
+        records = [(uid(i), 'QUEUED', '2010-01-01 00:00:00', '', '', '',
+                    '2010-01-01 00:00:00', '5551000', '', '5551000',
+                    'Caller') for i in range(scale)]
+        channels = [{'event': 'Status', 'uniqueid': uid(i),
+                     'channel': channel(i)} for i in range(0, scale, 2)]
+        snapshot = self.StatusSnapshot(channels, [])
+        return (lambda: plugin._initRecords((records, snapshot)), scale)
+
+    def initQueue(self, scale):
+        """ A tenth of the callers are waiting on a callback """
+        plugin = self._plugin(self.queue.QueuePlugin)
+        callbacks = [(uid(i), '1555%07d' % (i,), QUEUE, 1, None, None, 0)
+                     for i in range(0, scale, 10)]
+        queues = ([entryEvent(i) for i in range(scale)] +
+                  [queueMember(i) for i in range(min(scale, 50))])
+        snapshot = self.StatusSnapshot([], queues)
+        return (lambda: plugin._initQueue((callbacks, snapshot)), scale)
+
+
+def loadStarGate():
+    """ Returns the StarGate class of stargate.tac without starting it """
+    path = os.path.join(ROOT, 'stargate.tac')
+    source = open(path).read()
+    source = source[:source.index('\nstargate = StarGate()')]
+    namespace = {'__name__': 'stargate_tac', '__file__': path}
+    exec compile(source, path, 'exec') in namespace
+    return namespace['StarGate']
+
+
+def measure(setup, repeat):
+    """
+    Returns the best operations per second over repeat runs and the net
+    number of gc tracked objects allocated per operation.
+    """
+    best = None
+    objects = None
+    for i in range(repeat):
+        (run, count) = setup()
+        gc.collect()
+        gc.disable()
+        before = len(gc.get_objects())
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+        after = len(gc.get_objects())
+        gc.enable()
+        rate = count / max(elapsed, 1e-9)
+        if best is None or rate > best:
+            best = rate
+        growth = float(after - before) / count
+        if objects is None or growth < objects:
+            objects = growth
+        del run
+    return (best, objects)
+
+
+def compare(name, result, baseline, tolerance, slack):
+    """ Returns a description of the regression, if any """
+    base = baseline.get(name)
+    if base is None:
+        return None
+    problems = []
+    if result['ops'] < base['ops'] * (1 - tolerance):
+        problems.append("%.0f%% slower" %
+                        ((1 - result['ops'] / base['ops']) * 100,))
+    if result['objects'] > base['objects'] + slack:
+        problems.append("%+.2f objects/op" %
+                        (result['objects'] - base['objects'],))
+    return problems and ", ".join(problems) or None
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('-k', dest='filter', default='',
+                      help="only run benchmarks containing this string")
+    parser.add_option('--events', type='int', default=10000,
+                      help="events per handler benchmark [%default]")
+    parser.add_option('--scales', default='100,10000,100000',
+                      help="row counts of the init benchmarks [%default]")
+    parser.add_option('--repeat', type='int', default=3,
+                      help="runs per benchmark, the best is kept [%default]")
+    parser.add_option('--baseline', default=BASELINE,
+                      help="baseline file [%default]")
+    parser.add_option('--save', action='store_true',
+                      help="store the results as the new baseline")
+    parser.add_option('--tolerance', type='float', default=0.2,
+                      help="allowed slow down from baseline [%default]")
+    parser.add_option('--slack', type='float', default=0.5,
+                      help="allowed objects/op above baseline [%default]")
+    (options, args) = parser.parse_args(argv)
+
+    if not options.save and not os.path.exists(options.baseline):
+        parser.error("no baseline at %s, nothing to compare against: store "
+                     "one with --save first" % (options.baseline,))
+
+    workdir = setupPath()
+    try:
+        scales = [int(scale) for scale in options.scales.split(',')]
+        benchmarks = Benchmarks(options.events, scales)
+
+        baseline = {}
+        if os.path.exists(options.baseline):
+            baseline = json.load(open(options.baseline))
+
+        missing = 0
+
+        results = {}
+        regressions = 0
+        print "%-34s %12s %11s  %s" % ("benchmark", "ops/sec", "objects/op",
+                                       "baseline")
+        for (name, setup) in benchmarks.cases():
+            if options.filter not in name:
+                continue
+            (ops, objects) = measure(setup, options.repeat)
+            result = results[name] = {'ops': ops, 'objects': objects}
+            base = baseline.get(name)
+            note = base and "%.0f ops/sec" % (base['ops'],) or "no baseline"
+            if base is None and not options.save:
+                missing += 1
+            problem = compare(name, result, baseline, options.tolerance,
+                              options.slack)
+            if problem:
+                regressions += 1
+                note = "REGRESSION %s (%s)" % (problem, note)
+            print "%-34s %12.0f %11.2f  %s" % (name, ops, objects, note)
+    finally:
+        shutil.rmtree(workdir, True)
+
+    if options.save:
+        baseline.update(results)
+        out = open(options.baseline, 'w')
+        json.dump(baseline, out, indent=2, sort_keys=True)
+        out.close()
+        print "Baseline saved to %s" % (options.baseline,)
+        return 0
+    if missing:
+        print "%d benchmarks missing from %s, store them with --save" % (
+            missing, options.baseline)
+    return (regressions or missing) and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
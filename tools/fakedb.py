@@ -0,0 +1,177 @@
+"""
+In-process DB-API 2.0 stand-in used to run stargate without a database.
+
+Every statement is accepted and returns no rows. Statements can be made
+to take some time with the FAKEDB_LATENCY environment variable (seconds
+per execute) to mimic a real server. Point config.db['type'] at 'fakedb'
+with this directory on the python path to use it.
+
+ConnectionPool is an in-memory stand-in for adbapi.ConnectionPool which
+counts the statements run through it and answers synchronously, for timing
+chevron code without threads or a reactor.
+
+Copyright (C) 2010 Ovation Networks, Inc.
+This file is part of Stargate.
+
+Stargate is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Stargate is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import threading
+
+from twisted.internet import defer
+
+apilevel = '2.0'
+threadsafety = 1
+paramstyle = 'format'
+
+latency = float(os.environ.get('FAKEDB_LATENCY', 0))
+
+## Statement counters, shared by every connection
+lock = threading.Lock()
+statements = {'execute': 0, 'executemany': 0, 'rows': 0}
+
+
+class Error(Exception):
+    pass
+
+
+class DatabaseError(Error):
+    pass
+
+
+class OperationalError(DatabaseError):
+    pass
+
+
+class InterfaceError(Error):
+    pass
+
+
+def _count(kind, rows=1):
+    lock.acquire()
+    try:
+        statements[kind] += 1
+        statements['rows'] += rows
+    finally:
+        lock.release()
+
+
+class Cursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rowcount = -1
+        self.lastrowid = None
+        self.arraysize = 1
+        self.statements = []
+
+    def execute(self, sql, args=None):
+        if latency:
+            time.sleep(latency)
+        _count('execute')
+        self.rowcount = 0
+        self.statements.append((sql, args))
+
+    def executemany(self, sql, seq):
+        rows = list(seq)
+        if latency:
+            time.sleep(latency)
+        _count('executemany', len(rows))
+        self.rowcount = len(rows)
+        self.statements.append((sql, rows))
+
+    def fetchone(self):
+        return None
+
+    def fetchmany(self, size=None):
+        return []
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        self.statements = []
+
+
+class Connection:
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def connect(*args, **kwargs):
+    return Connection(**kwargs)
+
+
+class ConnectionPool:
+    """
+    Records the statements run instead of executing them. Queries fire their
+    deferred straight away with the rows given for the statement, if any.
+    """
+
+    def __init__(self, rows=None):
+        self.rows = rows or {}
+        self.queries = {}
+        self.last = None
+
+    def _record(self, sql, args):
+        self.queries[sql] = self.queries.get(sql, 0) + 1
+        self.last = (sql, args)
+
+    def runQuery(self, sql, *args, **kwargs):
+        self._record(sql, args)
+        return defer.succeed(self.rows.get(sql, []))
+
+    def runOperation(self, sql, *args, **kwargs):
+        self._record(sql, args)
+        return defer.succeed(None)
+
+    def runOperations(self, sql, rows, **kwargs):
+        self._record(sql, rows)
+        return defer.succeed(None)
+
+    def runInteraction(self, interaction, *args, **kwargs):
+        cursor = Cursor(None)
+        try:
+            result = interaction(cursor, *args, **kwargs)
+        except:
+            return defer.fail()
+        for (sql, rows) in cursor.statements:
+            self._record(sql, rows)
+        return defer.succeed(result)
+
+    def runBarrier(self, interaction, *args, **kwargs):
+        return self.runInteraction(interaction, *args, **kwargs)
+
+    def reset(self):
+        self.queries.clear()
+        self.last = None
+
+    def count(self):
+        return sum(self.queries.values())
@@ -0,0 +1,614 @@
+#!/usr/bin/env python2.6
+"""
+End to end load harness for stargate.
+
+Starts a fake asterisk manager interface, runs stargate.tac against it
+under twistd with the in-process fakedb module standing in for MySQL and
+replays synthetic queue calls: every call opens a NewCall fastAGI session
+followed by Join, QueueMemberStatus, Leave, Bridge, Unlink and Hangup
+events, with a share of the calls toggling and removing a callback. Once
+the run is over the sustained event rate, fastAGI latency, database pool
+queue depth and memory growth are reported, as scraped from stargate's
+metrics endpoint.
+
+    % python tools/loadtest.py --rate 50 --duration 60 --agi-concurrency 20
+
+Copyright (C) 2010 Ovation Networks, Inc.
+This file is part of Stargate.
+
+Stargate is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Stargate is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import time
+import random
+import socket
+import shutil
+import signal
+import tempfile
+from optparse import OptionParser
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.protocols import basic
+from twisted.web.client import getPage
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TOOLS)
+
+CONFIG = """from default_config import *
+
+ami = dict(ami, host='127.0.0.1', port=%(ami)d, filters=False,
+           eventmask=None)
+agi = dict(agi, port=%(agi)d)
+db = dict(db, type='fakedb')
+metrics = dict(metrics, port=%(metrics)d, interface='127.0.0.1')
+logging = dict(logging, level=%(level)r)
+plugins = dict(plugins)
+plugins['queue'] = dict(plugins['queue'], queues=[%(queue)r])
+"""
+
+
+class FakeAMI(basic.LineOnlyReceiver):
+    """ Just enough of the asterisk manager protocol to serve stargate """
+    delimiter = '\r\n'
+
+    def connectionMade(self):
+        self.message = []
+        self.transport.write("Asterisk Call Manager/1.1\r\n")
+
+    def lineReceived(self, line):
+        if line:
+            self.message.append(line)
+            return
+        fields = {}
+        for entry in self.message:
+            if ':' in entry:
+                (key, value) = entry.split(':', 1)
+                fields[key.strip().lower()] = value.strip()
+        self.message = []
+        self.actionReceived(fields)
+
+    def send(self, *fields):
+        lines = ["%s: %s" % (key, value) for (key, value) in fields
+                 if value is not None]
+        self.transport.write("\r\n".join(lines) + "\r\n\r\n")
+        self.factory.sent += 1
+
+    def actionReceived(self, fields):
+        action = fields.get('action', '').lower()
+        actionid = fields.get('actionid')
+        if action == 'challenge':
+            self.send(('Response', 'Success'), ('ActionID', actionid),
+                      ('Challenge', '840415273'))
+        elif action == 'login':
+            self.send(('Response', 'Success'), ('ActionID', actionid),
+                      ('Message', 'Authentication accepted'))
+            self.factory.loggedIn(self)
+        elif action == 'status':
+            self.send(('Response', 'Success'), ('ActionID', actionid),
+                      ('Message', 'Channel status will follow'))
+            self.send(('Event', 'StatusComplete'), ('ActionID', actionid),
+                      ('Items', 0))
+        elif action == 'queuestatus':
+            self.send(('Response', 'Success'), ('ActionID', actionid),
+                      ('Message', 'Queue status will follow'))
+            self.factory.queueStatus(self, actionid)
+            self.send(('Event', 'QueueStatusComplete'),
+                      ('ActionID', actionid))
+        elif action == 'logoff':
+            self.send(('Response', 'Goodbye'), ('ActionID', actionid))
+            self.transport.loseConnection()
+        else:
+            self.send(('Response', 'Success'), ('ActionID', actionid))
+
+    def connectionLost(self, reason):
+        self.factory.lost(self)
+
+
+class FakeAMIFactory(protocol.ServerFactory):
+    protocol = FakeAMI
+
+    def __init__(self, queue, agents):
+        self.queue = queue
+        self.agents = agents
+        self.client = None
+        self.sent = 0
+        self.ready = defer.Deferred()
+
+    def loggedIn(self, client):
+        self.client = client
+        if self.ready is not None:
+            (d, self.ready) = (self.ready, None)
+            reactor.callLater(0, d.callback, client)
+
+    def lost(self, client):
+        if self.client is client:
+            self.client = None
+
+    def queueStatus(self, client, actionid):
+        client.send(('Event', 'QueueParams'), ('ActionID', actionid),
+                    ('Queue', self.queue), ('Max', 0), ('Calls', 0),
+                    ('Holdtime', 0), ('Completed', 0), ('Abandoned', 0),
+                    ('ServiceLevel', 0), ('ServicelevelPerf', '0.0'),
+                    ('Weight', 0))
+        for agent in self.agents:
+            client.send(('Event', 'QueueMember'), ('ActionID', actionid),
+                        ('Queue', self.queue), ('Name', agent),
+                        ('Location', agent), ('Membership', 'static'),
+                        ('Penalty', 0), ('CallsTaken', 0), ('LastCall', 0),
+                        ('Status', 1), ('Paused', 0))
+
+    def event(self, name, *fields):
+        """ Sends an event to stargate, returning False if not connected """
+        if self.client is None:
+            return False
+        self.client.send(('Event', name), ('Privilege', 'call,all'),
+                         *fields)
+        return True
+
+
+class FakeAGI(basic.LineOnlyReceiver):
+    """
+    Plays the asterisk side of a fastAGI session, answering every command
+    until stargate hangs up.
+    """
+    delimiter = '\n'
+
+    def __init__(self, variables, done, timeout):
+        self.variables = variables
+        self.done = done
+        self.timeout = timeout
+        self.commands = 0
+        self.timedOut = False
+
+    def connectionMade(self):
+        self.start = time.time()
+        self.timer = reactor.callLater(self.timeout, self._timeout)
+        lines = ["%s: %s" % item for item in self.variables]
+        self.transport.write("\n".join(lines) + "\n\n")
+
+    def lineReceived(self, line):
+        self.commands += 1
+        command = line.split(' ', 2)[:2]
+        if command[0] == 'GET':
+            self.sendLine("200 result=1 (QUEUED)")
+        elif command == ['STREAM', 'FILE'] or command[0] == 'CONTROL':
+            self.sendLine("200 result=0 endpos=0")
+        elif command == ['SET', 'VARIABLE']:
+            self.sendLine("200 result=1")
+        else:
+            self.sendLine("200 result=0")
+
+    def _timeout(self):
+        self.timedOut = True
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if self.timer.active():
+            self.timer.cancel()
+        self.done.callback(self)
+
+
+class LoadTest:
+    """ Drives stargate with synthetic calls and collects the results """
+
+    def __init__(self, options):
+        self.options = options
+        self.agents = ['SIP/%d' % (1000 + i,) for i in range(options.agents)]
+        self.ami = FakeAMIFactory(options.queue, self.agents)
+        self.semaphore = defer.DeferredSemaphore(options.agi_concurrency)
+        self.epoch = int(time.time())
+        self.random = random.Random(options.seed)
+        self.process = None
+        self.pid = None
+        self.calls = 0
+        self.completed = 0
+        self.events = 0
+        self.dropped = 0
+        self.latency = []
+        self.sessions = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.samples = []
+        self.agiBacklog = 0
+        self.error = None
+        self.finished = False
+
+    def run(self):
+        options = self.options
+        listener = reactor.listenTCP(0, self.ami, interface='127.0.0.1')
+        self.ports = {'ami': listener.getHost().port, 'agi': freePort(),
+                      'metrics': freePort()}
+        self.workdir = tempfile.mkdtemp(prefix='stargate-load-')
+        config = open(os.path.join(self.workdir, 'config.py'), 'w')
+        config.write(CONFIG % dict(self.ports, queue=options.queue,
+                                   level=options.log_level))
+        config.close()
+
+        self._spawn()
+        timeout = reactor.callLater(options.startup, self._abort,
+                                    "stargate did not log into the fake AMI")
+        d = self.ami.ready
+        d.addCallback(lambda _: timeout.cancel())
+        d.addCallback(lambda _: task.deferLater(reactor, options.settle,
+                                                lambda: None))
+        d.addCallback(self._load)
+        d.addErrback(self._failed)
+        d.addBoth(self._finish)
+
+    def _spawn(self):
+        env = dict(os.environ)
+        path = [self.workdir, TOOLS, ROOT]
+        if env.get('PYTHONPATH'):
+            path.append(env['PYTHONPATH'])
+        env['PYTHONPATH'] = os.pathsep.join(path)
+        env['FAKEDB_LATENCY'] = str(self.options.db_latency)
+        twistd = self.options.twistd or findTwistd()
+        args = [twistd, '-n', '--pidfile', '', '-l',
+                os.path.join(self.workdir, 'stargate.log'),
+                '-y', os.path.join(ROOT, 'stargate.tac')]
+        self.process = StarGateProcess(self)
+        reactor.spawnProcess(self.process, twistd, args, env=env, path=ROOT)
+        self.pid = self.process.transport.pid
+
+    def _abort(self, reason):
+        self.error = reason
+        if self.ami.ready is not None:
+            (d, self.ami.ready) = (self.ami.ready, None)
+            d.errback(RuntimeError(reason))
+
+    def _failed(self, failure):
+        if self.error is None:
+            self.error = failure.getErrorMessage()
+
+    @defer.inlineCallbacks
+    def _load(self, _):
+        options = self.options
+        yield self._scrape()
+        scraper = task.LoopingCall(self._scrape)
+        scraper.start(options.interval, now=False)
+
+        self.started = time.time()
+        calls = task.LoopingCall(self._tick)
+        calls.start(min(1.0 / options.rate, 0.01))
+        yield task.deferLater(reactor, options.duration, lambda: None)
+        calls.stop()
+        self.stopped = time.time()
+
+        # Let the calls in progress play out before the final sample
+        yield task.deferLater(reactor, options.drain, lambda: None)
+        scraper.stop()
+        yield self._scrape()
+
+    def _finish(self, _):
+        self.finished = True
+        if self.process is not None and self.process.running:
+            os.kill(self.pid, signal.SIGTERM)
+        reactor.callLater(1, reactor.stop)
+
+    def _tick(self):
+        """ Starts the calls due to keep up with options.rate """
+        due = int((time.time() - self.started) * self.options.rate)
+        while self.calls < due:
+            self._call()
+
+    def _call(self):
+        """ Starts a synthetic call, spread over options.step seconds """
+        self.calls += 1
+        n = self.calls
+        uid = '%d.%d' % (self.epoch, n)
+        agentUid = '%d.%d' % (self.epoch + 1, n)
+        channel = 'SIP/trunk-%08x' % (n,)
+        callerid = '1555%07d' % (n % 10000000,)
+        agent = self.agents[n % len(self.agents)]
+        agentChannel = '%s-%08x' % (agent, n)
+        queue = self.options.queue
+        callback = self.random.random() < self.options.callbacks
+
+        steps = [
+            (self._agi, 'NewCall?status=QUEUED', uid, channel, callerid),
+            (self._event, 'Join', ('Channel', channel),
+             ('CallerIDNum', callerid), ('CallerIDName', 'Load Test'),
+             ('Queue', queue), ('Position', 1), ('Count', 1),
+             ('Uniqueid', uid))]
+        if callback:
+            steps.append((self._agi, 'ToggleCallback', uid, channel,
+                          callerid))
+        steps.extend([
+            (self._event, 'QueueMemberStatus', ('Queue', queue),
+             ('Location', agent), ('MemberName', agent),
+             ('Membership', 'static'), ('Penalty', 0),
+             ('CallsTaken', n), ('LastCall', int(time.time())),
+             ('Status', 2), ('Paused', 0)),
+            (self._event, 'Leave', ('Channel', channel), ('Queue', queue),
+             ('Count', 0), ('Uniqueid', uid)),
+            (self._event, 'Bridge', ('Bridgestate', 'Link'),
+             ('Bridgetype', 'core'), ('Channel1', channel),
+             ('Channel2', agentChannel), ('Uniqueid1', uid),
+             ('Uniqueid2', agentUid), ('CallerID1', callerid),
+             ('CallerID2', agent)),
+            (self._event, 'Unlink', ('Channel1', channel),
+             ('Channel2', agentChannel), ('Uniqueid1', uid),
+             ('Uniqueid2', agentUid), ('CallerID1', callerid),
+             ('CallerID2', agent))])
+        if callback:
+            steps.append((self._agi, 'RemoveCallback?uniqueid=%s' % (uid,),
+                          uid, channel, callerid))
+        steps.extend([
+            (self._event, 'Hangup', ('Channel', channel), ('Uniqueid', uid),
+             ('CallerIDNum', callerid), ('Cause', 16),
+             ('Cause-txt', 'Normal Clearing')),
+            (self._event, 'QueueMemberStatus', ('Queue', queue),
+             ('Location', agent), ('MemberName', agent),
+             ('Membership', 'static'), ('Penalty', 0),
+             ('CallsTaken', n), ('LastCall', int(time.time())),
+             ('Status', 1), ('Paused', 0))])
+
+        step = self.options.step
+        for (i, entry) in enumerate(steps):
+            reactor.callLater(i * step, entry[0], *entry[1:])
+        reactor.callLater(len(steps) * step, self._completed)
+
+    def _completed(self):
+        self.completed += 1
+
+    def _event(self, name, *fields):
+        if self.ami.event(name, *fields):
+            self.events += 1
+        else:
+            self.dropped += 1
+
+    def _agi(self, script, uid, channel, callerid):
+        self.agiBacklog = max(self.agiBacklog,
+                              len(self.semaphore.waiting))
+        self.semaphore.run(self._session, script, uid, channel, callerid)
+
+    def _session(self, script, uid, channel, callerid):
+        """ Runs a single fastAGI session, firing once it is over """
+        port = self.ports['agi']
+        variables = [
+            ('agi_network', 'yes'),
+            ('agi_network_script', script),
+            ('agi_request', 'agi://127.0.0.1:%d/%s' % (port, script)),
+            ('agi_channel', channel),
+            ('agi_language', 'en'),
+            ('agi_type', 'SIP'),
+            ('agi_uniqueid', uid),
+            ('agi_version', '1.6.2'),
+            ('agi_callerid', callerid),
+            ('agi_calleridname', 'Load Test'),
+            ('agi_callingpres', '0'),
+            ('agi_callingani2', '0'),
+            ('agi_callington', '0'),
+            ('agi_callingtns', '0'),
+            ('agi_dnid', '8005550100'),
+            ('agi_rdnis', 'unknown'),
+            ('agi_context', 'queue'),
+            ('agi_extension', 's'),
+            ('agi_priority', '1'),
+            ('agi_enhanced', '0.0'),
+            ('agi_accountcode', ''),
+            ('agi_threadid', '1')]
+        done = defer.Deferred()
+        creator = protocol.ClientCreator(reactor, FakeAGI, variables, done,
+                                         self.options.agi_timeout)
+        d = creator.connectTCP('127.0.0.1', port)
+        d.addCallback(lambda _: done)
+        d.addCallbacks(self._sessionDone, self._sessionFailed)
+        return d
+
+    def _sessionDone(self, session):
+        self.sessions += 1
+        if session.timedOut:
+            self.timeouts += 1
+        else:
+            self.latency.append(time.time() - session.start)
+
+    def _sessionFailed(self, failure):
+        self.sessions += 1
+        self.failed += 1
+
+    def _scrape(self):
+        url = 'http://127.0.0.1:%d/metrics' % (self.ports['metrics'],)
+        d = getPage(url, timeout=self.options.interval * 2)
+        d.addCallback(self._sample)
+        d.addErrback(lambda failure: None)
+        return d
+
+    def _sample(self, body):
+        self.samples.append((time.time(), parseMetrics(body), rss(self.pid)))
+
+    def report(self):
+        options = self.options
+        result = {'rate': options.rate, 'duration': options.duration,
+                  'queue': options.queue, 'agents': options.agents,
+                  'db_latency': options.db_latency, 'error': self.error,
+                  'calls': self.calls, 'calls_completed': self.completed,
+                  'events_sent': self.events, 'events_dropped': self.dropped,
+                  'agi_sessions': self.sessions, 'agi_failed': self.failed,
+                  'agi_timeouts': self.timeouts,
+                  'agi_backlog_max': self.agiBacklog}
+
+        if self.samples and hasattr(self, 'stopped'):
+            elapsed = self.stopped - self.started
+            result['events_sent_per_sec'] = self.events / elapsed
+            (first, last) = (self.samples[0], self.samples[-1])
+            handled = (last[1].get('stargate_ami_events_total', 0) -
+                       first[1].get('stargate_ami_events_total', 0))
+            result['events_handled'] = int(handled)
+            result['events_handled_per_sec'] = handled / (last[0] - first[0])
+            result['agi_rejected'] = int(
+                last[1].get('stargate_agi_sessions_rejected', 0))
+            depths = [s[1].get('stargate_db_pool_queue_depth', 0)
+                      for s in self.samples]
+            result['db_queue_depth_max'] = max(depths)
+            result['db_queue_depth_mean'] = sum(depths) / len(depths)
+            result['rss_start_kb'] = first[2]
+            result['rss_end_kb'] = last[2]
+            if first[2] is not None and last[2] is not None:
+                result['rss_growth_kb'] = last[2] - first[2]
+
+        if self.latency:
+            latency = sorted(self.latency)
+            result['agi_p50_ms'] = percentile(latency, .50) * 1000
+            result['agi_p99_ms'] = percentile(latency, .99) * 1000
+            result['agi_max_ms'] = latency[-1] * 1000
+        return result
+
+
+class StarGateProcess(protocol.ProcessProtocol):
+
+    def __init__(self, test):
+        self.test = test
+        self.running = True
+
+    def processEnded(self, reason):
+        self.running = False
+        if not self.test.finished:
+            self.test._abort("stargate exited: %s"
+                             % (reason.getErrorMessage(),))
+
+
+def parseMetrics(body):
+    """ Sums the samples of each metric in the prometheus text format """
+    values = {}
+    for line in body.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        (sample, value) = line.rsplit(' ', 1)
+        name = sample.split('{', 1)[0]
+        values[name] = values.get(name, 0) + float(value)
+    return values
+
+
+def percentile(values, fraction):
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def rss(pid):
+    """ Resident memory of the process in kB, None where /proc is missing """
+    try:
+        for line in open('/proc/%d/status' % (pid,)):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    except (IOError, TypeError):
+        pass
+    return None
+
+
+def freePort():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def findTwistd():
+    candidates = [os.path.join(os.path.dirname(sys.executable), 'twistd')]
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        candidates.append(os.path.join(path, 'twistd'))
+    for candidate in candidates:
+        if os.access(candidate, os.X_OK):
+            return candidate
+    raise SystemExit("twistd not found, use --twistd")
+
+
+def printReport(result):
+    print "StarGate load test: %(duration)ss at %(rate)s calls/s" % result
+    if result['error']:
+        print "  error                %s" % (result['error'],)
+    print "  calls                %(calls)d started, " \
+          "%(calls_completed)d completed" % result
+    if 'events_sent_per_sec' in result:
+        print "  AMI events sent      %d (%.1f/s, %d dropped)" % (
+            result['events_sent'], result['events_sent_per_sec'],
+            result['events_dropped'])
+        print "  AMI events handled   %d (%.1f/s)" % (
+            result['events_handled'], result['events_handled_per_sec'])
+    print "  AGI sessions         %d (%d failed, %d timed out, %d " \
+          "rejected, backlog max %d)" % (result['agi_sessions'],
+          result['agi_failed'], result['agi_timeouts'],
+          result.get('agi_rejected', 0), result['agi_backlog_max'])
+    if 'agi_p50_ms' in result:
+        print "  AGI latency          p50 %.1fms  p99 %.1fms  max %.1fms" % (
+            result['agi_p50_ms'], result['agi_p99_ms'], result['agi_max_ms'])
+    if 'db_queue_depth_max' in result:
+        print "  DB queue depth       max %d  mean %.1f" % (
+            result['db_queue_depth_max'], result['db_queue_depth_mean'])
+    if 'rss_growth_kb' in result:
+        print "  Memory (RSS)         %dkB -> %dkB (%+dkB)" % (
+            result['rss_start_kb'], result['rss_end_kb'],
+            result['rss_growth_kb'])
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--rate', type='float', default=20,
+                      help="new calls per second [%default]")
+    parser.add_option('--duration', type='float', default=30,
+                      help="seconds to generate calls for [%default]")
+    parser.add_option('--step', type='float', default=0.2,
+                      help="seconds between the events of a call [%default]")
+    parser.add_option('--callbacks', type='float', default=0.1,
+                      help="share of calls toggling a callback [%default]")
+    parser.add_option('--agi-concurrency', type='int', default=20,
+                      help="concurrent fastAGI sessions [%default]")
+    parser.add_option('--agi-timeout', type='float', default=30,
+                      help="seconds before a session is dropped [%default]")
+    parser.add_option('--agents', type='int', default=10,
+                      help="queue members [%default]")
+    parser.add_option('--queue', default='LoadTest',
+                      help="queue name [%default]")
+    parser.add_option('--db-latency', type='float', default=0.002,
+                      help="seconds each fake query takes [%default]")
+    parser.add_option('--interval', type='float', default=1,
+                      help="seconds between metrics samples [%default]")
+    parser.add_option('--drain', type='float', default=5,
+                      help="seconds to wait for calls to finish [%default]")
+    parser.add_option('--startup', type='float', default=30,
+                      help="seconds to wait for stargate to start [%default]")
+    parser.add_option('--settle', type='float', default=1,
+                      help="seconds to wait after login [%default]")
+    parser.add_option('--log-level', default='warning',
+                      help="stargate log level [%default]")
+    parser.add_option('--seed', type='int', default=0,
+                      help="random seed [%default]")
+    parser.add_option('--twistd', help="twistd executable")
+    parser.add_option('--json', help="also write the results to this file")
+    parser.add_option('--keep', action='store_true',
+                      help="keep the work directory with the stargate log")
+    (options, args) = parser.parse_args(argv)
+
+    test = LoadTest(options)
+    reactor.callWhenRunning(test.run)
+    reactor.run()
+
+    result = test.report()
+    printReport(result)
+    if options.json:
+        import json
+        out = open(options.json, 'w')
+        json.dump(result, out, indent=2, sort_keys=True)
+        out.close()
+    if options.keep:
+        print "  work directory       %s" % (test.workdir,)
+    else:
+        shutil.rmtree(test.workdir, True)
+    return result['error'] is not None and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
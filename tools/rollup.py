@@ -0,0 +1,153 @@
+#!/usr/bin/env python2.6
+"""
+Backfills the call record rollups from the records already stored.
+
+Reads the closed records ending between --since and --until in chunks of
+--chunk rows, walking the primary key so no chunk rescans the ones before
+it, and adds each chunk's totals to records_rollup with the same batched
+upsert the records chevron uses. --replace first deletes the rollups of the
+buckets in range, so a range can be rebuilt safely. The range defaults to
+everything before the current bucket, which the running chevron owns.
+
+Only the caller_dnid and account_code rollups are backfilled. The agent a
+call was bridged to is only known to the running chevron, which leaves the
+agent column of the records table empty, so its agent rollups are left as
+they are, --replace included.
+
+    % python tools/rollup.py --since 2010-01-01 --replace
+
+Copyright (C) 2010 Ovation Networks, Inc.
+This file is part of Stargate.
+
+Stargate is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Stargate is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import time
+import datetime
+from optparse import OptionParser
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TOOLS)
+sys.path.insert(0, ROOT)
+
+from rollups import Rollups, UPSERT, bucketOf
+import config
+
+## Dimensions the records table has the values of
+BACKFILLED = ('caller_dnid', 'account_code')
+
+SELECT = """
+    SELECT id, call_end, status, hold_start, hold_end, talk_start, talk_end,
+           caller_dnid, account_code
+    FROM `records`
+    WHERE id > %s AND call_end >= %s AND call_end < %s
+    ORDER BY id
+    LIMIT %s"""
+
+
+def parseDate(value):
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError("Unrecognized date %r, use YYYY-MM-DD [HH:MM:SS]" %
+                     (value,))
+
+
+def connect(cfg):
+    dbapi = __import__(cfg['type'])
+    return dbapi.connect(host=cfg['host'], user=cfg['username'],
+                         passwd=cfg['password'], db=cfg['database'])
+
+
+def backfill(connection, since, until, size, chunk, replace=False):
+    """
+    Adds the rollups of the records ending in [since, until), returning the
+    number of records read and rollup rows written.
+    """
+    cursor = connection.cursor()
+    if replace:
+        cursor.execute("""
+            DELETE FROM `records_rollup`
+            WHERE bucket >= %%s AND bucket < %%s AND dimension IN (%s)""" % (
+            ", ".join(["%s"] * len(BACKFILLED)),),
+            (since, until) + BACKFILLED)
+        connection.commit()
+
+    (last, calls, written, start) = (0, 0, 0, time.time())
+    while True:
+        cursor.execute(SELECT, (last, since, until, chunk))
+        records = cursor.fetchall()
+        if not records:
+            break
+        rollups = Rollups(size, BACKFILLED)
+        for (id, callEnd, status, holdStart, holdEnd, talkStart, talkEnd,
+             dnid, accountCode) in records:
+            rollups.add(callEnd, (dnid, accountCode, None), status,
+                        holdStart, holdEnd, talkStart, talkEnd)
+        rows = rollups.drain()
+        cursor.executemany(UPSERT, rows)
+        connection.commit()
+
+        last = records[-1][0]
+        calls += len(records)
+        written += len(rows)
+        print "  %d records, %d rollup rows, up to id %d (%.0f records/s)" % (
+            calls, written, last, calls / max(time.time() - start, 0.001))
+    cursor.close()
+    return (calls, written)
+
+
+def main(argv):
+    cfg = config.plugins.get('records', {})
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--since', help="first call end to include "
+                      "[the earliest]")
+    parser.add_option('--until', help="call end to stop at, exclusive "
+                      "[the start of the current bucket]")
+    parser.add_option('--bucket', type='int',
+                      default=cfg.get('rollup_bucket', 3600),
+                      help="seconds per bucket [%default]")
+    parser.add_option('--chunk', type='int', default=5000,
+                      help="records read per query [%default]")
+    parser.add_option('--replace', action='store_true',
+                      help="delete the caller_dnid and account_code rollups "
+                      "in range first")
+    (options, args) = parser.parse_args(argv)
+
+    since = datetime.datetime(1970, 1, 1)
+    if options.since:
+        since = bucketOf(parseDate(options.since), options.bucket)
+    until = datetime.datetime.now()
+    if options.until:
+        until = parseDate(options.until)
+    until = bucketOf(until, options.bucket)
+
+    print "Backfilling rollups from %s until %s" % (since, until)
+    connection = connect(config.db)
+    try:
+        (calls, written) = backfill(connection, since, until,
+                                    options.bucket, options.chunk,
+                                    options.replace)
+    finally:
+        connection.close()
+    print "Done, %d records rolled up into %d rows" % (calls, written)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
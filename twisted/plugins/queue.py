@@ -23,41 +23,236 @@ You should have received a copy of the GNU General Public License
 along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import math
+import time
+
 from zope.interface import implements
 from twisted.plugin import IPlugin
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.python import log
 from twisted.application import internet
 from starpy import fastagi
 
-from stargate import IChevron
+from stargate import IChevron, getLogger
+from metrics import instrumentQueries
+from storage import CRITICAL, BEST_EFFORT, Shed
+import metrics
 import config
 
 
-def debug(*args, **kwargs):
-    """ If debug mode is set push out logs """
-    d = False
-    if d:
-        log.msg(*args, **kwargs)
+logger = getLogger('QueuePlugin')
+
+
+class QueueCaller(object):
+    """
+    A caller waiting in, or flagged for a callback from, one of the queues.
+    Callers of a queue are chained together in join order.
+    """
+    __slots__ = ('uid', 'callback', 'callerid', 'number', 'room', 'queue',
+                 'count', 'prev', 'next')
+
+    def __init__(self, uid, callerid=None, queue=None, callback=0,
+                 number=None, room=None, count=0):
+        self.uid = uid
+        self.callback = callback
+        self.callerid = callerid
+        self.number = number
+        self.room = room
+        self.queue = queue
+        self.count = count
+        self.prev = self.next = self
+
+
+class QueueIndex(object):
+    """
+    Authoritative in memory copy of the `queue` table. Keeps the callers of
+    each queue in join order with constant time appends, removals by uid and
+    lookups of the caller at the head of a queue.
+    """
+    __slots__ = ('_queues', '_uids')
+
+    def __init__(self):
+        self._queues = {}
+        self._uids = {}
+
+    def __contains__(self, uid):
+        return uid in self._uids
+
+    def __len__(self):
+        return len(self._uids)
+
+    def get(self, uid):
+        """ Returns the caller with the given uid or None """
+        return self._uids.get(uid)
+
+    def add(self, caller):
+        """ Appends a caller to the tail of its queue, ignoring duplicates """
+        if caller.uid in self._uids:
+            return self._uids[caller.uid]
+        head = self._queues.get(caller.queue)
+        if head is None:
+            head = self._queues[caller.queue] = QueueCaller(None)
+        caller.prev = head.prev
+        caller.next = head
+        head.prev.next = caller
+        head.prev = caller
+        self._uids[caller.uid] = caller
+        return caller
+
+    def remove(self, uid):
+        """ Removes and returns the caller with the given uid or None """
+        caller = self._uids.pop(uid, None)
+        if caller is not None:
+            caller.prev.next = caller.next
+            caller.next.prev = caller.prev
+            caller.prev = caller.next = caller
+        return caller
+
+    def head(self, queue):
+        """ Returns the caller next up in the given queue or None """
+        head = self._queues.get(queue)
+        if head is None or head.next is head:
+            return None
+        return head.next
+
+    def callers(self, queue):
+        """ Iterates over the callers of the given queue in order """
+        head = self._queues.get(queue)
+        if head is None:
+            return
+        caller = head.next
+        while caller is not head:
+            following = caller.next
+            yield caller
+            caller = following
+
+    def clear(self):
+        self._queues.clear()
+        self._uids.clear()
+
+
+class Blacklist(object):
+    """
+    In memory copy of the `callback_blacklist` table. Refreshed incrementally
+    using the auto increment id as a high-water mark, with a periodic full
+    resync to pick up numbers removed from the table.
+    """
+    __slots__ = ('numbers', 'highWater', 'loaded', 'hits', 'misses')
+
+    def __init__(self):
+        self.numbers = set()
+        self.highWater = 0
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, number):
+        if number in self.numbers:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def update(self, rows):
+        """ Adds (id, number) rows fetched past the high-water mark """
+        for (id, number) in rows:
+            self.numbers.add(number)
+            self.highWater = max(self.highWater, id)
+        self.loaded = True
+
+    def replace(self, rows):
+        """ Replaces the blacklist with a full set of (id, number) rows """
+        self.numbers = set()
+        self.highWater = 0
+        self.update(rows)
+
+    def stats(self):
+        return {'size': len(self.numbers), 'hits': self.hits,
+                'misses': self.misses, 'high_water': self.highWater}
+
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel used to hold callers back between callback attempts.
+    Timers are kept in one of a fixed number of slots, each tick of the wheel
+    expiring the timers of a single slot. The wheel only ticks while it holds
+    any timers.
+    """
+
+    def __init__(self, expired, resolution=1.0, slots=512):
+        self.expired = expired
+        self.resolution = resolution
+        self.slots = [{} for i in xrange(slots)]
+        self.timers = {}
+        self.position = 0
+        self.loop = task.LoopingCall(self._tick)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, delay):
+        """ Expires key after delay seconds, replacing any existing timer """
+        self.cancel(key)
+        ticks = max(1, int(math.ceil(delay / self.resolution)))
+        index = (self.position + ticks) % len(self.slots)
+        self.slots[index][key] = (ticks - 1) // len(self.slots)
+        self.timers[key] = index
+        if not self.loop.running:
+            self.loop.start(self.resolution, now=False)
+
+    def cancel(self, key):
+        index = self.timers.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def _tick(self):
+        self.position = (self.position + 1) % len(self.slots)
+        slot = self.slots[self.position]
+        expired = []
+        for (key, rounds) in slot.items():
+            if rounds:
+                slot[key] = rounds - 1
+            else:
+                del slot[key]
+                del self.timers[key]
+                expired.append(key)
+
+        # Expire before stopping, so timers re-armed by the callbacks keep
+        # this loop running rather than starting a second one mid tick.
+        for key in expired:
+            self.expired(key)
+        if not self.timers and self.loop.running:
+            self.loop.stop()
+
+
+def _normalize(row):
+    """
+    Row values as strings, so rows read back from the database compare
+    equal to the same values taken from AMI events.
+    """
+    return tuple(['%s' % (value,) for value in row])
 
 
 class RequestHandler:
-    """ Handles requests to control the callback queue """
+    """
+    Handles requests to control the callback queue. Queue and membership
+    writes are normal priority, callback requests critical and agent status
+    updates best-effort, as the next status event supersedes them anyway.
+    Writes for a caller are ordered on its uid and writes for a member on
+    its queue and location.
+    """
 
     def __init__(self, dbpool):
         self.dbpool = dbpool
         self.uid = 0
-        self.errCount = 0
         self.deferred = defer.Deferred()
 
-    def _fail(self, failure):
-        """
-        Attempt to retry our collector calls up to a maximum
-        failed attempts (default 3). If still unsuccessful
-        return failed deferred object
-        """
-        log.err(failure)
-
     def validateNumber(self, number=None):
         """ Validates a number against the callback queue blacklist """
         if number is not None:
@@ -66,20 +261,130 @@ class RequestHandler:
                         WHERE number=%s""", (number,))
         return self.deferred.errback(ValueError("No Number Set"))
 
-    def resetQueue(self):
+    def getBlacklist(self, since=0):
         """
-        Reset the queue database by clearing/deleting out all the non-callback
-        rows.
+        Gets the callback blacklist numbers added after the given id, or the
+        whole blacklist by default.
         """
         return self.dbpool.runQuery("""
+                    SELECT id, number FROM `callback_blacklist`
+                    WHERE id > %s""", (since,))
+
+    def loadQueue(self, callers, members):
+        """
+        Replaces the queue and queue members with a snapshot of the asterisk
+        queues in a single interaction. The reset deletes and the multi-row
+        inserts share one transaction so, on transactional tables, readers
+        never see the queue empty partway through a reload. Callers are rows
+        of (uid, callerid, queue) and members rows of addAgentToQueue's
+        arguments. The reload runs as a barrier, after the queue writes made
+        before the snapshot and before those made after it.
+        """
+        return self.dbpool.runBarrier(self._loadQueue, callers, members)
+
+    def _loadQueue(self, txn, callers, members):
+        txn.execute("""
                     DELETE FROM `queue`
                     WHERE callback=0""")
+        txn.execute("""DELETE FROM `queue_members`""")
+        if callers:
+            # Callers flagged for a callback survive the reset, so skip them
+            # rather than failing the whole batch on the unique uid.
+            txn.executemany("""
+                    INSERT IGNORE INTO `queue`
+                        (uid, callback, callerid, queue_name)
+                    VALUES (%s, 0, %s, %s)""", callers)
+        if members:
+            txn.executemany("""
+                    INSERT INTO `queue_members`
+                        (agent, queue, name, location, penalty, calls_taken,
+                         last_call, status, paused, timestamp)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())""",
+                members)
 
-    def resetQueueMembers(self):
+    def syncQueue(self, callers, members, size=500):
         """
-        Resets the queue members database by clearing/deleting out all members
+        Reconciles the queue and queue members with a snapshot of the
+        asterisk queues, writing only the rows that differ instead of
+        reloading the tables, in statements of at most size rows. Callers
+        and members are given as for loadQueue, and the rows are diffed in a
+        barrier like the reload. Fires with the number of rows inserted or
+        updated and deleted.
         """
-        return self.dbpool.runQuery("""DELETE FROM `queue_members`""")
+        return self.dbpool.runBarrier(self._syncQueue, callers, members,
+                                      size)
+
+    def _syncQueue(self, txn, callers, members, size):
+        txn.execute("""
+                    SELECT uid, callerid, queue_name FROM `queue`
+                    WHERE callback=0""")
+        stored = {}
+        for row in txn.fetchall():
+            stored[str(row[0])] = _normalize(row)
+        wanted = {}
+        for row in callers:
+            wanted[str(row[0])] = row
+        gone = [uid for uid in stored if uid not in wanted]
+        changed = [row for (uid, row) in wanted.iteritems()
+                   if stored.get(uid) != _normalize(row)]
+        for i in xrange(0, len(gone), size):
+            batch = gone[i:i + size]
+            txn.execute("""
+                    DELETE FROM `queue`
+                    WHERE callback=0 AND uid IN (%s)""" % (
+                ", ".join(["%s"] * len(batch)),), batch)
+        for i in xrange(0, len(changed), size):
+            # Callers flagged for a callback are left as they are
+            txn.executemany("""
+                    INSERT INTO `queue`
+                        (uid, callback, callerid, queue_name)
+                    VALUES (%s, 0, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        callerid=IF(callback=0, VALUES(callerid), callerid),
+                        queue_name=IF(callback=0, VALUES(queue_name),
+                                      queue_name)""", changed[i:i + size])
+        (written, deleted) = (len(changed), len(gone))
+
+        txn.execute("""
+                    SELECT agent, queue, name, location, penalty, calls_taken,
+                           last_call, status, paused
+                    FROM `queue_members`""")
+        stored = {}
+        for row in txn.fetchall():
+            stored[(row[1], row[3])] = _normalize(row)
+        wanted = {}
+        for row in members:
+            wanted[(row[1], row[3])] = row
+        gone = [key for key in stored if key not in wanted]
+        changed = [row for (key, row) in wanted.iteritems()
+                   if stored.get(key) != _normalize(row)]
+        for i in xrange(0, len(gone), size):
+            batch = gone[i:i + size]
+            args = []
+            for key in batch:
+                args.extend(key)
+            txn.execute("""
+                    DELETE FROM `queue_members`
+                    WHERE (queue, location) IN (%s)""" % (
+                ", ".join(["(%s, %s)"] * len(batch)),), args)
+        for i in xrange(0, len(changed), size):
+            txn.executemany(self._upsertMemberSQL, changed[i:i + size])
+        return (written + len(changed), deleted + len(gone))
+
+    _upsertMemberSQL = """
+                    INSERT INTO `queue_members`
+                        (agent, queue, name, location, penalty, calls_taken,
+                         last_call, status, paused, timestamp)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())
+                    ON DUPLICATE KEY UPDATE
+                        agent=VALUES(agent),
+                        name=VALUES(name),
+                        penalty=VALUES(penalty),
+                        calls_taken=VALUES(calls_taken),
+                        last_call=VALUES(last_call),
+                        status=VALUES(status),
+                        paused=VALUES(paused),
+                        timestamp=VALUES(timestamp)"""
 
     def addAgentToQueue(self, agent, queue, name, location, penalty,
                         calls_taken, last_call, status, paused):
@@ -90,46 +395,55 @@ class RequestHandler:
         if queue is None or location is None:
             return self.deferred.errback(ValueError("No queue/location set"))
 
-        return self.dbpool.runQuery("""
+        return self.dbpool.runOperation("""
                     INSERT INTO `queue_members`
                         (agent, queue, name, location, penalty, calls_taken,
                          last_call, status, paused, timestamp)
                     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())""",
                 (agent, queue, name, location, penalty, calls_taken,
-                 last_call, status, paused,))
+                 last_call, status, paused,), lanes=((queue, location),))
 
     def removeAgentFromQueue(self, queue, location):
         """ Remove agent location/queue from the database. """
         if queue is None or location is None:
             return self.deferred.errback(ValueError("No queue/location set"))
 
-        return self.dbpool.runQuery("""
+        return self.dbpool.runOperation("""
                     DELETE FROM `queue_members`
-                    WHERE queue=%s AND location=%s""", (queue, location,))
+                    WHERE queue=%s AND location=%s""", (queue, location,),
+                lanes=((queue, location),))
 
-    def updateAgentStatus(self, queue, location, penalty, calls_taken,
-                          last_call, status, paused):
-        """ Update an agent status. """
-        if queue is None or location is None:
-            return self.deferred.errback(ValueError("No queue/location set"))
-
-        return self.dbpool.runQuery("""
+    def updateAgentStatuses(self, members):
+        """
+        Updates the status of many agents in one batched write. Members are
+        rows of addAgentToQueue's arguments, keyed on queue and location so
+        a member's waiting update is replaced by its next one.
+        """
+        rows = []
+        keys = []
+        for (agent, queue, name, location, penalty, calls_taken, last_call,
+             status, paused) in members:
+            rows.append((penalty, calls_taken, last_call, status, paused,
+                         queue, location))
+            keys.append((queue, location))
+        return self.dbpool.runOperations("""
                     UPDATE `queue_members` SET
                         penalty=%s,
                         calls_taken=%s,
                         last_call=%s,
                         status=%s,
                         paused=%s
-                    WHERE queue=%s AND location=%s""", (penalty, calls_taken,
-                last_call, status, paused, queue, location,))
+                    WHERE queue=%s AND location=%s""", rows,
+                priority=BEST_EFFORT, keys=keys, lanes=keys)
 
     def addToQueue(self, uid, callerid, queue):
         """ Validates the caller before adding them to the callback queue """
         if uid > 0:
-            return self.dbpool.runQuery("""
+            return self.dbpool.runOperation("""
                         INSERT INTO `queue`
                             (uid, callback, callerid, queue_name)
-                        VALUES (%s, 0, %s, %s)""", (uid, callerid, queue,))
+                        VALUES (%s, 0, %s, %s)""", (uid, callerid, queue,),
+                lanes=(uid,))
 
         return self.deferred.errback(ValueError("No UniqueID Set"))
 
@@ -141,9 +455,9 @@ class RequestHandler:
             condition = ""
             if not force:
                 condition = "AND callback=0"
-            return self.dbpool.runQuery("""
+            return self.dbpool.runOperation("""
                         DELETE FROM `queue`
-                        WHERE uid=%s""" + condition, (uid,))
+                        WHERE uid=%s""" + condition, (uid,), lanes=(uid,))
         return self.deferred.errback(ValueError("No UniqueID Set"))
 
     def updateCallbackCount(self, uid=None):
@@ -153,10 +467,10 @@ class RequestHandler:
         situation where we are spamming the number with calls
         """
         if uid > 0:
-            return self.dbpool.runQuery("""
+            return self.dbpool.runOperation("""
                         UPDATE `queue` SET
                             count=count+1
-                        WHERE uid=%s""", (uid,))
+                        WHERE uid=%s""", (uid,), lanes=(uid,))
         return self.deferred.errback(ValueError("No UniqueID Set"))
 
     def toggleQueueCallback(self, uid=None, number=None, room=None):
@@ -166,36 +480,44 @@ class RequestHandler:
         later point in time call them back.
         """
         if uid is not None:
-            return self.dbpool.runQuery("""
+            return self.dbpool.runOperation("""
                     UPDATE `queue` SET
                         callback=IF(callback=0, 1, 0),
                         number=%s,
                         room=%s
-                    WHERE uid=%s""", (number, room, uid,))
+                    WHERE uid=%s""", (number, room, uid,), priority=CRITICAL,
+                lanes=(uid,))
         return self.deferred.errback(ValueError("No UniqueID Set"))
 
-    def getQueueCallback(self, name=None):
+    def getCallbacks(self):
+        """
+        Gets the callers flagged for a callback, which survive queue resets,
+        in the order they joined their queue.
+        """
+        return self.dbpool.runQuery("""
+                    SELECT uid, callerid, queue_name, callback, number, room,
+                           count
+                    FROM `queue`
+                    WHERE callback=1
+                    ORDER BY id ASC""")
+
+    def getCallbackRecord(self, uid=None):
         """
-        Queries the database and returns the top caller in the callback queue
+        Gets the call record details passed along with a callback for the
+        given uid.
         """
-        if name is not None:
+        if uid is not None:
             return self.dbpool.runQuery("""
-                    SELECT
-                        q.uid, q.callback, q.callerid, q.number, q.room,
-                        q.queue_name, q.count, r.ticket, r.caller_dnid
-                    FROM `queue` AS q
-                    LEFT JOIN `records` AS r
-                        ON `r`.`uid`=`q`.uid
-                    WHERE q.queue_name = %s
-                    ORDER BY q.id ASC
-                    LIMIT 1""", (name,))
-
-        return self.deferred.errback(ValueError("No Queue Name Set"))
+                    SELECT ticket, caller_dnid FROM `records`
+                    WHERE uid=%s""", (uid,))
+        return self.deferred.errback(ValueError("No UniqueID Set"))
 
     def getQueues(self):
         """ Gets all of the configured queues from the database """
         return self.dbpool.runQuery("SELECT id, name FROM `queue_name`")
 
+instrumentQueries(RequestHandler, 'queue')
+
 
 class QueuePlugin:
     """
@@ -209,17 +531,34 @@ class QueuePlugin:
         self.service = None
         self.factory = None
         self.cfg = config.plugins['queue']
+        self.callers = QueueIndex()
+        self.agents = {}
+        self.available = {}
+        self.backoff = TimerWheel(self._onBackoffExpired,
+                                  self.cfg.get('resolution', 1))
+        self.blacklist = Blacklist()
+        self.blacklistSynced = 0
+        self.members = {}
+        self.dirtyMembers = {}
+        self.flushingMembers = {}
 
     def registerServices(self, application):
-        debug("%s Chevron: Services Locked." % (self.__class__.__name__,))
+        logger.debug("Services Locked.")
         if self.application is None:
             self.application = application
-        self.checker = internet.TimerService(self.cfg['interval'],
-                                             self._callbackService)
-        self.checker.setServiceParent(self.application.service)
+        self.blacklistService = internet.TimerService(
+            self.cfg.get('blacklist_refresh', 60), self._refreshBlacklist)
+        self.blacklistService.setServiceParent(self.application.service)
+        self.memberService = internet.TimerService(
+            self.cfg.get('status_flush', 0.5), self._flushMembers)
+        self.memberService.setServiceParent(self.application.service)
+        for key in ('size', 'hits', 'misses', 'high_water'):
+            metrics.registry.gauge('stargate_queue_blacklist_%s' % (key,),
+                'Callback blacklist %s' % (key.replace('_', ' '),),
+                lambda key=key: self.blacklist.stats()[key])
 
     def registerCommands(self, application):
-        debug("%s Chevron: Commands Locked." % (self.__class__.__name__,))
+        logger.debug("Commands Locked.")
         if self.application is None:
             self.application = application
         self.application.registerCommands('ToggleCallback',
@@ -228,35 +567,38 @@ class QueuePlugin:
                                           self._removeCallback)
 
     def registerEvents(self, application):
-        debug("%s Chevron: Events Locked." % (self.__class__.__name__,))
+        logger.debug("Events Locked.")
 
         if self.application is None:
             self.application = application
-        self.application.ami.registerEvent('Join', self._onQueueJoin)
-        self.application.ami.registerEvent('Leave', self._onQueueLeave)
-        #self.application.ami.registerEvent('Hangup', self._onQueueLeave)
-        self.application.ami.registerEvent('QueueCallerAbandoned',
-                                           self._onCallerAbandonded)
-        self.application.ami.registerEvent('AgentConnect',
-                                           self._onAgentConnect)
-        self.application.ami.registerEvent('AgentDump', self._onAgentDump)
-        self.application.ami.registerEvent('AgentComplete',
-                                           self._onAgentComplete)
-        self.application.ami.registerEvent('QueueMemberStatus',
-                                           self._onAgentStatus)
-        self.application.ami.registerEvent('QueueMemberPaused',
-                                           self._onAgentPause)
-        self.application.ami.registerEvent('QueueMemberAdded',
-                                            self._onAgentAdded)
-        self.application.ami.registerEvent('QueueMemberRemoved',
-                                            self._onAgentRemoved)
-
-        h = RequestHandler(self.application.dbpool)
-        d1 = h.resetQueue().addErrback(self._fail)
-        d2 = h.resetQueueMembers().addErrback(self._fail)
-        s = self.application.ami.queueStatus()
-        dl = defer.gatherResults([d1, d2, s])
-        dl.addCallback(self._initQueue)
+        queues = {'queue': self.cfg['queues']}
+        self.application.registerEvent('Join', self._onQueueJoin, queues)
+        self.application.registerEvent('Leave', self._onQueueLeave, queues)
+        #self.application.registerEvent('Hangup', self._onQueueLeave)
+        self.application.registerEvent('QueueCallerAbandoned',
+                                       self._onCallerAbandonded, queues)
+        self.application.registerEvent('AgentConnect',
+                                       self._onAgentConnect, queues)
+        self.application.registerEvent('AgentDump', self._onAgentDump,
+                                       queues)
+        self.application.registerEvent('AgentComplete',
+                                       self._onAgentComplete, queues)
+        self.application.registerEvent('QueueMemberStatus',
+                                       self._onAgentStatus, queues)
+        self.application.registerEvent('QueueMemberPaused',
+                                       self._onAgentPause, queues)
+        self.application.registerEvent('QueueMemberAdded',
+                                       self._onAgentAdded, queues)
+        self.application.registerEvent('QueueMemberRemoved',
+                                       self._onAgentRemoved, queues)
+
+    def onStatus(self, snapshot):
+        """ Resynchronizes the queues with asterisk on each new connection """
+        h = RequestHandler(self.application.getPool('queue'))
+        d = h.getCallbacks()
+        d.addCallback(lambda callbacks: self._initQueue((callbacks, snapshot)))
+        d.addErrback(self._fail)
+        return d
 
     def _fail(self, failure, agi=None):
         """ Handles failures """
@@ -279,8 +621,6 @@ class QueuePlugin:
         if agi is not None:
             queue = agi.variables['agi_queue']
         elif event is not None:
-            debug("%s Chevron: Event Triggered: %s" %
-                (self.__class__.__name__, event,))
             queue = event['queue']
         else:
             return False
@@ -294,44 +634,76 @@ class QueuePlugin:
         stale data in the database and verifying that the users are either
         still in the queue or allowing them to get callbacks.
         """
-
-        events = args[2]
-
-        debug("%s Chevron: Initializing Queue" % (self.__class__.__name__,))
-        for event in events:
-            if not self._interesting(event=event):
-                continue
-
-            debug("Event: %s" % (event,))
-            if event['event'] == "QueueEntry":
-                h = RequestHandler(self.application.dbpool)
-                d = h.addToQueue(event['uniqueid'],
-                                 event['calleridnum'],
-                                 event['queue'])
-                d.addErrback(self._fail)
-            elif event['event'] == "QueueMember":
+        (callbacks, snapshot) = args
+
+        logger.debug("Initializing Queue")
+
+        # Callers waiting on a callback joined before anyone still in queue
+        self.callers.clear()
+        for row in callbacks:
+            self.callers.add(QueueCaller(*row))
+
+        self.agents.clear()
+        self.available.clear()
+        self.members.clear()
+        self.dirtyMembers.clear()
+        self.flushingMembers.clear()
+
+        callers = []
+        members = []
+        for name in self.cfg['queues']:
+            for event in snapshot.entries.get(name, ()):
+                logger.debug("Event: %s", event)
+                if event['uniqueid'] in self.callers:
+                    continue
+                self.callers.add(QueueCaller(event['uniqueid'],
+                                             event['calleridnum'],
+                                             event['queue']))
+                callers.append((event['uniqueid'], event['calleridnum'],
+                                event['queue']))
+
+            for event in snapshot.members.get(name, ()):
+                logger.debug("Event: %s", event)
+                self._setAgent(event['queue'], event['location'],
+                               event['status'], event['paused'])
                 (_, agent) = event['location'].split("/")
+                members.append((agent, event['queue'], event['name'],
+                                event['location'], event['penalty'],
+                                event['callstaken'], event['lastcall'],
+                                event['status'], event['paused']))
+                self.members[(event['queue'], event['location'])] = \
+                    members[-1]
+
+        h = RequestHandler(self.application.getPool('queue'))
+        if self.cfg.get('resync', 'diff') == 'diff':
+            d = h.syncQueue(callers, members, self.cfg.get('resync_batch',
+                                                           500))
+            d.addCallback(self._synced)
+        else:
+            d = h.loadQueue(callers, members)
+        d.addErrback(self._fail)
+
+        for name in self.cfg['queues']:
+            self._scheduleCallback(name)
+        return d
 
-                h = RequestHandler(self.application.dbpool)
-                d = h.addAgentToQueue(agent,
-                                      event['queue'], event['name'],
-                                      event['location'], event['penalty'],
-                                      event['callstaken'], event['lastcall'],
-                                      event['status'], event['paused'])
-                d.addErrback(self._fail)
+    def _synced(self, counts):
+        logger.info("Queue resynchronized, %d rows written, %d deleted",
+                    *counts)
 
     def _onQueueJoin(self, ami, event):
         """
         When a user/channel joins a asterisk queue this AMI event will be
         triggered and will add the caller into our queue.
         """
-        debug("%s Chevron: %s Event Triggered: %s" %
-            (self.__class__.__name__, event['event'], event,))
+        logger.event(event)
 
-        if not self._interesting(event=event):
+        if event['uniqueid'] in self.callers:
             return
+        self.callers.add(QueueCaller(event['uniqueid'], event['calleridnum'],
+                                     event['queue']))
 
-        h = RequestHandler(self.application.dbpool)
+        h = RequestHandler(self.application.getPool('queue'))
         d = h.addToQueue(event['uniqueid'],
                          event['calleridnum'], event['queue'])
         d.addErrback(self._fail)
@@ -342,15 +714,18 @@ class QueuePlugin:
         trigger and causes the caller to be removed from the callback queue
         if they were not set to get a callback from support.
         """
-        debug("%s Chevron: %s Event Triggered: %s" %
-            (self.__class__.__name__, event['event'], event,))
+        logger.event(event)
 
-        if not self._interesting(event=event):
-            return
+        caller = self.callers.get(event['uniqueid'])
+        if caller is not None and not caller.callback:
+            self.callers.remove(caller.uid)
 
-        h = RequestHandler(self.application.dbpool)
-        d = h.removeFromQueue(event['uniqueid'])
-        d.addErrback(self._fail)
+            h = RequestHandler(self.application.getPool('queue'))
+            d = h.removeFromQueue(event['uniqueid'])
+            d.addErrback(self._fail)
+
+        # Someone else may now be next up in the queue
+        self._scheduleCallback(event['queue'])
 
     def _onCallerAbandonded(self, ami, event):
         """
@@ -370,7 +745,7 @@ class QueuePlugin:
 
     def _onAgentComplete(self, ami, event):
         """ Agent call completed successfuly. """
-        pass
+        self._scheduleCallback(event['queue'])
 
     def _onAgentStatus(self, ami, event):
         """
@@ -386,57 +761,67 @@ class QueuePlugin:
             AST_DEVICE_RINGINUSE    7
             AST_DEVICE_ONHOLD       8
         """
-        debug("%s Chevron: %s Event Triggered: %s" %
-            (self.__class__.__name__, event['event'], event,))
-
-        if not self._interesting(event=event):
-            return
-
-        h = RequestHandler(self.application.dbpool)
-        d = h.updateAgentStatus(
-                queue=event['queue'],
-                location=event['location'],
-                penalty=event['penalty'],
-                calls_taken=event['callstaken'],
-                last_call=event['lastcall'],
-                status=event['status'],
-                paused=event['paused'])
-        d.addErrback(self._fail)
+        logger.event(event)
+
+        if self._setAgent(event['queue'], event['location'],
+                          event['status'], event['paused']):
+            self._scheduleCallback(event['queue'])
+
+        # Only the latest status is written on the next flush, if changed
+        # from the one written or being written
+        key = (event['queue'], event['location'])
+        member = (event['location'].split("/")[-1], event['queue'],
+                  event.get('membername'), event['location'], event['penalty'],
+                  event['callstaken'], event['lastcall'], event['status'],
+                  event['paused'])
+        stored = self.flushingMembers.get(key, self.members.get(key))
+        if stored is not None and stored[4:] == member[4:]:
+            self.dirtyMembers.pop(key, None)
+        else:
+            self.dirtyMembers[key] = member
 
     def _onAgentPause(self, ami, event):
         """
         Agent was paused. Calls from the queue will not get sent to the agent
         while they are paused.
         """
-        debug("%s Chevron: %s Event Triggered: %s" %
-            (self.__class__.__name__, event['event'], event,))
+        logger.event(event)
+
+        state = self.agents.get((event['queue'], event['location']))
+        if state is not None and self._setAgent(event['queue'],
+                event['location'], state[0], event['paused']):
+            self._scheduleCallback(event['queue'])
 
     def _onAgentAdded(self, ami, event):
         """ Agent was dynamically added to a queue. """
-        debug("%s Chevron: %s Event Triggered: %s" %
-            (self.__class__.__name__, event['event'], event,))
+        logger.event(event)
 
-        if not self._interesting(event=event):
-            return
+        if self._setAgent(event['queue'], event['location'],
+                          event['status'], event['paused']):
+            self._scheduleCallback(event['queue'])
 
         (_, agent) = event['location'].split("/")
-
-        h = RequestHandler(self.application.dbpool)
-        d = h.addAgentToQueue(agent, event['queue'], event['membername'],
-                              event['location'], event['penalty'],
-                              event['callstaken'], event['lastcall'],
-                              event['status'], event['paused'])
+        member = (agent, event['queue'], event['membername'],
+                  event['location'], event['penalty'], event['callstaken'],
+                  event['lastcall'], event['status'], event['paused'])
+        self.members[(event['queue'], event['location'])] = member
+        self.dirtyMembers.pop((event['queue'], event['location']), None)
+        self.flushingMembers.pop((event['queue'], event['location']), None)
+
+        h = RequestHandler(self.application.getPool('queue'))
+        d = h.addAgentToQueue(*member)
         d.addErrback(self._fail)
 
     def _onAgentRemoved(self, ami, event):
         """ Agent was removed from a queue dynamically. """
-        debug("%s Chevron: %s Event Triggered: %s" %
-            (self.__class__.__name__, event['event'], event,))
+        logger.event(event)
 
-        if not self._interesting(event=event):
-            return
+        self._removeAgent(event['queue'], event['location'])
+        self.members.pop((event['queue'], event['location']), None)
+        self.dirtyMembers.pop((event['queue'], event['location']), None)
+        self.flushingMembers.pop((event['queue'], event['location']), None)
 
-        h = RequestHandler(self.application.dbpool)
+        h = RequestHandler(self.application.getPool('queue'))
         d = h.removeAgentFromQueue(event['queue'], event['location'])
         d.addErrback(self._fail)
 
@@ -446,8 +831,7 @@ class QueuePlugin:
         callback number if one is given, otherwise the caller ID will be used
         as the callback number instead.
         """
-        debug("%s Chevron: Toggle Callback Triggered." %
-            (self.__class__.__name__,))
+        logger.debug("Toggle Callback Triggered.")
         if number is None:
             number = agi.variables['agi_callerid']
         else:
@@ -457,23 +841,31 @@ class QueuePlugin:
             room = room[0]
 
         ## Chained defers method
-        h = RequestHandler(self.application.dbpool)
-        d = h.validateNumber(number)
+        if self.blacklist.loaded:
+            matches = []
+            if number in self.blacklist:
+                matches.append((None, number))
+            d = defer.succeed(matches)
+        else:
+            h = RequestHandler(self.application.getPool('queue'))
+            d = h.validateNumber(number)
         d.addCallback(self._setCallback,
                       uid=agi.variables['agi_uniqueid'],
                       number=number, room=room, agi=agi)
         d.addErrback(self._fail, agi=agi)
+        return d
 
     def _removeCallback(self, agi, uniqueid=None):
         """
         Removes the given uniqueid from the callback queue. This should be used
         once the callback as occured and the caller is now back in the queue.
         """
-        debug("%s Chevron: Remove Callback Triggered." %
-            (self.__class__.__name__,))
+        logger.debug("Remove Callback Triggered.")
         if uniqueid is not None:
             uniqueid = uniqueid[0]
-            h = RequestHandler(self.application.dbpool)
+            self.callers.remove(uniqueid)
+            self.backoff.cancel(uniqueid)
+            h = RequestHandler(self.application.getPool('queue'))
             d = h.removeFromQueue(uniqueid, force=True)
             d.addErrback(self._fail, agi=agi)
 
@@ -490,82 +882,188 @@ class QueuePlugin:
         sequence = fastagi.InSequence()
         if uid > 0:
             if len(matches) > 0:
-                debug("%s Chevron: Number is invalid" %
-                    (self.__class__.__name__,))
+                logger.debug("Number is invalid")
                 sequence.append(agi.setVariable, "INVALID", 1)
                 sequence.append(agi.streamFile, 'privacy-incorrect')
                 sequence.append(agi.wait, 1)
                 sequence.append(agi.setPriority, 1)
             else:
-                debug("%s Chevron: Number is valid" %
-                    (self.__class__.__name__,))
-                h = RequestHandler(self.application.dbpool)
+                logger.debug("Number is valid")
+                caller = self.callers.get(uid)
+                if caller is not None:
+                    caller.callback = int(not caller.callback)
+                    caller.number = number
+                    caller.room = room
+                h = RequestHandler(self.application.getPool('queue'))
                 d = h.toggleQueueCallback(uid, number, room)
                 d.addErrback(self._fail, agi=agi)
 
         sequence.append(agi.finish)
         return sequence()
 
-    def _callbackService(self):
+    def _refreshBlacklist(self):
+        """
+        Fetches the blacklist numbers added since the last refresh, or the
+        whole blacklist once every blacklist_resync seconds.
+        """
+        h = RequestHandler(self.application.getPool('queue'))
+        now = time.time()
+        if now - self.blacklistSynced >= self.cfg.get('blacklist_resync',
+                                                      3600):
+            self.blacklistSynced = now
+            d = h.getBlacklist()
+            d.addCallback(self.blacklist.replace)
+        else:
+            d = h.getBlacklist(self.blacklist.highWater)
+            d.addCallback(self.blacklist.update)
+        d.addCallback(lambda _: logger.debug("Blacklist %s",
+                                             self.blacklist.stats()))
+        d.addErrback(self._fail)
+        return d
+
+    def _setAgent(self, queue, location, status, paused):
+        """
+        Tracks the state of a queue member. Returns True when the member has
+        just become available to take a call, i.e. not in use and not paused.
+        """
+        self.agents[(queue, location)] = (status, paused)
+        available = self.available.setdefault(queue, set())
+        if str(status) == '1' and str(paused) == '0':
+            if location not in available:
+                available.add(location)
+                return True
+        else:
+            available.discard(location)
+        return False
+
+    def _flushMembers(self):
+        """
+        Writes the latest status of every member changed since the last
+        flush in one batched update.
+        """
+        if not self.dirtyMembers or self.application is None:
+            return
+        (dirty, self.dirtyMembers) = (self.dirtyMembers, {})
+        self.flushingMembers.update(dirty)
+        logger.debug("Flushing %d member statuses", len(dirty))
+
+        h = RequestHandler(self.application.getPool('queue'))
+        d = h.updateAgentStatuses(dirty.values())
+        d.addCallbacks(self._flushed, self._flushFailed,
+                       callbackArgs=(dirty,), errbackArgs=(dirty,))
+
+    def _flushed(self, result, dirty):
+        """ Keeps the written statuses unless superseded since """
+        for (key, member) in dirty.iteritems():
+            if self.flushingMembers.get(key) is member:
+                del self.flushingMembers[key]
+                self.members[key] = member
+
+    def _flushFailed(self, failure, dirty):
+        """
+        Flushes the statuses again next time unless superseded. Shed updates
+        are expected while the database is busy or failing.
+        """
+        for (key, member) in dirty.iteritems():
+            if self.flushingMembers.get(key) is member:
+                del self.flushingMembers[key]
+                self.dirtyMembers.setdefault(key, member)
+        if failure.check(Shed):
+            logger.debug("Member statuses shed: %s",
+                         failure.getErrorMessage())
+            return
+        self._fail(failure)
+
+    def _removeAgent(self, queue, location):
+        self.agents.pop((queue, location), None)
+        self.available.get(queue, set()).discard(location)
+
+    def _scheduleCallback(self, queue):
         """
-        Checks the callback queue for any callers who need to be called back
-        in order to re-enter the call queue.
+        Calls back the caller next up in the given queue, if they asked for
+        a callback, as soon as an agent is available to take the call.
+        Callers are then held back by the timer wheel for a backoff growing
+        with each attempt before they may be called again.
         """
-        debug("%s Chevron: Callback Triggered." % (self.__class__.__name__,))
-        if self.application.ami != None:
-            for name in self.cfg['queues']:
-                h = RequestHandler(self.application.dbpool)
-                d = h.getQueueCallback(name)
-                ## Uncomment this to re-enable the call back features
-                #d.addCallbacks(self._sendCallback, self._fail)
+        if not self.cfg.get('callback_enabled', False):
+            return
+        if self.application is None or self.application.ami is None:
+            return
+        if not self.available.get(queue):
+            return
+
+        caller = self.callers.head(queue)
+        if caller is None or not caller.callback or caller.uid in self.backoff:
+            return
+
+        logger.debug("Callback Triggered.")
+        self.backoff.schedule(caller.uid, self._backoffDelay(caller.count))
+
+        h = RequestHandler(self.application.getPool('queue'))
+        d = h.getCallbackRecord(caller.uid)
+        d.addCallbacks(self._sendCallback, self._fail, callbackArgs=(caller,))
+        return d
+
+    def _backoffDelay(self, count):
+        """ Seconds to wait after a callback attempt before the next one """
+        delay = self.cfg.get('backoff', 90) * (2 ** count)
+        return min(delay, self.cfg.get('backoff_max', 900))
+
+    def _onBackoffExpired(self, uid):
+        caller = self.callers.get(uid)
+        if caller is not None:
+            self._scheduleCallback(caller.queue)
 
-    def _sendCallback(self, callers=None):
+    def _sendCallback(self, records, caller):
         """
         Uses the asterisk AMI interface to originate a call out to the number
         given. If the call fails to connect it leaves the caller in the queue
         otherwise it will remove the caller from the queue once they answer the
         line.
         """
-        for caller in callers:
-            if caller[1] != 0:
-                l = []
-                if caller[6] >= config.plugins['callback']['callback_limit']:
-                    debug("%s Chevron: Exceeded Callback Attempts Limit" %
-                        (self.__class__.__name__,))
-                    h = RequestHandler(self.application.dbpool)
-                    rd = h.removeFromQueue(caller[0], force=True)
-                    rd.addErrback(self._fail)
-                    l.append(rd)
-
-                debug("%s Chevron: Sending Callback" %
-                    (self.__class__.__name__,))
-
-                # Send the actual callback to the number. The results of
-                # success or fail do not matter at this time. We use another
-                # AGI call once the channel is picked up to determine if it
-                # worked. This is because the originate can't tell accurately.
-                cd = self.application.ami.originate(
-                    channel='SIP/' + caller[3] + '@13193656200',
-                    context=self.cfg['callback']['context'],
-                    exten=self.cfg['callback']['exten'],
-                    priority=self.cfg['callback']['priority'],
-                    callerid=self.cfg['callback']['callerid'],
-                    timeout=self.cfg['callback']['timeout'],
-                    variable={'callbackUID': caller[0],
-                              'queueName': caller[5],
-                              'itemID': caller[7],
-                              'roomNumber': caller[4],
-                              'callbackDNID': caller[8]})
-                l.append(cd)
-
-                # Update the callback counter after callback (successful or
-                # not)
-                h = RequestHandler(self.application.dbpool)
-                ud = h.updateCallbackCount(caller[0])
-                ud.addErrback(self._fail)
-                l.append(ud)
-
-                dl = defer.DeferredList(l)
+        (ticket, dnid) = (None, None)
+        if records:
+            (ticket, dnid) = records[0]
+
+        if caller.count >= self.cfg['callback_limit']:
+            logger.debug("Exceeded Callback Attempts Limit")
+            self.callers.remove(caller.uid)
+            self.backoff.cancel(caller.uid)
+            h = RequestHandler(self.application.getPool('queue'))
+            rd = h.removeFromQueue(caller.uid, force=True)
+            rd.addErrback(self._fail)
+            return rd
+
+        logger.debug("Sending Callback")
+
+        # Send the actual callback to the number. The results of
+        # success or fail do not matter at this time. We use another
+        # AGI call once the channel is picked up to determine if it
+        # worked. This is because the originate can't tell accurately.
+        l = []
+        cd = self.application.ami.originate(
+            channel='SIP/%s@%s' % (caller.number,
+                                   self.cfg['callback']['trunk']),
+            context=self.cfg['callback']['context'],
+            exten=self.cfg['callback']['exten'],
+            priority=self.cfg['callback']['priority'],
+            callerid=self.cfg['callback']['callerid'],
+            timeout=self.cfg['callback']['timeout'],
+            variable={'callbackUID': caller.uid,
+                      'queueName': caller.queue,
+                      'itemID': ticket,
+                      'roomNumber': caller.room,
+                      'callbackDNID': dnid})
+        l.append(cd)
+
+        # Update the callback counter after callback (successful or not)
+        caller.count += 1
+        h = RequestHandler(self.application.getPool('queue'))
+        ud = h.updateCallbackCount(caller.uid)
+        ud.addErrback(self._fail)
+        l.append(ud)
+
+        return defer.DeferredList(l)
 
 
 # Comment out this line to disable the plugin
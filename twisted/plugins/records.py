@@ -20,6 +20,9 @@ along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
 """
 ##!/usr/bin/env python
 
+import datetime
+import time
+
 from zope.interface import implements
 from twisted.plugin import IPlugin
 from twisted.internet import defer
@@ -27,7 +30,12 @@ from twisted.python import log
 from twisted.application import internet
 from starpy import fastagi
 
-from stargate import IChevron
+from stargate import IChevron, getLogger
+from metrics import instrumentQueries
+from storage import CRITICAL
+from rollups import Rollups, UPSERT
+from export import RecordExport
+import metrics
 import config
 
 #def verbose(fn):
@@ -45,39 +53,172 @@ import config
 #    return wrapper()
 
 
-def debug(*args, **kwargs):
-    """ If debug mode is set push out logs """
-    d = False
-    if d:
-        log.msg(*args, **kwargs)
+logger = getLogger('CallRecordPlugin')
+
+
+ZERO_DATE = '0000-00-00 00:00:00'
+
+
+def now():
+    """ Current time truncated to the second, as stored by MySQL NOW() """
+    return datetime.datetime.now().replace(microsecond=0)
+
+
+class CallRecord(object):
+    """
+    In memory copy of an open call record. Tracks the call state between its
+    creation and its hangup so the write-behind mode only has to make a single
+    final write to the database.
+    """
+    __slots__ = ('uid', 'channel', 'status', 'holdStart', 'holdEnd',
+                 'talkStart', 'talkEnd', 'callStart', 'callEnd', 'dirty',
+                 'dnid', 'accountCode', 'agent', 'callerNumber',
+                 'callerName')
+
+    def __init__(self, uid, channel=None, status='', holdStart=None,
+                 holdEnd=None, talkStart=None, talkEnd=None, callStart=None,
+                 dnid=None, accountCode=None, agent=None, callerNumber=None,
+                 callerName=None):
+        self.uid = uid
+        self.channel = channel
+        self.status = status
+        self.holdStart = holdStart
+        self.holdEnd = holdEnd
+        self.talkStart = talkStart
+        self.talkEnd = talkEnd
+        self.callStart = callStart
+        self.callEnd = None
+        self.dirty = False
+        self.dnid = dnid
+        self.accountCode = accountCode
+        self.agent = agent
+        self.callerNumber = callerNumber
+        self.callerName = callerName
+
+    def enqueue(self):
+        self.holdStart = now()
+        self.status = 'ENQUEUE'
+        self.dirty = True
+
+    def dequeue(self):
+        self.holdEnd = now()
+        if self.status not in ('ABANDONED', 'TALKING'):
+            self.status = 'DEQUEUE'
+        self.dirty = True
+
+    def link(self, peer=None):
+        self.talkStart = now()
+        self.status = 'TALKING'
+        if peer is not None:
+            # Device of the bridged channel, e.g. 1001 for SIP/1001-0a1b2c
+            self.agent = peer.split('/', 1)[-1].rsplit('-', 1)[0]
+        self.dirty = True
+
+    def unlink(self):
+        self.talkEnd = now()
+        self.status = 'COMPLETE'
+        self.dirty = True
+
+    def abandon(self):
+        self.status = 'ABANDONED'
+        self.dirty = True
+
+    def close(self):
+        """ Closes out the record, ending any hold or talk time still open """
+        self.callEnd = now()
+        if self.holdStart is not None and self.holdEnd is None:
+            self.holdEnd = self.callEnd
+        if self.talkStart is not None and self.talkEnd is None:
+            self.talkEnd = self.callEnd
+        self.dirty = True
+
+    def row(self):
+        """ Returns the record values in RequestHandler.saveRecord order """
+        return (self.status,
+                self.holdStart or ZERO_DATE, self.holdEnd or ZERO_DATE,
+                self.talkStart or ZERO_DATE, self.talkEnd or ZERO_DATE,
+                self.callEnd or ZERO_DATE, self.uid)
+
+    def cdr(self):
+        """ Returns the record keyed by the records columns, for export """
+        return {'uid': self.uid, 'channel': self.channel,
+                'caller_number': self.callerNumber,
+                'caller_name': self.callerName, 'caller_dnid': self.dnid,
+                'account_code': self.accountCode, 'status': self.status,
+                'agent': self.agent, 'call_start': self.callStart,
+                'call_end': self.callEnd, 'hold_start': self.holdStart,
+                'hold_end': self.holdEnd, 'talk_start': self.talkStart,
+                'talk_end': self.talkEnd}
+
+
+class CallTable(object):
+    """
+    Table of the actively monitored calls indexed by uniqueid, giving
+    constant time lookups and removals no matter how many channels are up.
+    """
+    __slots__ = ('_uids',)
+
+    def __init__(self):
+        self._uids = {}
+
+    def __contains__(self, uid):
+        return uid in self._uids
+
+    def __len__(self):
+        return len(self._uids)
+
+    def __iter__(self):
+        return self._uids.itervalues()
+
+    def get(self, uid):
+        """ Returns the record for the given uniqueid or None """
+        return self._uids.get(uid)
+
+    def add(self, record):
+        self._uids[record.uid] = record
+        return record
+
+    def remove(self, uid):
+        """ Removes and returns the record for the uniqueid or None """
+        return self._uids.pop(uid, None)
+
+    def rename(self, uid, channel):
+        """ Updates a record whose channel was renamed by asterisk """
+        record = self._uids.get(uid)
+        if record is None:
+            return None
+        record.channel = channel
+        return record
+
+    def clear(self):
+        self._uids.clear()
 
 
 #@defer.inlineCallbacks
 class RequestHandler:
-    """ Handles requests to control the callback queue """
-    maxErrs = 3
+    """
+    Handles requests to control the call records. Call record writes are
+    critical, so they are journaled rather than shed when the database is
+    struggling; retrying them is up to the application's write queue, which
+    runs the writes for each uid in order.
+    """
 
     def __init__(self, dbpool):
         self.dbpool = dbpool
         self.uid = 0
-        self.errCount = 0
         self.deferred = defer.Deferred()
 
-    def _fail(self, failure):
+    def getActiveRecords(self):
         """
-        Attempt to retry our collector calls up to a maximum
-        failed attempts (default 3). If still unsuccessful
-        return failed deferred object
+        Reads back the open records. The agent column is never written, the
+        bridged agent only being known to the running chevron, so it isn't
+        read either.
         """
-        self.errCount += 1
-        if self.errCount < self.maxErrs:
-            pass
-        else:
-            self.deferred.errback(failure)
-
-    def getActiveRecords(self):
         return self.dbpool.runQuery("""
-            SELECT `uid` FROM `records` WHERE call_end = '0000-00-00 00:00:00'
+            SELECT `uid`, `status`, `hold_start`, `hold_end`,
+                   `talk_start`, `talk_end`, `call_start`, `caller_dnid`,
+                   `account_code`, `caller_number`, `caller_name`
+            FROM `records` WHERE call_end = '0000-00-00 00:00:00'
         """)
 
     def createRecord(self, uid, channel, callerNumber, callerName,
@@ -86,15 +227,16 @@ class RequestHandler:
         Creates new record in the stargate database.
         """
         if uid > 0:
-            debug("Creating a new Call Record: %s, %s, %s, %s, %s, %s, %s" %
-                (uid, channel, callerNumber, callerName,
-                 callerDNID, accountCode, status))
-            return self.dbpool.runQuery("""
+            logger.debug("Creating a new Call Record: %s, %s, %s, %s, %s, "
+                "%s, %s", uid, channel, callerNumber, callerName,
+                callerDNID, accountCode, status)
+            return self.dbpool.runOperation("""
                 INSERT INTO `records`
                     (uid, channel, caller_number, caller_name,
                      caller_dnid, account_code, status, call_start)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())""", (uid, channel,
-                    callerNumber, callerName, callerDNID, accountCode, status))
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""", (uid, channel,
+                    callerNumber, callerName, callerDNID, accountCode, status,
+                    now()), priority=CRITICAL, lanes=(uid,))
 
         self.deferred.errback(ValueError("No UniqueID Set"))
         return self.deferred
@@ -104,12 +246,13 @@ class RequestHandler:
         Updates record into a queued status.
         """
         if uid > 0:
-            debug("Entering call into queue")
-            return self.dbpool.runQuery("""
+            logger.debug("Entering call into queue")
+            return self.dbpool.runOperation("""
                 UPDATE `records` SET
-                    hold_start = NOW(),
+                    hold_start = %s,
                     status = 'ENQUEUE'
-                WHERE uid=%s""", (uid,))
+                WHERE uid=%s""", (now(), uid),
+                priority=CRITICAL, lanes=(uid,))
         self.deferred.errback(ValueError("No UniqueID Set"))
         return self.deferred
 
@@ -119,42 +262,46 @@ class RequestHandler:
         setting dequeue status based on cause.
         """
         if uid > 0:
-            return self.dbpool.runQuery("""
+            return self.dbpool.runOperation("""
                 UPDATE `records` SET
-                    hold_end = NOW(),
+                    hold_end = %s,
                     status = CASE
                         WHEN status = 'ABANDONED' THEN 'ABANDONED'
                         WHEN status = 'TALKING' THEN 'TALKING'
                         ELSE 'DEQUEUE'
                     END
-                WHERE uid=%s""", (uid,))
+                WHERE uid=%s""", (now(), uid),
+                priority=CRITICAL, lanes=(uid,))
         self.deferred.errback(ValueError("No UniqueID Set"))
         return self.deferred
 
     def linkRecord(self, uid):
         if uid > 0:
-            return self.dbpool.runQuery("""
+            return self.dbpool.runOperation("""
                 UPDATE `records` SET
-                    talk_start = NOW(),
+                    talk_start = %s,
                     status = 'TALKING'
-                WHERE uid=%s""", (uid,))
+                WHERE uid=%s""", (now(), uid),
+                priority=CRITICAL, lanes=(uid,))
         return self.deferred.errback(ValueError("No UniqueId Set"))
 
     def unlinkRecord(self, uid):
         if uid > 0:
-            return self.dbpool.runQuery("""
+            return self.dbpool.runOperation("""
                 UPDATE `records` SET
-                    talk_end = NOW(),
+                    talk_end = %s,
                     status = 'COMPLETE'
-                WHERE uid=%s""", (uid,))
+                WHERE uid=%s""", (now(), uid),
+                priority=CRITICAL, lanes=(uid,))
         return self.deferred.errback(ValueError("No UniqueId Set"))
 
     def abandonRecord(self, uid):
         if uid > 0:
-            return self.dbpool.runQuery("""
+            return self.dbpool.runOperation("""
                 UPDATE `records` SET
                     status = 'ABANDONED'
-                WHERE uid=%s""", (uid,))
+                WHERE uid=%s""", (uid,),
+                priority=CRITICAL, lanes=(uid,))
         return self.deferred.errback(ValueError("No UniqueId Set"))
 
     def closeRecord(self, uid):
@@ -162,24 +309,99 @@ class RequestHandler:
         Closes a record in the stargate database
         """
         if uid > 0:
-            debug("Closing Call Record: ", uid)
-            return self.dbpool.runQuery("""
+            logger.debug("Closing Call Record: %s", uid)
+            t = now()
+            return self.dbpool.runOperation(self._closeSQL + """
+                WHERE uid = %s""", (t, t, t, uid),
+                priority=CRITICAL, lanes=(uid,))
+        self.deferred.errback(ValueError("No UniqueID Set"))
+        return self.deferred
+
+    def closeRecords(self, uids, size=500):
+        """
+        Closes many records in the stargate database, using one UPDATE per
+        batch of at most size uids.
+        """
+        t = now()
+        uids = list(uids)
+        batches = []
+        for i in xrange(0, len(uids), size):
+            batch = uids[i:i + size]
+            batches.append(self.dbpool.runOperation(self._closeSQL + """
+                WHERE uid IN (%s)""" % (", ".join(["%s"] * len(batch)),),
+                [t, t, t] + batch, priority=CRITICAL, lanes=batch))
+        return defer.DeferredList(batches, fireOnOneErrback=True,
+                                  consumeErrors=True)
+
+    _closeSQL = """
                 UPDATE `records` SET
-                    call_end = NOW(),
+                    call_end = %s,
                     hold_end = IF(
                             hold_start != '0000-00-00 00:00:00'
                             AND hold_end = '0000-00-00 00:00:00',
-                            NOW(), hold_end
+                            %s, hold_end
                         ),
                     talk_end = IF(
                             talk_start != '0000-00-00 00:00:00'
                             AND talk_end = '0000-00-00 00:00:00',
-                            NOW(), talk_end
-                        )
-                WHERE uid = %s""", (uid,))
+                            %s, talk_end
+                        )"""
+
+    def saveRecord(self, uid, status, holdStart, holdEnd, talkStart, talkEnd,
+                   callEnd):
+        """
+        Writes the full state of a record kept in memory by the write-behind
+        mode back to the stargate database.
+        """
+        if uid > 0:
+            logger.debug("Saving Call Record: %s", uid)
+            return self.dbpool.runOperation(self._saveSQL, (status,
+                holdStart, holdEnd, talkStart, talkEnd, callEnd, uid),
+                priority=CRITICAL, lanes=(uid,))
         self.deferred.errback(ValueError("No UniqueID Set"))
         return self.deferred
 
+    def saveRecords(self, rows):
+        """
+        Writes a batch of in memory records in a single statement. Each row
+        is given in the order returned by CallRecord.row(). Checkpoints are
+        only normal priority, the records are saved again on hangup.
+        """
+        rows = list(rows)
+        return self.dbpool.runOperations(self._saveSQL, rows,
+                                         lanes=[row[-1] for row in rows])
+
+    def saveRollups(self, rows):
+        """
+        Adds the totals of finished rollup buckets, rows as returned by
+        Rollups, to the summary table in a single batched upsert.
+        """
+        return self.dbpool.runOperations(UPSERT, rows)
+
+    _saveSQL = """
+                UPDATE `records` SET
+                    status = %s,
+                    hold_start = %s,
+                    hold_end = %s,
+                    talk_start = %s,
+                    talk_end = %s,
+                    call_end = %s
+                WHERE uid = %s"""
+
+instrumentQueries(RequestHandler, 'records')
+
+
+class RollupService(internet.TimerService):
+    """ Flushes the finished rollups periodically and the rest on stop """
+
+    def __init__(self, step, flush):
+        internet.TimerService.__init__(self, step, flush)
+        self.flush = flush
+
+    def stopService(self):
+        self.flush(True)
+        return internet.TimerService.stopService(self)
+
 
 class CallRecordPlugin:
     """
@@ -193,35 +415,78 @@ class CallRecordPlugin:
         self.service = None
         self.factory = None
         self.cfg = config.plugins['records']
-        self.active = []
+        self.active = CallTable()
+        self.writeBehind = self.cfg.get('write_behind', False)
+        self.database = self.cfg.get('database', True)
+        if not self.database:
+            # Without the records table calls only live in memory
+            self.writeBehind = True
+        self.export = None
+        export = self.cfg.get('export')
+        if export:
+            self.export = RecordExport(export['path'],
+                                       export.get('format', 'jsonl'),
+                                       export.get('max_bytes', 64 << 20),
+                                       export.get('max_age', 3600),
+                                       export.get('compress', True),
+                                       export.get('interval', 1.0),
+                                       export.get('batch', 500),
+                                       export.get('max_buffered', 100000))
+        self.rollups = None
+        if self.cfg.get('rollups', False):
+            self.rollups = Rollups(self.cfg.get('rollup_bucket', 3600))
 
     def registerServices(self, application):
-        pass
+        logger.debug("Services Locked.")
+        if self.application is None:
+            self.application = application
+        interval = self.cfg.get('checkpoint', 0)
+        if self.database and self.writeBehind and interval > 0:
+            self.checkpointer = internet.TimerService(interval,
+                                                      self._checkpoint)
+            self.checkpointer.setServiceParent(self.application.service)
+        if self.rollups is not None:
+            self.rollupService = RollupService(
+                self.cfg.get('rollup_flush', 60), self._flushRollups)
+            self.rollupService.setServiceParent(self.application.service)
+        if self.export is not None:
+            self.export.setServiceParent(self.application.service)
+            for key in ('buffered', 'exported', 'failed', 'dropped',
+                        'rejected'):
+                metrics.registry.gauge('stargate_records_export_%s' % (key,),
+                    'Call records %s by the export' % (key,),
+                    lambda key=key: self.export.stats()[key])
 
     def registerCommands(self, application):
-        debug("%s chevron commands locked" % (self.__class__.__name__,))
+        logger.debug("Commands Locked.")
         if self.application is None:
             self.application = application
         self.application.registerCommands('NewCall', self._createRecord)
 
     def registerEvents(self, application):
-        debug("%s chevron events locked" % (self.__class__.__name__,))
+        logger.debug("Events Locked.")
         if self.application is None:
             self.application = application
-        self.application.ami.registerEvent('Hangup', self._onHangup)
-        self.application.ami.registerEvent('Join', self._onJoin)
-        self.application.ami.registerEvent('Leave', self._onLeave)
-        self.application.ami.registerEvent('Bridge', self._onBridge)
-        self.application.ami.registerEvent('Unlink', self._onUnlink)
-        self.application.ami.registerEvent('QueueCallerAbandon',
-            self._onAbandon)
-
-        # Initialize the new connection
-        h = RequestHandler(self.application.dbpool)
-        d = h.getActiveRecords().addErrback(self._fail)
-        s = self.application.ami.status()
-        dl = defer.gatherResults([d, s])
-        dl.addCallback(self._initRecords)
+        active = {'uniqueid': self.active}
+        bridged = [{'uniqueid1': self.active}, {'uniqueid2': self.active}]
+        self.application.registerEvent('Hangup', self._onHangup, active)
+        self.application.registerEvent('Join', self._onJoin, active)
+        self.application.registerEvent('Leave', self._onLeave, active)
+        self.application.registerEvent('Bridge', self._onBridge, bridged)
+        self.application.registerEvent('Unlink', self._onUnlink, bridged)
+        self.application.registerEvent('QueueCallerAbandon',
+            self._onAbandon, active)
+        self.application.registerEvent('Rename', self._onRename, active)
+
+    def onStatus(self, snapshot):
+        """ Initialize the new connection """
+        if not self.database:
+            return self._resumeRecords(snapshot)
+        h = RequestHandler(self.application.getPool('records'))
+        d = h.getActiveRecords()
+        d.addCallback(lambda records: self._initRecords((records, snapshot)))
+        d.addErrback(self._fail)
+        return d
 
     def _initRecords(self, args):
         """
@@ -229,25 +494,125 @@ class CallRecordPlugin:
         records in the database to those open channels from the phone system if
         a call record exists in the db and in the channels then make the
         channel actively monitored, else close out the record or ignore the
-        channel
+        channel. Records already in memory are newer than the database, which
+        may lag a checkpoint or a queued insert behind, so they are kept as
+        they are while their channel is up, and closed out like any other
+        call once it is gone, unless they started after the snapshot was
+        taken and so are missing from it. Only the rows never seen in memory
+        are closed in the database alone.
         """
+        start = time.time()
         records = args[0]
-        channels = args[1]
-
-        self.active = []
+        channels = args[1].channels
 
+        stale = []
         for record in records:
             uid = record[0]
-            found = None
-            for channel in channels:
-                if channel['uniqueid'] == uid:
-                    self.active.append(uid)
-                    found = True
-                    break
-            if not found:
-                h = RequestHandler(self.application.dbpool)
-                d = h.closeRecord(uid).addErrback(self._fail)
-        debug("Active List: %s" % (self.active,))
+            if uid in self.active:
+                continue
+            if uid in channels:
+                channel = channels[uid].get('channel')
+                self.active.add(CallRecord(uid, channel, record[1],
+                    *[self._date(value) for value in record[2:7]],
+                    **dict(zip(('dnid', 'accountCode', 'callerNumber',
+                                'callerName'), record[7:]))))
+            else:
+                stale.append(uid)
+
+        closed = self._resumeRecords(args[1])
+
+        if stale:
+            h = RequestHandler(self.application.getPool('records'))
+            d = h.closeRecords(stale, self.cfg.get('close_batch', 500))
+            d.addErrback(self._fail)
+
+        logger.info("Reconciled %d open records against %d channels in %.3fs,"
+                    " %d active, %d closed", len(records), len(channels),
+                    time.time() - start, len(self.active),
+                    len(stale) + closed)
+
+    def _resumeRecords(self, snapshot):
+        """
+        Keeps monitoring the calls in memory whose channel is still up, or
+        which started after the snapshot was taken, and closes out the rest,
+        returning how many were closed.
+        """
+        closed = 0
+        for record in list(self.active):
+            channel = snapshot.channels.get(record.uid)
+            if channel is None:
+                if (record.callStart is not None and
+                        record.callStart >= snapshot.taken):
+                    continue
+                self.active.remove(record.uid)
+                self._closed(record)
+                closed += 1
+            elif (channel.get('channel') and
+                    channel.get('channel') != record.channel):
+                self.active.rename(record.uid, channel.get('channel'))
+        if not self.database:
+            logger.info("Resumed %d calls still up, %d closed",
+                        len(self.active), closed)
+        return closed
+
+    def _date(self, value):
+        """ Normalizes zero dates read back from the database to None """
+        if value in ('', ZERO_DATE):
+            return None
+        return value
+
+    def _save(self, record):
+        """
+        Writes a record kept in memory back to the database. Used on hangup
+        when running in write-behind mode.
+        """
+        record.dirty = False
+        if not self.database:
+            return None
+        h = RequestHandler(self.application.getPool('records'))
+        d = h.saveRecord(record.uid, *record.row()[:-1])
+        d.addErrback(self._fail)
+        return d
+
+    def _checkpoint(self):
+        """
+        Periodically writes the state of any open records that changed since
+        the last checkpoint, bounding the data lost if stargate dies mid call.
+        """
+        dirty = [r for r in self.active if r.dirty]
+        if not dirty:
+            return
+
+        logger.debug("Checkpointing %d records", len(dirty))
+        for record in dirty:
+            record.dirty = False
+
+        h = RequestHandler(self.application.getPool('records'))
+        d = h.saveRecords([record.row() for record in dirty])
+        d.addErrback(self._checkpointFailed, dirty)
+        return d
+
+    def _checkpointFailed(self, failure, dirty):
+        """ Marks records dirty again so the next checkpoint retries them """
+        for record in dirty:
+            record.dirty = True
+        self._fail(failure)
+
+    def _flushRollups(self, final=False):
+        """
+        Writes the rollups of the buckets which are over, or of every bucket
+        when stopping.
+        """
+        if final:
+            rows = self.rollups.drain()
+        else:
+            rows = self.rollups.due(now())
+        if not rows:
+            return
+        logger.debug("Flushing %d rollup rows", len(rows))
+        h = RequestHandler(self.application.getPool('records'))
+        d = h.saveRollups(rows)
+        d.addErrback(self._fail)
 
     def _fail(self, failure, agi=None):
         """ Handles failures """
@@ -266,19 +631,19 @@ class CallRecordPlugin:
         Ideally it would be all incoming calls on the zap channel and
         all incoming calls from the vonage lines. The point is to exclude
         events triggered by internal channels and communication.
+        Returns the active call record for the channel or None.
         """
         if agi is not None:
             uid = agi.variables['agi_uniqueid']
         elif event is not None:
             uid = event['uniqueid']
         else:
-            return False
+            return None
 
-        return (uid in self.active)
+        return self.active.get(uid)
 
     def _createRecord(self, agi, status=None):
-        debug("%s Chevron: Create Record Command Triggered" %
-            (self.__class__.__name__))
+        logger.debug("Create Record Command Triggered")
 
         if status is None:
             status = agi.getVariable("CDRSTATUS")
@@ -286,17 +651,26 @@ class CallRecordPlugin:
             status = status[0]
 
         ## Chained defers method
-        h = RequestHandler(self.application.dbpool)
-        d = h.createRecord(agi.variables['agi_uniqueid'],
-                           agi.variables['agi_channel'],
-                           agi.variables['agi_callerid'],
-                           agi.variables['agi_calleridname'],
-                           agi.variables['agi_dnid'],
-                           agi.variables['agi_accountcode'],
-                           status)
-        d.addErrback(self._fail, agi=agi)
-
-        self.active.append(agi.variables['agi_uniqueid'])
+        if self.database:
+            h = RequestHandler(self.application.getPool('records'))
+            d = h.createRecord(agi.variables['agi_uniqueid'],
+                               agi.variables['agi_channel'],
+                               agi.variables['agi_callerid'],
+                               agi.variables['agi_calleridname'],
+                               agi.variables['agi_dnid'],
+                               agi.variables['agi_accountcode'],
+                               status)
+            d.addErrback(self._fail, agi=agi)
+
+        self.active.add(CallRecord(agi.variables['agi_uniqueid'],
+                                   agi.variables['agi_channel'], status,
+                                   callStart=now(),
+                                   dnid=agi.variables['agi_dnid'],
+                                   accountCode=agi.variables[
+                                       'agi_accountcode'],
+                                   callerNumber=agi.variables['agi_callerid'],
+                                   callerName=agi.variables[
+                                       'agi_calleridname']))
 
         sequence = fastagi.InSequence()
         sequence.append(agi.wait, 1)
@@ -308,13 +682,17 @@ class CallRecordPlugin:
         Join queue event trigger, once triggered the call status and hold time
         start tracking.
         """
-        if not self._interesting(event=event):
+        record = self._interesting(event=event)
+        if record is None:
             return
 
-        debug("%s Chevron: %s Event Triggered: %s" %
-            (self.__class__.__name__, event['event'], event,))
+        logger.event(event)
+
+        record.enqueue()
+        if self.writeBehind:
+            return
 
-        h = RequestHandler(self.application.dbpool)
+        h = RequestHandler(self.application.getPool('records'))
         d = h.queueRecord(event['uniqueid'])
         d.addErrback(self._fail)
 
@@ -324,13 +702,17 @@ class CallRecordPlugin:
         times will reflect the change. from this point call is either hanging
         up or entering talk state.
         """
-        if not self._interesting(event=event):
+        record = self._interesting(event=event)
+        if record is None:
             return
 
-        debug("%s Chevron: %s Event Triggered: %s" %
-            (self.__class__.__name__, event['event'], event,))
+        logger.event(event)
+
+        record.dequeue()
+        if self.writeBehind:
+            return
 
-        h = RequestHandler(self.application.dbpool)
+        h = RequestHandler(self.application.getPool('records'))
         d = h.dequeueRecord(event['uniqueid'])
         d.addErrback(self._fail)
 
@@ -340,19 +722,23 @@ class CallRecordPlugin:
         another. This is an indication of an agent/phone talking with the
         originating call's channel
         """
-        if event['uniqueid1'] in self.active:
-            uid = event['uniqueid1']
-        elif event['uniqueid2'] in self.active:
-            uid = event['uniqueid2']
-        else:
+        record = self.active.get(event['uniqueid1'])
+        peer = event.get('channel2')
+        if record is None:
+            record = self.active.get(event['uniqueid2'])
+            peer = event.get('channel1')
+        if record is None:
             return
 
-        debug("%s Chevron: %s Event Triggered: %s" %
-            (self.__class__.__name__, event['event'], event,))
+        logger.event(event)
 
         if event['bridgestate'] == "Link":
-            h = RequestHandler(self.application.dbpool)
-            d = h.linkRecord(uid)
+            record.link(peer)
+            if self.writeBehind:
+                return
+
+            h = RequestHandler(self.application.getPool('records'))
+            d = h.linkRecord(record.uid)
             d.addErrback(self._fail)
 
     def _onUnlink(self, ami, event):
@@ -361,30 +747,35 @@ class CallRecordPlugin:
         linked to disconnect. Either entering back into the phone IVR system or
         directly handing up and finishing the call.
         """
-        if event['uniqueid1'] in self.active:
-            uid = event['uniqueid1']
-        elif event['uniqueid2'] in self.active:
-            uid = event['uniqueid2']
-        else:
+        record = (self.active.get(event['uniqueid1']) or
+                  self.active.get(event['uniqueid2']))
+        if record is None:
             return
 
-        debug("%s Chevron: %s Event Triggered: %s" %
-            (self.__class__.__name__, event['event'], event,))
+        logger.event(event)
 
-        h = RequestHandler(self.application.dbpool)
-        d = h.unlinkRecord(uid)
+        record.unlink()
+        if self.writeBehind:
+            return
+
+        h = RequestHandler(self.application.getPool('records'))
+        d = h.unlinkRecord(record.uid)
         d.addErrback(self._fail)
 
     def _onAbandon(self, ami, event):
         """
         """
-        if not self._interesting(event=event):
+        record = self._interesting(event=event)
+        if record is None:
             return
 
-        debug("%s Chevron: %s Event Triggered: %s" %
-            (self.__class__.__name__, event['event'], event,))
+        logger.event(event)
+
+        record.abandon()
+        if self.writeBehind:
+            return
 
-        h = RequestHandler(self.application.dbpool)
+        h = RequestHandler(self.application.getPool('records'))
         d = h.abandonRecord(event['uniqueid'])
         d.addErrback(self._fail)
 
@@ -393,18 +784,44 @@ class CallRecordPlugin:
         Hangup event triggered causes the call record to close out adding
         required end times and final status of call.
         """
-        if not self._interesting(event=event):
+        record = self.active.remove(event['uniqueid'])
+        if record is None:
             return
 
-        debug("%s Chevron: %s Event Triggered: %s" %
-            (self.__class__.__name__, event['event'], event,))
+        logger.event(event)
 
-        h = RequestHandler(self.application.dbpool)
-        d = h.closeRecord(event['uniqueid'])
-        d.addErrback(self._fail)
+        self._closed(record)
+
+        logger.debug("Active calls: %d", len(self.active))
+
+    def _closed(self, record):
+        """
+        Closes out a call no longer monitored, writing it to the records
+        table, rollups and export as configured.
+        """
+        record.close()
+        if self.rollups is not None:
+            self.rollups.add(record.callEnd, (record.dnid, record.accountCode,
+                             record.agent), record.status, record.holdStart,
+                             record.holdEnd, record.talkStart, record.talkEnd)
+        if self.export is not None:
+            self.export.write(record.cdr())
+        if self.writeBehind:
+            self._save(record)
+        else:
+            h = RequestHandler(self.application.getPool('records'))
+            d = h.closeRecord(record.uid)
+            d.addErrback(self._fail)
+
+    def _onRename(self, ami, event):
+        """
+        Channel rename event triggered, e.g. on masquerade or transfer. Keeps
+        the channel name of the active call current.
+        """
+        if self.active.rename(event['uniqueid'], event['newname']) is None:
+            return
 
-        del self.active[event['uniqueid']]
-        debug("Active calls: %d" % (len(self.active),))
+        logger.event(event)
 
 # Comment out this line to disable the plugin
 callRecordPlugin = CallRecordPlugin()
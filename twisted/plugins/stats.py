@@ -0,0 +1,353 @@
+"""
+Stargate live queue statistics plugin, keeping per-queue counters up to date
+from the AMI queue events without touching the database.
+
+Copyright (C) 2010 Ovation Networks, Inc.
+This file is part of Stargate.
+
+Stargate is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Stargate is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Stargate.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import time
+from collections import deque
+
+from zope.interface import implements
+from twisted.plugin import IPlugin
+from twisted.web import resource
+
+from stargate import IChevron, getLogger
+import metrics
+import config
+
+
+logger = getLogger('StatsPlugin')
+
+
+AVAILABLE = 'available'
+BUSY = 'busy'
+PAUSED = 'paused'
+UNAVAILABLE = 'unavailable'
+
+## Member device states counted as busy: in use, busy, ringing, ringing
+## while in use and on hold
+BUSY_STATES = ('2', '3', '6', '7', '8')
+
+
+def memberState(status, paused):
+    """ Sorts a queue member into one of the agent states counted """
+    if str(paused) == '1':
+        return PAUSED
+    status = str(status)
+    if status == '1':
+        return AVAILABLE
+    if status in BUSY_STATES:
+        return BUSY
+    return UNAVAILABLE
+
+
+class Window(object):
+    """
+    Sum and count of the values observed over the last span seconds. Values
+    are summed into one slot per step seconds, reused as the window moves
+    on, so adding a value is constant time however busy the queue is.
+    """
+    __slots__ = ('step', 'size', 'slots', 'sums', 'counts')
+
+    def __init__(self, span=900, step=10):
+        self.step = step
+        self.size = max(1, int(span // step))
+        self.slots = [None] * self.size
+        self.sums = [0.0] * self.size
+        self.counts = [0] * self.size
+
+    def add(self, value, now):
+        slot = int(now // self.step)
+        i = slot % self.size
+        if self.slots[i] != slot:
+            self.slots[i] = slot
+            self.sums[i] = 0.0
+            self.counts[i] = 0
+        self.sums[i] += value
+        self.counts[i] += 1
+
+    def totals(self, now):
+        """ Returns the sum and count of the values still in the window """
+        oldest = int(now // self.step) - self.size
+        (total, count) = (0.0, 0)
+        for i in xrange(self.size):
+            slot = self.slots[i]
+            if slot is not None and slot > oldest:
+                total += self.sums[i]
+                count += self.counts[i]
+        return (total, count)
+
+    def average(self, now):
+        (total, count) = self.totals(now)
+        return count and total / count or 0.0
+
+
+class QueueStats:
+    """
+    Running statistics of a single queue. Callers are kept by uniqueid with
+    the time they joined, oldest first, and agents by location with their
+    status and paused flag, so every event updates the counts in constant
+    time. The join order keeps callers who left until they reach its head,
+    and is rebuilt should they come to outnumber the callers still waiting.
+    """
+
+    def __init__(self, name, span=900, step=10, serviceLevel=20):
+        self.name = name
+        self.serviceLevel = serviceLevel
+        self.callers = {}
+        self.order = deque()
+        self.agents = {}
+        self.states = {AVAILABLE: 0, BUSY: 0, PAUSED: 0, UNAVAILABLE: 0}
+        self.joined = 0
+        self.answered = 0
+        self.abandoned = 0
+        self.completed = 0
+        self.waits = Window(span, step)
+        self.talks = Window(span, step)
+        # One value per answered call: 1 if within the service level
+        self.answers = Window(span, step)
+        self.abandons = Window(span, step)
+
+    def join(self, uid, now, wait=0):
+        joined = now - wait
+        self.callers[uid] = joined
+        self.order.append((joined, uid))
+        self.joined += 1
+
+    def leave(self, uid):
+        self.callers.pop(uid, None)
+        self._trim()
+
+    def connect(self, holdtime, now):
+        self.answered += 1
+        self.waits.add(holdtime, now)
+        self.answers.add(holdtime <= self.serviceLevel and 1 or 0, now)
+
+    def abandon(self, holdtime, now):
+        self.abandoned += 1
+        self.waits.add(holdtime, now)
+        self.abandons.add(1, now)
+
+    def complete(self, talktime, now):
+        self.completed += 1
+        self.talks.add(talktime, now)
+
+    def setAgent(self, location, status, paused):
+        previous = self.agents.get(location)
+        if previous is not None:
+            self.states[memberState(*previous)] -= 1
+        self.agents[location] = (status, paused)
+        self.states[memberState(status, paused)] += 1
+
+    def pauseAgent(self, location, paused):
+        previous = self.agents.get(location)
+        if previous is not None:
+            self.setAgent(location, previous[0], paused)
+
+    def removeAgent(self, location):
+        previous = self.agents.pop(location, None)
+        if previous is not None:
+            self.states[memberState(*previous)] -= 1
+
+    def reset(self):
+        """ Forgets the callers and agents, keeping the counters """
+        self.callers.clear()
+        self.order.clear()
+        self.agents.clear()
+        for state in self.states:
+            self.states[state] = 0
+
+    def longestWait(self, now):
+        """ Seconds the oldest caller still in queue has been waiting """
+        self._trim()
+        order = self.order
+        return order and now - order[0][0] or 0.0
+
+    def _trim(self):
+        """ Drops the callers who left from the join order """
+        order = self.order
+        while order and self.callers.get(order[0][1]) != order[0][0]:
+            order.popleft()
+        if len(order) > 2 * len(self.callers) + 100:
+            order.clear()
+            order.extend(sorted([(joined, uid) for (uid, joined)
+                                 in self.callers.iteritems()]))
+
+    def stats(self, now):
+        (within, answered) = self.answers.totals(now)
+        abandoned = self.abandons.totals(now)[1]
+        offered = answered + abandoned
+        return {'depth': len(self.callers),
+                'longest_wait': self.longestWait(now),
+                'average_wait': self.waits.average(now),
+                'average_talk': self.talks.average(now),
+                'abandon_rate': offered and float(abandoned) / offered or 0.0,
+                'service_level': offered and within / offered or 0.0,
+                'agents': dict(self.states),
+                'joined': self.joined, 'answered': self.answered,
+                'abandoned': self.abandoned, 'completed': self.completed}
+
+
+class StatsEngine:
+    """ Statistics of every watched queue, kept entirely in memory """
+
+    def __init__(self, queues, span=900, step=10, serviceLevel=20):
+        self.queues = {}
+        for name in queues:
+            self.queues[name] = QueueStats(name, span, step, serviceLevel)
+
+    def get(self, name):
+        return self.queues.get(name)
+
+    def stats(self, name=None, now=None):
+        """
+        Returns the statistics of the named queue, or of every queue keyed
+        by name.
+        """
+        if now is None:
+            now = time.time()
+        if name is not None:
+            return self.queues[name].stats(now)
+        result = {}
+        for (name, queue) in self.queues.items():
+            result[name] = queue.stats(now)
+        return result
+
+
+class StatsResource(resource.Resource):
+    """ Serves the queue statistics as json, ?queue=name for just one """
+    isLeaf = True
+
+    def __init__(self, engine):
+        resource.Resource.__init__(self)
+        self.engine = engine
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        name = request.args.get('queue', [None])[0]
+        if name is not None and self.engine.get(name) is None:
+            request.setResponseCode(404)
+            return json.dumps({'error': 'Unknown queue %s' % (name,)})
+        return json.dumps(self.engine.stats(name), sort_keys=True)
+
+
+class StatsPlugin:
+    """
+    Live queue statistics plugin implementation to work with the stargate
+    and asterisk interface system. Statistics are available in-process from
+    the engine and over HTTP at /stats next to the metrics.
+    """
+    implements(IChevron, IPlugin)
+
+    def __init__(self):
+        self.application = None
+        self.cfg = config.plugins.get('stats', {})
+        self.engine = StatsEngine(self.cfg.get('queues', ()),
+                                  self.cfg.get('window', 900),
+                                  self.cfg.get('step', 10),
+                                  self.cfg.get('service_level', 20))
+
+    def registerServices(self, application):
+        logger.debug("Services Locked.")
+        if self.application is None:
+            self.application = application
+        self.application.registerResource('stats',
+                                          StatsResource(self.engine))
+        for queue in self.engine.queues.values():
+            self._registerMetrics(queue)
+
+    def registerEvents(self, application):
+        logger.debug("Events Locked.")
+        if self.application is None:
+            self.application = application
+        queues = {'queue': self.engine.queues}
+        self.application.registerEvent('Join', self._onJoin, queues)
+        self.application.registerEvent('Leave', self._onLeave, queues)
+        self.application.registerEvent('QueueCallerAbandon',
+                                       self._onAbandon, queues)
+        self.application.registerEvent('AgentConnect', self._onConnect,
+                                       queues)
+        self.application.registerEvent('AgentComplete', self._onComplete,
+                                       queues)
+        self.application.registerEvent('QueueMemberStatus',
+                                       self._onAgentStatus, queues)
+        self.application.registerEvent('QueueMemberPaused',
+                                       self._onAgentPause, queues)
+        self.application.registerEvent('QueueMemberAdded',
+                                       self._onAgentStatus, queues)
+        self.application.registerEvent('QueueMemberRemoved',
+                                       self._onAgentRemoved, queues)
+
+    def onStatus(self, snapshot):
+        """ Rebuilds the callers and agents in queue on each connection """
+        now = time.time()
+        for (name, queue) in self.engine.queues.items():
+            queue.reset()
+            for event in snapshot.entries.get(name, ()):
+                queue.join(event['uniqueid'], now,
+                           float(event.get('wait') or 0))
+            for event in snapshot.members.get(name, ()):
+                queue.setAgent(event['location'], event['status'],
+                               event['paused'])
+
+    def _registerMetrics(self, queue):
+        registry = metrics.registry
+        registry.gauge('stargate_queue_depth', 'Callers waiting in queue',
+            lambda: len(queue.callers), queue=queue.name)
+        registry.gauge('stargate_queue_longest_wait_seconds',
+            'Wait of the longest waiting caller in queue',
+            lambda: queue.longestWait(time.time()), queue=queue.name)
+        for state in queue.states:
+            registry.gauge('stargate_queue_agents', 'Queue members by state',
+                lambda state=state: queue.states[state], queue=queue.name,
+                state=state)
+
+    def _onJoin(self, ami, event):
+        self.engine.queues[event['queue']].join(event['uniqueid'],
+                                                time.time())
+
+    def _onLeave(self, ami, event):
+        self.engine.queues[event['queue']].leave(event['uniqueid'])
+
+    def _onAbandon(self, ami, event):
+        self.engine.queues[event['queue']].abandon(
+            float(event.get('holdtime') or 0), time.time())
+
+    def _onConnect(self, ami, event):
+        self.engine.queues[event['queue']].connect(
+            float(event.get('holdtime') or 0), time.time())
+
+    def _onComplete(self, ami, event):
+        self.engine.queues[event['queue']].complete(
+            float(event.get('talktime') or 0), time.time())
+
+    def _onAgentStatus(self, ami, event):
+        self.engine.queues[event['queue']].setAgent(
+            event['location'], event['status'], event['paused'])
+
+    def _onAgentPause(self, ami, event):
+        self.engine.queues[event['queue']].pauseAgent(event['location'],
+                                                      event['paused'])
+
+    def _onAgentRemoved(self, ami, event):
+        self.engine.queues[event['queue']].removeAgent(event['location'])
+
+
+# Comment out this line to disable the plugin
+statsPlugin = StatsPlugin()